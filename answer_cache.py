@@ -0,0 +1,132 @@
+"""
+Semantic cache of web-only answers.
+
+Trending questions arrive many times within minutes in slightly different
+words ("latest news on X", "what's the latest on X?"). Each one used to cost a
+Serper search plus a Gemini call. The cache embeds the normalized query with the
+already-loaded MiniLM model and looks up its nearest neighbour among recent
+queries in an in-memory FAISS inner-product index; when the cosine similarity
+clears ANSWER_CACHE_THRESHOLD and the entry is younger than ANSWER_CACHE_TTL
+seconds, the stored answer is returned without searching or generating.
+
+Only self-contained questions are cached. Queries that point back into the
+conversation ("tell me more about it", "what about the second one?") or at the
+user's uploaded documents depend on more than their own text and always go to
+the LLM; callers also keep document (RAG) answers out of the cache. Because
+the cache is shared by all users, cached answers must be generated from a
+prompt without any user's conversation context.
+"""
+import os
+import re
+import time
+import threading
+import numpy as np
+import faiss
+
+ANSWER_CACHE_ENABLED = os.getenv('ANSWER_CACHE', 'true').lower() in ('1', 'true', 'yes')
+ANSWER_CACHE_THRESHOLD = float(os.getenv('ANSWER_CACHE_THRESHOLD', '0.92'))   # cosine similarity
+ANSWER_CACHE_TTL = int(os.getenv('ANSWER_CACHE_TTL', '600'))                   # seconds
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', '5000'))
+
+# Pronouns and follow-up phrasing that only make sense with the conversation before them
+CONTEXT_REFERENCE_RE = re.compile(
+    r"\b(it|its|this|that|these|those|they|them|their|he|him|his|she|her|above|previous|earlier|"
+    r"again|more|further|continue|elaborate|else|same|first one|second one|last one|you said)\b")
+DOCUMENT_REFERENCE_RE = re.compile(r"\b(document|doc|docs|pdf|file|files|upload|uploaded|attachment|attached)\b")
+URL_RE = re.compile(r"https?://|www\.")
+PUNCTUATION_RE = re.compile(r"[^\w\s]")
+
+
+def normalize_query(query):
+    """Lower-cased query with punctuation dropped and whitespace collapsed"""
+    return " ".join(PUNCTUATION_RE.sub(" ", query.lower()).split())
+
+
+def is_cacheable_query(query):
+    """True for self-contained questions whose answer doesn't depend on the conversation or documents"""
+    normalized = normalize_query(query)
+    if len(normalized.split()) < 2 or URL_RE.search(query.lower()):
+        return False
+    return not (CONTEXT_REFERENCE_RE.search(normalized) or DOCUMENT_REFERENCE_RE.search(normalized))
+
+
+class SemanticAnswerCache:
+    """Recent answers indexed by query embedding"""
+
+    def __init__(self, encode, dimension, threshold=ANSWER_CACHE_THRESHOLD, ttl=ANSWER_CACHE_TTL,
+                 max_entries=ANSWER_CACHE_MAX_ENTRIES):
+        self.encode = encode            # callable(text) -> (1, dimension) embedding
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(dimension))
+        self.entries = {}               # {id: {'query', 'answer', 'created', 'seconds'}}, insertion ordered
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+
+    def _embed(self, normalized):
+        vector = np.array(self.encode(normalized), dtype=np.float32).reshape(1, -1)
+        faiss.normalize_L2(vector)
+        return vector
+
+    def _expire(self, now):
+        # Entries are insertion ordered, so expired ones are at the front
+        stale = []
+        for entry_id, entry in self.entries.items():
+            if now - entry['created'] <= self.ttl and len(self.entries) - len(stale) <= self.max_entries:
+                break
+            stale.append(entry_id)
+        if stale:
+            self.index.remove_ids(np.array(stale, dtype=np.int64))
+            for entry_id in stale:
+                del self.entries[entry_id]
+
+    def lookup(self, query):
+        """(answer, similarity) of a fresh, similar enough cached query, or None"""
+        vector = self._embed(normalize_query(query))
+        with self.lock:
+            self._expire(time.time())
+            if self.index.ntotal:
+                scores, ids = self.index.search(vector, 1)
+                entry = self.entries.get(int(ids[0][0]))
+                if entry is not None and scores[0][0] >= self.threshold:
+                    self.hits += 1
+                    self.seconds_saved += entry['seconds']
+                    print(f"🎯 Answer cache hit ({scores[0][0]:.3f}): '{entry['query']}'")
+                    return entry['answer'], float(scores[0][0])
+            self.misses += 1
+        return None
+
+    def store(self, query, answer, seconds):
+        """Remember answer for query; seconds is what producing it cost (credited on later hits)"""
+        normalized = normalize_query(query)
+        vector = self._embed(normalized)
+        with self.lock:
+            entry_id = self.next_id
+            self.next_id += 1
+            self.index.add_with_ids(vector, np.array([entry_id], dtype=np.int64))
+            self.entries[entry_id] = {'query': normalized, 'answer': answer, 'created': time.time(), 'seconds': seconds}
+            self._expire(time.time())
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else None,
+                'seconds_saved': round(self.seconds_saved, 2),
+                'threshold': self.threshold,
+                'ttl_seconds': self.ttl
+            }
+
+
+def open_answer_cache(encode, dimension):
+    """The shared answer cache, or None when disabled"""
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    return SemanticAnswerCache(encode, dimension)
@@ -0,0 +1,220 @@
+"""
+Content-addressed store of ingest artifacts.
+
+Uploads are hashed (SHA-256) while they are spooled. After a document has been
+ingested once, its chunks (with character offsets) and chunk embeddings are
+kept under RAG_ARTIFACT_DIR, keyed by that hash plus the ingest
+settings that produced them (embedding model, chunk size and overlap). A later
+upload of the same bytes, into any conversation, attaches those artifacts
+instead of parsing, chunking and embedding the file again.
+
+Entries are written to a temporary directory and renamed into place, so readers
+only ever see complete entries and several workers can share one store. The
+store is bounded by RAG_ARTIFACT_MAX_MB: each process keeps a running total of
+the bytes it knows about and only rescans the directory (which other workers
+also write to) when that total goes over budget, then removes the least
+recently used entries until the store is back under ARTIFACT_PRUNE_TARGET of it.
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import numpy as np
+
+RAG_ARTIFACTS_ENABLED = os.getenv('RAG_ARTIFACTS', 'true').lower() in ('1', 'true', 'yes')
+RAG_ARTIFACT_DIR = os.getenv('RAG_ARTIFACT_DIR', os.path.join(tempfile.gettempdir(), "rag_artifacts"))
+RAG_ARTIFACT_MAX_MB = int(os.getenv('RAG_ARTIFACT_MAX_MB', '2048'))
+ARTIFACT_PRUNE_TARGET = 0.9     # pruning frees down to this share of the budget, so it runs rarely
+
+CHUNKS_FILENAME = "chunks.json"
+VECTORS_FILENAME = "embeddings.npy"
+META_FILENAME = "meta.json"     # written last; its mtime doubles as the entry's last-use time
+
+
+def content_hasher():
+    return hashlib.sha256()
+
+
+class DocumentArtifacts:
+    """A stored document: chunk texts, offsets and embeddings (memory-mapped)"""
+
+    def __init__(self, directory, meta, texts, offsets, vectors):
+        self.directory = directory
+        self.meta = meta
+        self.texts = texts
+        self.offsets = offsets
+        self.vectors = vectors
+
+    @property
+    def content_hash(self):
+        return self.meta['content_hash']
+
+
+class ArtifactWriter:
+    """Collects one document's artifacts during ingest and publishes them on commit"""
+
+    def __init__(self, store, content_hash):
+        self.store = store
+        self.content_hash = content_hash
+        self.directory = tempfile.mkdtemp(prefix=".incoming-", dir=store.directory)
+        self.texts, self.offsets, self.vectors = [], [], []
+
+    def add(self, chunks, vectors):
+        self.texts.extend(chunk['text'] for chunk in chunks)
+        self.offsets.extend((chunk['start'], chunk['end']) for chunk in chunks)
+        self.vectors.append(np.asarray(vectors, dtype=np.float32))
+
+    def commit(self, filename):
+        """Publish the entry; returns False if it could not be stored"""
+        try:
+            vectors = np.vstack(self.vectors) if self.vectors else np.zeros((0, 0), dtype=np.float32)
+            np.save(os.path.join(self.directory, VECTORS_FILENAME), vectors)
+            with open(os.path.join(self.directory, CHUNKS_FILENAME), 'w', encoding='utf-8') as f:
+                json.dump({'texts': self.texts, 'offsets': self.offsets}, f, ensure_ascii=False)
+            meta = {
+                'content_hash': self.content_hash,
+                'settings': self.store.settings,
+                'filename': filename,
+                'chunks': len(self.texts),
+                'created_at': time.time()
+            }
+            with open(os.path.join(self.directory, META_FILENAME), 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+            return self.store.publish(self.content_hash, self.directory)
+        except Exception as e:
+            print(f"❌ Failed to store artifacts for {self.content_hash[:12]}: {e}")
+            self.abort()
+            return False
+
+    def abort(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class ArtifactStore:
+    """Artifacts of ingested documents keyed by content hash and ingest settings"""
+
+    def __init__(self, settings, directory=RAG_ARTIFACT_DIR, max_bytes=RAG_ARTIFACT_MAX_MB * 1024 * 1024):
+        self.settings = settings      # e.g. {'model': ..., 'chunk_tokens': ..., 'overlap_tokens': ...}
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.fingerprint = hashlib.blake2b(json.dumps(settings, sort_keys=True).encode('utf-8'),
+                                           digest_size=4).hexdigest()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.entry_bytes = {}         # {entry directory: bytes} as of the last scan plus entries published since
+        self.total_bytes = 0
+        self._rescan()
+
+    def entry_dir(self, content_hash):
+        return os.path.join(self.directory, f"{content_hash}-{self.fingerprint}")
+
+    def get(self, content_hash):
+        """Stored artifacts for a content hash, or None"""
+        directory = self.entry_dir(content_hash)
+        meta_path = os.path.join(directory, META_FILENAME)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            with open(os.path.join(directory, CHUNKS_FILENAME), 'r', encoding='utf-8') as f:
+                chunks = json.load(f)
+            vectors = np.load(os.path.join(directory, VECTORS_FILENAME), mmap_mode='r')
+            os.utime(meta_path)
+        except (OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return DocumentArtifacts(directory, meta, chunks['texts'], [tuple(span) for span in chunks['offsets']], vectors)
+
+    def writer(self, content_hash):
+        try:
+            return ArtifactWriter(self, content_hash)
+        except OSError as e:
+            print(f"❌ Cannot stage artifacts for {content_hash[:12]}: {e}")
+            return None
+
+    def publish(self, content_hash, staged_directory):
+        target = self.entry_dir(content_hash)
+        size = _directory_bytes(staged_directory)
+        try:
+            os.rename(staged_directory, target)
+        except OSError:
+            # Another job stored the same document first; keep theirs
+            shutil.rmtree(staged_directory, ignore_errors=True)
+            return os.path.isdir(target)
+        print(f"🗃️ Stored ingest artifacts for {content_hash[:12]}")
+        with self.lock:
+            self.total_bytes += size - self.entry_bytes.get(target, 0)
+            self.entry_bytes[target] = size
+            over_budget = self.total_bytes > self.max_bytes
+        if over_budget:
+            self.prune()
+        return True
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            directory = os.path.join(self.directory, name)
+            if name.startswith('.') or not os.path.isdir(directory):
+                continue
+            try:
+                size = _directory_bytes(directory)
+                used = os.path.getmtime(os.path.join(directory, META_FILENAME))
+            except OSError:
+                continue
+            entries.append((used, size, directory))
+        return entries
+
+    def _rescan(self):
+        # Full walk: picks up entries other workers stored or pruned since the last one
+        entries = self._entries()
+        with self.lock:
+            self.entry_bytes = {directory: size for _, size, directory in entries}
+            self.total_bytes = sum(self.entry_bytes.values())
+        return entries
+
+    def prune(self):
+        """Remove least recently used entries until the store is back under ARTIFACT_PRUNE_TARGET of its budget"""
+        entries = sorted(self._rescan())
+        if self.total_bytes <= self.max_bytes:
+            return
+        target = self.max_bytes * ARTIFACT_PRUNE_TARGET
+        for _, size, directory in entries:
+            with self.lock:
+                if self.total_bytes <= target:
+                    break
+                self.entry_bytes.pop(directory, None)
+                self.total_bytes -= size
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entry_bytes),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else None
+            }
+
+
+def _directory_bytes(directory):
+    return sum(entry.stat().st_size for entry in os.scandir(directory))
+
+
+def open_artifact_store(settings):
+    """The shared artifact store, or None when disabled/unavailable"""
+    if not RAG_ARTIFACTS_ENABLED:
+        return None
+    try:
+        return ArtifactStore(settings)
+    except Exception as e:
+        print(f"❌ Failed to open artifact store: {e}")
+        return None
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+"""
+Performance benchmarks for the RAG layer.
+
+Usage:
+    python benchmarks.py index [--sizes 1000 10000 50000] [--k 10] [--text FILE]
+    python benchmarks.py compression [--size 10000] [--k 10] [--text FILE]
+    python benchmarks.py embeddings [--backends torch onnx onnx-int8] [--text FILE] [--min-cosine 0.99]
+    python benchmarks.py encode [--files a.pdf b.txt ...] [--token-budget 8192]
+    python benchmarks.py extract [--files big.pdf report.docx old.doc notes.txt ...]
+    python benchmarks.py chunk [--files big.pdf notes.txt ...] [--repeat 20] [--chunk-tokens 128]
+
+By default the benchmarks run on synthetic clustered unit vectors shaped like
+MiniLM embeddings (384 dims), so they need neither the model nor network access.
+Pass --text to embed real chunks of a text file with the configured model instead.
+
+The embeddings benchmark needs the model: it checks each backend's cosine
+agreement with the PyTorch reference on a fixed corpus (exiting non-zero below
+--min-cosine) and reports encode throughput in sentences/sec. The encode
+benchmark compares fixed 32-chunk batches in document order with the
+length-bucketed, token-budgeted batching used at ingest. The chunk benchmark
+times the ingest chunker against the old character splitter on extracted
+segments (pages for PDFs) and reports how much of the text each one keeps.
+The extract benchmark runs every registered extractor that can read each file
+(every PDF backend for PDFs) and reports MB/s, pages (segments) per second and
+word agreement with the first backend.
+"""
+import os
+import re
+import sys
+import argparse
+import time
+import numpy as np
+import faiss
+
+import rag_store
+import chunking
+import embeddings
+import extractors
+
+DIMENSION = 384
+MODEL_NAME = 'all-MiniLM-L6-v2'
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "comprehensive_news_knowledge.txt")
+
+
+def synthetic_embeddings(n, dimension=DIMENSION, clusters=64, seed=0):
+    """Unit vectors drawn around random topic centroids, roughly like sentence embeddings"""
+    rng = np.random.default_rng(seed)
+    centroids = rng.standard_normal((clusters, dimension)).astype(np.float32)
+    assignments = rng.integers(0, clusters, size=n)
+    vectors = centroids[assignments] + 0.6 * rng.standard_normal((n, dimension)).astype(np.float32)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def text_embeddings(path, n):
+    """Embed paragraphs of a text file with the embedding model, repeated up to n chunks"""
+    with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+        paragraphs = [p.strip() for p in f.read().split('\n\n') if len(p.strip()) > 50]
+    model = embeddings.load_embedding_backend(MODEL_NAME)
+    vectors = model.encode(paragraphs, show_progress_bar=False).astype(np.float32)
+    faiss.normalize_L2(vectors)
+    # Jitter repeats slightly so duplicated paragraphs don't produce exact ties
+    repeats = int(np.ceil(n / len(vectors)))
+    tiled = np.tile(vectors, (repeats, 1))[:n]
+    tiled += 0.01 * np.random.default_rng(0).standard_normal(tiled.shape).astype(np.float32)
+    faiss.normalize_L2(tiled)
+    return tiled
+
+
+def split_queries(vectors, num_queries=200, seed=1):
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(len(vectors), size=min(num_queries, len(vectors)), replace=False)
+    queries = vectors[picks] + 0.05 * rng.standard_normal((len(picks), vectors.shape[1])).astype(np.float32)
+    faiss.normalize_L2(queries)
+    return queries
+
+
+def recall_at_k(ground_truth, found, k):
+    hits = sum(len(set(gt[:k]) & set(fd[:k])) for gt, fd in zip(ground_truth, found))
+    return hits / float(k * len(ground_truth))
+
+
+def time_search(index, queries, k):
+    """Mean single-query latency in ms (queries issued one at a time, like search_documents)"""
+    results = []
+    start = time.perf_counter()
+    for query in queries:
+        _, ids = index.search(query.reshape(1, -1), k)
+        results.append(ids[0])
+    elapsed = time.perf_counter() - start
+    return results, 1000.0 * elapsed / len(queries)
+
+
+def bench_index(args):
+    print(f"{'chunks':>8} {'index':>6} {'build ms':>9} {'query ms':>9} {'recall@' + str(args.k):>10}")
+    for n in args.sizes:
+        vectors = text_embeddings(args.text, n) if args.text else synthetic_embeddings(n)
+        ids = np.arange(n, dtype=np.int64)
+        queries = split_queries(vectors)
+
+        baseline = rag_store.build_index('flat', vectors.shape[1], vectors, ids)
+        ground_truth, _ = time_search(baseline, queries, args.k)
+
+        for index_type in ('flat', 'ivf', 'hnsw'):
+            if index_type == 'ivf' and n < 1000:
+                continue
+            start = time.perf_counter()
+            index = rag_store.build_index(index_type, vectors.shape[1], vectors, ids)
+            build_ms = 1000.0 * (time.perf_counter() - start)
+            found, query_ms = time_search(index, queries, args.k)
+            recall = recall_at_k(ground_truth, found, args.k)
+            print(f"{n:>8} {index_type:>6} {build_ms:>9.1f} {query_ms:>9.3f} {recall:>10.3f}")
+
+
+def bench_compression(args):
+    n = args.size
+    vectors = text_embeddings(args.text, n) if args.text else synthetic_embeddings(n)
+    ids = np.arange(n, dtype=np.int64)
+    queries = split_queries(vectors)
+
+    baseline = rag_store.build_index('flat', vectors.shape[1], vectors, ids)
+    ground_truth, _ = time_search(baseline, queries, args.k)
+    float32_bytes = vectors.shape[1] * 4
+
+    print(f"{n} chunks, {vectors.shape[1]} dims (raw float32 = {float32_bytes} bytes/vector)")
+    print(f"{'index':>6} {'mode':>6} {'bytes/vec':>10} {'total MB':>9} {'query ms':>9} {'recall@' + str(args.k):>10}")
+    for index_type in ('flat', 'ivf'):
+        for compression in ('none', 'fp16', 'int8', 'pq'):
+            index = rag_store.build_index(index_type, vectors.shape[1], vectors, ids, compression)
+            # Serialized size covers codes, ids and quantizer/centroid tables
+            total_bytes = faiss.serialize_index(index).nbytes
+            found, query_ms = time_search(index, queries, args.k)
+            recall = recall_at_k(ground_truth, found, args.k)
+            print(f"{index_type:>6} {compression:>6} {total_bytes / n:>10.1f} {total_bytes / 1e6:>9.2f} "
+                  f"{query_ms:>9.3f} {recall:>10.3f}")
+
+
+def corpus_sentences(path, limit):
+    """Fixed, deterministic sentence list: the first `limit` non-trivial lines of a text file"""
+    with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+        lines = [line.strip(' -•\t') for line in f.read().splitlines()]
+    sentences = [line for line in lines if len(line) > 20 and not re.fullmatch(r'[=\-_ ]+', line)]
+    return sentences[:limit]
+
+
+def time_encode(backend, sentences, batch_size, repeats=3):
+    """Best-of-N sentences/sec for encoding the whole list"""
+    backend.encode(sentences[:batch_size], batch_size=batch_size)   # warm-up
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        backend.encode(sentences, batch_size=batch_size)
+        best = min(best, time.perf_counter() - start)
+    return len(sentences) / best
+
+
+def bench_embeddings(args):
+    sentences = corpus_sentences(args.text, args.sentences)
+    print(f"{len(sentences)} sentences from {os.path.basename(args.text)}, batch size {args.batch_size}")
+
+    reference = embeddings.TorchEmbeddingBackend(MODEL_NAME)
+    print(f"{'backend':>10} {'sent/sec':>10} {'speedup':>8} {'min cos':>8} {'mean cos':>9}")
+    baseline = None
+    failed = False
+    for name in args.backends:
+        backend = reference if name == 'torch' else embeddings.OnnxEmbeddingBackend(MODEL_NAME, quantize=(name == 'onnx-int8'))
+        throughput = time_encode(backend, sentences, args.batch_size)
+        baseline = baseline or throughput
+        parity = embeddings.embedding_parity(reference, backend, sentences, args.batch_size)
+        failed |= parity['min'] < args.min_cosine
+        print(f"{name:>10} {throughput:>10.1f} {throughput / baseline:>7.2f}x "
+              f"{parity['min']:>8.4f} {parity['mean']:>9.4f}")
+    if failed:
+        print(f"❌ Parity below {args.min_cosine} for at least one backend")
+        sys.exit(1)
+
+
+def document_text(path):
+    if path.lower().endswith('.pdf'):
+        import PyPDF2
+        with open(path, 'rb') as f:
+            return "\n\n".join(page.extract_text() or "" for page in PyPDF2.PdfReader(f).pages)
+    with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+        return f.read()
+
+
+def ingest_chunks(text):
+    """Chunk texts exactly as ingest produces them"""
+    return [chunk['text'] for chunk in chunking.chunk_text(text)]
+
+
+def legacy_chunks(segments):
+    """The ~400-char paragraph/sentence splitter ingest used before chunking.py (baseline only)"""
+    text = "".join(segments)
+    for paragraph in text.split('\n\n'):
+        if len(paragraph.strip()) > 100:
+            if len(paragraph) > 400:
+                current_chunk = ""
+                for sentence in paragraph.split('. '):
+                    if len(current_chunk + sentence) < 400:
+                        current_chunk += sentence + ". "
+                    else:
+                        if len(current_chunk.strip()) > 50:
+                            yield current_chunk.strip()
+                        current_chunk = sentence + ". "
+                if len(current_chunk.strip()) > 50:
+                    yield current_chunk.strip()
+            else:
+                yield paragraph.strip()
+
+
+def document_segments(path, repeat=1):
+    """Extracted segments (pages for PDFs), read once and replayed repeat times"""
+    with open(path, 'rb') as f:
+        segments = list(extractors.iter_document_text(f, path))
+    return segments * repeat
+
+
+def bench_chunk(args):
+    print(f"{'file':<32} {'chunker':>8} {'MB':>7} {'MB/s':>8} {'chunks':>7} "
+          f"{'tok mean':>8} {'tok max':>7} {'kept':>7}")
+    for path in args.files:
+        segments = document_segments(path, args.repeat)
+        megabytes = sum(len(segment) for segment in segments) / 1e6
+        words = sum(len(segment.split()) for segment in segments)
+        runs = [('legacy', lambda: list(legacy_chunks(segments))),
+                ('token', lambda: list(chunking.iter_chunks(segments, args.chunk_tokens, args.overlap_tokens)))]
+        for name, run in runs:
+            best = float('inf')
+            for _ in range(args.repeats):
+                started = time.perf_counter()
+                chunks = run()
+                best = min(best, time.perf_counter() - started)
+            # Share of the document's words that ended up in some chunk (overlap counted once)
+            kept_text = chunking.join_chunks(chunks) if name == 'token' else " ".join(chunks)
+            tokens = [chunking.estimate_tokens(chunk['text'] if name == 'token' else chunk) for chunk in chunks] or [0]
+            print(f"{os.path.basename(path)[:32]:<32} {name:>8} {megabytes:>7.2f} {megabytes / best:>8.1f} "
+                  f"{len(chunks):>7} {np.mean(tokens):>8.0f} {max(tokens):>7} {len(kept_text.split()) / max(words, 1):>7.1%}")
+
+
+def extractor_variants(path):
+    """(label, callable(stream) -> segments) for every way the registry can read this file"""
+    with open(path, 'rb') as f:
+        name = extractors.resolve_extractor(f, path)
+    if name == 'pdf':
+        return name, [(f"pdf/{backend}", lambda stream, backend=backend: extractors.iter_pdf_text(stream, backend))
+                      for backend in extractors.PDF_BACKENDS]
+    return name, [(name, extractors.EXTRACTORS[name])]
+
+
+def bench_extract(args):
+    print(f"{'file':<28} {'extractor':<15} {'MB':>6} {'MB/s':>8} {'pages/s':>9} {'chars':>9} {'agree':>6}")
+    for path in args.files:
+        megabytes = os.path.getsize(path) / 1e6
+        _, variants = extractor_variants(path)
+        reference = None
+        for label, extract in variants:
+            best, segments = float('inf'), []
+            try:
+                for _ in range(args.repeats):
+                    with open(path, 'rb') as f:
+                        started = time.perf_counter()
+                        segments = list(extract(f))
+                        best = min(best, time.perf_counter() - started)
+            except ImportError as e:
+                print(f"{os.path.basename(path)[:28]:<28} {label:<15} not installed ({e.name})")
+                continue
+            # Word-set agreement with the first backend: a fast backend that drops text shows up here
+            words = set("".join(segments).split())
+            reference = words if reference is None else reference
+            agree = len(words & reference) / max(len(words | reference), 1)
+            print(f"{os.path.basename(path)[:28]:<28} {label:<15} {megabytes:>6.2f} {megabytes / best:>8.1f} "
+                  f"{len(segments) / best:>9.0f} {sum(len(segment) for segment in segments):>9} {agree:>6.1%}")
+
+
+def padding_efficiency(lengths, batches):
+    """Real tokens / padded tokens for a batching plan"""
+    padded = sum(len(batch) * max(lengths[i] for i in batch) for batch in batches)
+    return float(sum(lengths)) / padded if padded else 1.0
+
+
+def bench_encode(args):
+    chunks = [chunk for path in args.files for chunk in ingest_chunks(document_text(path))]
+    model = embeddings.load_embedding_backend(MODEL_NAME)
+    lengths = embeddings.token_lengths(model, chunks).tolist()
+    print(f"{len(chunks)} chunks from {len(args.files)} file(s), backend {model.name}, "
+          f"tokens/chunk min {min(lengths)} mean {np.mean(lengths):.0f} max {max(lengths)}")
+
+    fixed = [list(range(start, min(start + 32, len(chunks)))) for start in range(0, len(chunks), 32)]
+    bucketed = embeddings.length_bucketed_batches(np.array(lengths), args.token_budget)
+    runs = [
+        ('fixed-32', fixed, lambda: model.encode(chunks, batch_size=32)),
+        ('bucketed', bucketed, lambda: embeddings.encode_length_bucketed(model, chunks, args.token_budget))
+    ]
+    print(f"{'batching':>10} {'batches':>8} {'pad eff':>8} {'seconds':>8} {'chunks/sec':>11}")
+    results = {}
+    for name, batches, run in runs:
+        run()   # warm-up
+        start = time.perf_counter()
+        results[name] = run()
+        elapsed = time.perf_counter() - start
+        print(f"{name:>10} {len(batches):>8} {padding_efficiency(lengths, batches):>8.2f} "
+              f"{elapsed:>8.2f} {len(chunks) / elapsed:>11.1f}")
+    agreement = (results['fixed-32'] * results['bucketed']).sum(axis=1) / (
+        np.linalg.norm(results['fixed-32'], axis=1) * np.linalg.norm(results['bucketed'], axis=1))
+    print(f"order check: min cosine between runs {agreement.min():.5f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RAG performance benchmarks")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    index_parser = subparsers.add_parser('index', help="flat vs IVF vs HNSW latency and recall@k")
+    index_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 20000, 50000])
+    index_parser.add_argument('--k', type=int, default=10)
+    index_parser.add_argument('--text', help="embed paragraphs of this file instead of synthetic vectors")
+    index_parser.set_defaults(func=bench_index)
+
+    compression_parser = subparsers.add_parser('compression', help="memory and recall@k per storage mode")
+    compression_parser.add_argument('--size', type=int, default=10000)
+    compression_parser.add_argument('--k', type=int, default=10)
+    compression_parser.add_argument('--text', help="embed paragraphs of this file instead of synthetic vectors")
+    compression_parser.set_defaults(func=bench_compression)
+
+    embeddings_parser = subparsers.add_parser('embeddings', help="backend parity (cosine) and sentences/sec")
+    embeddings_parser.add_argument('--backends', nargs='+', default=['torch', 'onnx', 'onnx-int8'],
+                                   choices=['torch', 'onnx', 'onnx-int8'])
+    embeddings_parser.add_argument('--text', default=DEFAULT_CORPUS, help="corpus file (one sentence per line)")
+    embeddings_parser.add_argument('--sentences', type=int, default=512)
+    embeddings_parser.add_argument('--batch-size', type=int, default=32)
+    embeddings_parser.add_argument('--min-cosine', type=float, default=0.99)
+    embeddings_parser.set_defaults(func=bench_embeddings)
+
+    encode_parser = subparsers.add_parser('encode', help="ingest encode throughput: fixed vs length-bucketed batches")
+    encode_parser.add_argument('--files', nargs='+', default=[DEFAULT_CORPUS], help="PDF or text documents to chunk")
+    encode_parser.add_argument('--token-budget', type=int, default=embeddings.EMBEDDING_TOKEN_BUDGET)
+    encode_parser.set_defaults(func=bench_encode)
+
+    extract_parser = subparsers.add_parser('extract', help="extraction MB/s and pages/s per extractor and PDF backend")
+    extract_parser.add_argument('--files', nargs='+', default=[DEFAULT_CORPUS], help="PDF, DOC, DOCX or text documents")
+    extract_parser.add_argument('--repeats', type=int, default=3, help="timed runs per extractor (best is reported)")
+    extract_parser.set_defaults(func=bench_extract)
+
+    chunk_parser = subparsers.add_parser('chunk', help="chunking throughput (MB/s) and chunk sizes: legacy vs token-aware")
+    chunk_parser.add_argument('--files', nargs='+', default=[DEFAULT_CORPUS], help="PDF, DOCX or text documents")
+    chunk_parser.add_argument('--repeat', type=int, default=20, help="replay each document this many times")
+    chunk_parser.add_argument('--repeats', type=int, default=3, help="timed runs per chunker (best is reported)")
+    chunk_parser.add_argument('--chunk-tokens', type=int, default=chunking.CHUNK_SIZE_TOKENS)
+    chunk_parser.add_argument('--overlap-tokens', type=int, default=chunking.CHUNK_OVERLAP_TOKENS)
+    chunk_parser.set_defaults(func=bench_chunk)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""
+Token-aware document chunking.
+
+One chunker serves every ingest path. It scans streamed text segments once, left
+to right, cutting them into sentence units at precompiled boundary patterns, and
+packs consecutive units into chunks of up to CHUNK_SIZE_TOKENS. Each chunk
+repeats the last CHUNK_OVERLAP_TOKENS worth of sentences of the chunk before it,
+so a passage straddling a boundary can be retrieved from either side.
+
+Every chunk records its [start, end) character offsets in the document text
+(the concatenation of the segments), which lets overlapping chunks be stitched
+back into the original text with join_chunks.
+
+Token counts are estimated as words plus punctuation marks, which tracks
+MiniLM's WordPiece count closely for English prose at a fraction of the cost of
+running the tokenizer; pass count_tokens to use an exact tokenizer instead.
+Text that isn't space-separated words would be badly undercounted that way:
+CJK characters are one WordPiece token each, and long runs with no spaces
+(base64, hashes, URLs) break into many short pieces. Those count one token per
+character and per LONG_RUN_CHARS_PER_TOKEN characters respectively, so their
+chunks stay within the 256 tokens MiniLM reads.
+"""
+import os
+import re
+
+CHUNK_SIZE_TOKENS = int(os.getenv('CHUNK_SIZE_TOKENS', '128'))
+CHUNK_OVERLAP_TOKENS = int(os.getenv('CHUNK_OVERLAP_TOKENS', '16'))
+CHUNK_MIN_CHARS = int(os.getenv('CHUNK_MIN_CHARS', '1'))      # raise to drop stray fragments (page numbers)
+CHARS_PER_TOKEN = 8                                          # generous bound used to cap boundary-less runs
+
+WORD_MAX_CHARS = 16                                          # longer runs are not ordinary words
+LONG_RUN_CHARS_PER_TOKEN = 3
+
+CJK_CHARS = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+# A CJK character, an ordinary word, a piece of an over-long run, or a punctuation mark
+TOKEN_RE = re.compile(
+    rf"[{CJK_CHARS}]|[^\W{CJK_CHARS}]{{1,{WORD_MAX_CHARS}}}(?![^\W{CJK_CHARS}])"
+    rf"|[^\W{CJK_CHARS}]{{1,{LONG_RUN_CHARS_PER_TOKEN}}}|[^\w\s]")
+# Sentence end (terminal punctuation, closing quotes/brackets, whitespace) or a blank line;
+# a digit followed by "." is a list number ("1. Scope"), not the end of a sentence
+BOUNDARY_RE = re.compile(r"(?<!\b\d)[.!?][\"')\]]*\s+|\n[ \t]*\n\s*")
+
+
+def estimate_tokens(text):
+    return len(TOKEN_RE.findall(text))
+
+
+def _split_oversized(text, start, limit):
+    """Cut one over-long unit at token starts into (start, end, tokens) pieces of <= limit tokens"""
+    pieces, piece_start, piece_end, count = [], 0, 0, 0
+    for match in TOKEN_RE.finditer(text):
+        if count == limit:
+            pieces.append((start + piece_start, start + piece_end, count))
+            piece_start, count = match.start(), 0
+        piece_end = match.end()
+        count += 1
+    if count:
+        pieces.append((start + piece_start, start + len(text.rstrip()), count))
+    return pieces
+
+
+def iter_chunks(segments, chunk_tokens=CHUNK_SIZE_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS,
+                min_chars=CHUNK_MIN_CHARS, count_tokens=None):
+    """Yield {'text', 'start', 'end', 'tokens'} chunks as streamed text segments arrive.
+
+    Work is linear in the input: each character is matched by the boundary
+    regex once and only the text of the current window plus an unfinished
+    sentence is buffered between segments.
+    """
+    count_tokens = count_tokens or estimate_tokens
+    overlap_tokens = min(overlap_tokens, chunk_tokens // 2)
+    max_unit_chars = chunk_tokens * CHARS_PER_TOKEN
+
+    buffer, base = "", 0     # buffered text and its offset in the document
+    scan = 0                 # document offset where the next unit begins
+    window, window_tokens = [], 0
+    fresh = False            # window holds units no emitted chunk has covered yet
+
+    def emit():
+        start, end = window[0][0], window[-1][1]
+        text = buffer[start - base:end - base]
+        if len(text) >= min_chars:
+            return {'text': text, 'start': start, 'end': end, 'tokens': window_tokens}
+        return None
+
+    def carry_overlap():
+        kept, kept_tokens = [], 0
+        for unit in reversed(window):
+            if kept_tokens + unit[2] > overlap_tokens:
+                break
+            kept.append(unit)
+            kept_tokens += unit[2]
+        kept.reverse()
+        return kept, kept_tokens
+
+    def units_between(start, end):
+        # Trim the raw span to its non-whitespace content, splitting it if it is too long
+        raw = buffer[start - base:end - base]
+        text = raw.strip()
+        if not text:
+            return []
+        start += len(raw) - len(raw.lstrip())
+        tokens = count_tokens(text)
+        if tokens > chunk_tokens:
+            return _split_oversized(text, start, chunk_tokens)
+        return [(start, start + len(text), tokens)]
+
+    def scan_units(final):
+        nonlocal scan
+        units = []
+        for match in BOUNDARY_RE.finditer(buffer, scan - base):
+            if match.end() == len(buffer) and not final:
+                break  # the whitespace run may continue in the next segment
+            units.extend(units_between(scan, base + match.end()))
+            scan = base + match.end()
+        # A run with no sentence boundary (tables, code, OCR output): cut at whitespace
+        while base + len(buffer) - scan > max_unit_chars:
+            limit = scan - base + max_unit_chars
+            cut = max(buffer.rfind(' ', scan - base, limit), buffer.rfind('\n', scan - base, limit))
+            cut = cut + 1 if cut > scan - base else limit
+            units.extend(units_between(scan, base + cut))
+            scan = base + cut
+        if final and scan < base + len(buffer):
+            units.extend(units_between(scan, base + len(buffer)))
+            scan = base + len(buffer)
+        return units
+
+    def pack(units):
+        nonlocal window, window_tokens, fresh
+        for unit in units:
+            if window and window_tokens + unit[2] > chunk_tokens:
+                if fresh:
+                    chunk = emit()
+                    if chunk:
+                        yield chunk
+                    window, window_tokens = carry_overlap()
+                    fresh = False
+                if window_tokens + unit[2] > chunk_tokens:
+                    window, window_tokens = [], 0
+            window.append(unit)
+            window_tokens += unit[2]
+            fresh = True
+
+    for segment in segments:
+        if not segment:
+            continue
+        buffer += segment
+        yield from pack(scan_units(final=False))
+        # Keep only what the window and the unfinished unit still need
+        keep_from = min(window[0][0], scan) if window else scan
+        if keep_from > base:
+            buffer = buffer[keep_from - base:]
+            base = keep_from
+    yield from pack(scan_units(final=True))
+    if window and fresh:
+        chunk = emit()
+        if chunk:
+            yield chunk
+
+
+def chunk_text(text, **options):
+    """List of chunk dicts for an in-memory document"""
+    return list(iter_chunks([text], **options))
+
+
+def join_chunks(chunks):
+    """Reassemble document text from ordered chunk dicts, dropping the overlap between neighbours"""
+    pieces, position, current_doc = [], 0, None
+    for chunk in chunks:
+        if 'start' not in chunk:
+            # Chunks indexed before offsets were recorded
+            pieces.extend([" ", chunk['text']] if pieces else [chunk['text']])
+            continue
+        if chunk.get('doc_id') != current_doc:
+            current_doc, position = chunk.get('doc_id'), 0
+        if chunk['end'] <= position:
+            continue
+        text = chunk['text'][max(position - chunk['start'], 0):]
+        if pieces and chunk['start'] > position:
+            # Whitespace between the chunks; adjacent pieces of one long run join directly
+            pieces.append(" ")
+        pieces.append(text)
+        position = chunk['end']
+    return "".join(pieces)
@@ -0,0 +1,127 @@
+"""
+Per-request latency budgets.
+
+Every /api/news request gets a Deadline of NEWS_DEADLINE_SECONDS. It is passed
+down through the pipeline. Each stage (Supabase conversation lookup, website
+fetch, document search, web search, LLM call, saving the answer) takes its
+network timeout from the remaining budget. A stage that needs more time than is
+left is skipped, and the caller falls back to an answer that needs no LLM.
+
+Stages are recorded twice: on the request's own Deadline, returned to the
+client as debug timing, and in process-wide DeadlineStats. The stats count
+runs, misses (the deadline had passed when the stage finished) and skips (not
+started for lack of budget) per stage.
+"""
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+NEWS_DEADLINE_SECONDS = float(os.getenv('NEWS_DEADLINE_SECONDS', '25'))
+LLM_MIN_SECONDS = float(os.getenv('LLM_MIN_SECONDS', '4'))            # budget needed to start an LLM call
+WEB_SEARCH_MIN_SECONDS = float(os.getenv('WEB_SEARCH_MIN_SECONDS', '1'))
+BROWSER_MIN_SECONDS = 8.0                                             # headless Chrome start-up plus page load
+SUPABASE_TIMEOUT_SECONDS = float(os.getenv('SUPABASE_TIMEOUT_SECONDS', '5'))
+
+
+class DeadlineStats:
+    """Process-wide per-stage counters"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.requests = 0
+        self.over_budget = 0
+
+    def _stage(self, name):
+        return self.stages.setdefault(name, {'runs': 0, 'misses': 0, 'skipped': 0, 'seconds': 0.0})
+
+    def record(self, name, seconds, missed):
+        with self.lock:
+            stage = self._stage(name)
+            stage['runs'] += 1
+            stage['seconds'] += seconds
+            stage['misses'] += missed
+
+    def record_skip(self, name):
+        with self.lock:
+            self._stage(name)['skipped'] += 1
+
+    def record_request(self, over_budget):
+        with self.lock:
+            self.requests += 1
+            self.over_budget += over_budget
+
+    def stats(self):
+        with self.lock:
+            return {
+                'budget_seconds': NEWS_DEADLINE_SECONDS,
+                'requests': self.requests,
+                'over_budget': self.over_budget,
+                'stages': {
+                    name: {
+                        'runs': stage['runs'],
+                        'misses': stage['misses'],
+                        'skipped': stage['skipped'],
+                        'avg_seconds': round(stage['seconds'] / stage['runs'], 3) if stage['runs'] else None
+                    }
+                    for name, stage in self.stages.items()
+                }
+            }
+
+
+class Deadline:
+    """Time budget of one request"""
+
+    def __init__(self, seconds=NEWS_DEADLINE_SECONDS, stats=None):
+        self.seconds = seconds
+        self.started = time.monotonic()
+        self.expires = self.started + seconds
+        self.stats = stats
+        self.stages = []            # [{'stage', 'seconds', 'missed'/'skipped'}] in order
+
+    def remaining(self):
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self):
+        return time.monotonic() >= self.expires
+
+    def timeout(self, cap=None):
+        """Network timeout for a call: what's left of the budget, at most cap"""
+        remaining = self.remaining()
+        return min(cap, remaining) if cap is not None else remaining
+
+    def allows(self, name, min_seconds):
+        """True if min_seconds of budget remain for the stage; otherwise records it as skipped"""
+        if self.remaining() >= min_seconds:
+            return True
+        print(f"⏱️ Skipping {name}: {self.remaining():.2f}s left of the {self.seconds:.0f}s budget")
+        self.stages.append({'stage': name, 'skipped': True})
+        if self.stats:
+            self.stats.record_skip(name)
+        return False
+
+    def record(self, name, started):
+        """Record a stage that began at time.monotonic() == started and just ended"""
+        elapsed = time.monotonic() - started
+        missed = self.expired()
+        if missed:
+            print(f"⏱️ Deadline missed in {name} ({elapsed:.2f}s)")
+        self.stages.append({'stage': name, 'seconds': round(elapsed, 3), 'missed': missed})
+        if self.stats:
+            self.stats.record(name, elapsed, missed)
+
+    @contextmanager
+    def stage(self, name):
+        started = time.monotonic()
+        try:
+            yield self
+        finally:
+            self.record(name, started)
+
+    def finish(self):
+        """Close the request's accounting; returns its timing summary"""
+        elapsed = time.monotonic() - self.started
+        if self.stats:
+            self.stats.record_request(elapsed > self.seconds)
+        return {'budget_seconds': self.seconds, 'elapsed_seconds': round(elapsed, 3), 'stages': self.stages}
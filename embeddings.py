@@ -0,0 +1,528 @@
+"""
+Embedding helpers shared by document ingest and search.
+
+EmbeddingCache is a content-addressed cache of chunk embeddings keyed by
+hash(model name, chunk text). It lives on disk as fixed-size memory-mapped
+arrays (vectors, key digests and LRU access ticks), so the same handout uploaded
+to many conversations is only ever run through the model once.
+
+QueryBatcher coalesces concurrent single-query encode calls into one batched
+forward pass on a background thread.
+
+The model itself sits behind a backend chosen by EMBEDDING_BACKEND: 'torch'
+(SentenceTransformer) or 'onnx' / 'onnx-int8' (the same transformer exported to
+ONNX and run with ONNX Runtime, optionally with dynamic int8 quantization).
+Every backend exposes SentenceTransformer's encode() and
+get_sentence_embedding_dimension(), so callers don't care which one is loaded.
+
+Document chunks are encoded length-bucketed: sorted by token count and split
+into batches whose padded size fits EMBEDDING_TOKEN_BUDGET, so short chunks are
+not padded out to the longest chunk of a fixed-size batch.
+"""
+import os
+import json
+import hashlib
+import tempfile
+import time
+import queue
+import threading
+from concurrent.futures import Future
+import numpy as np
+
+EMBEDDING_BACKEND = os.getenv('EMBEDDING_BACKEND', 'torch').lower()   # torch | onnx | onnx-int8
+EMBEDDING_ONNX_DIR = os.getenv('EMBEDDING_ONNX_DIR', os.path.join(tempfile.gettempdir(), "onnx_models"))
+
+EMBEDDING_TOKEN_BUDGET = int(os.getenv('EMBEDDING_TOKEN_BUDGET', '2048'))  # padded tokens per forward pass
+EMBEDDING_MAX_BATCH_SIZE = int(os.getenv('EMBEDDING_MAX_BATCH_SIZE', '256'))
+
+EMBEDDING_CACHE_ENABLED = os.getenv('EMBEDDING_CACHE', 'true').lower() in ('1', 'true', 'yes')
+EMBEDDING_CACHE_DIR = os.getenv('EMBEDDING_CACHE_DIR', os.path.join(tempfile.gettempdir(), "embedding_cache"))
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv('EMBEDDING_CACHE_MAX_ENTRIES', '100000'))
+
+EMBEDDING_BATCH_WAIT_MS = float(os.getenv('EMBEDDING_BATCH_WAIT_MS', '5'))
+EMBEDDING_BATCH_MAX_SIZE = int(os.getenv('EMBEDDING_BATCH_MAX_SIZE', '32'))
+
+KEY_BYTES = 16
+HISTOGRAM_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+class TorchEmbeddingBackend:
+    """SentenceTransformer on PyTorch: the reference implementation"""
+
+    name = 'torch'
+
+    def __init__(self, model_name):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name, device='cpu')
+        # Kept equal to the bare model name so existing embedding caches stay valid
+        self.model_id = model_name
+
+    def encode(self, texts, batch_size=32, show_progress_bar=False, **kwargs):
+        return np.asarray(self.model.encode(texts, batch_size=batch_size, show_progress_bar=show_progress_bar,
+                                            **kwargs), dtype=np.float32)
+
+    def get_sentence_embedding_dimension(self):
+        return self.model.get_sentence_embedding_dimension()
+
+    def token_lengths(self, texts):
+        encoded = self.model.tokenizer(list(texts), truncation=True, max_length=self.model.max_seq_length)
+        return [len(ids) for ids in encoded['input_ids']]
+
+
+def export_onnx_model(model_name, model_dir):
+    """One-off export of a SentenceTransformer's transformer and tokenizer to model_dir (needs torch)"""
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    print(f"📦 Exporting {model_name} to ONNX in {model_dir}...")
+    os.makedirs(model_dir, exist_ok=True)
+    st_model = SentenceTransformer(model_name, device='cpu')
+    transformer = st_model[0].auto_model.eval()
+    tokenizer = st_model.tokenizer
+    tokenizer.save_pretrained(model_dir)
+
+    class LastHiddenState(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, *inputs):
+            return self.model(*inputs)[0]
+
+    sample = tokenizer(["onnx export sample"], return_tensors='pt')
+    input_names = [name for name in ('input_ids', 'attention_mask', 'token_type_ids') if name in sample]
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names + ['last_hidden_state']}
+    tmp_path = os.path.join(model_dir, f"model.onnx.{os.getpid()}.tmp")
+    with torch.no_grad():
+        torch.onnx.export(LastHiddenState(transformer), tuple(sample[name] for name in input_names), tmp_path,
+                          input_names=input_names, output_names=['last_hidden_state'],
+                          dynamic_axes=dynamic_axes, opset_version=14)
+    os.replace(tmp_path, os.path.join(model_dir, "model.onnx"))
+
+    # Pooling/normalisation happen outside the graph; record what the original pipeline does
+    with open(os.path.join(model_dir, "export.json"), 'w', encoding='utf-8') as f:
+        json.dump({
+            'model_name': model_name,
+            'max_seq_length': st_model.max_seq_length,
+            'normalize': any(type(module).__name__ == 'Normalize' for module in st_model)
+        }, f)
+
+
+def ensure_onnx_model(model_name, model_dir, quantize=False):
+    """Path of the (optionally int8-quantized) ONNX model, exporting/quantizing on first use"""
+    fp32_path = os.path.join(model_dir, "model.onnx")
+    if not os.path.exists(fp32_path):
+        export_onnx_model(model_name, model_dir)
+    if not quantize:
+        return fp32_path
+
+    int8_path = os.path.join(model_dir, "model.int8.onnx")
+    if not os.path.exists(int8_path):
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        print(f"📦 Quantizing {fp32_path} to int8...")
+        tmp_path = f"{int8_path}.{os.getpid()}.tmp"
+        quantize_dynamic(fp32_path, tmp_path, weight_type=QuantType.QInt8)
+        os.replace(tmp_path, int8_path)
+    return int8_path
+
+
+class OnnxEmbeddingBackend:
+    """The exported transformer on ONNX Runtime with mean pooling, optionally int8-quantized"""
+
+    def __init__(self, model_name, quantize=False, model_dir=None):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        self.name = 'onnx-int8' if quantize else 'onnx'
+        self.model_id = f"{model_name}@{self.name}"
+        model_dir = model_dir or os.path.join(EMBEDDING_ONNX_DIR, model_name.replace('/', '_'))
+        model_path = ensure_onnx_model(model_name, model_dir, quantize)
+        with open(os.path.join(model_dir, "export.json"), 'r', encoding='utf-8') as f:
+            export = json.load(f)
+        self.normalize = export.get('normalize', True)
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=export.get('max_seq_length', 256))
+        self.tokenizer.enable_padding()
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = int(os.getenv('OMP_NUM_THREADS', '0') or 0)
+        self.session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.dimension = self.encode(["dimension probe"]).shape[1]
+        print(f"✅ ONNX Runtime embedding backend ready ({os.path.basename(model_path)})")
+
+    def encode(self, texts, batch_size=32, show_progress_bar=False, **kwargs):
+        if isinstance(texts, str):
+            texts = [texts]
+        batches = []
+        for start in range(0, len(texts), batch_size):
+            encodings = self.tokenizer.encode_batch(list(texts[start:start + batch_size]))
+            feeds = {
+                'input_ids': np.array([e.ids for e in encodings], dtype=np.int64),
+                'attention_mask': np.array([e.attention_mask for e in encodings], dtype=np.int64)
+            }
+            if 'token_type_ids' in self.input_names:
+                feeds['token_type_ids'] = np.array([e.type_ids for e in encodings], dtype=np.int64)
+            hidden = self.session.run(None, feeds)[0]
+
+            # Mean pooling over real tokens, matching sentence-transformers' Pooling module
+            mask = feeds['attention_mask'][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            if self.normalize:
+                pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            batches.append(pooled.astype(np.float32))
+        if not batches:
+            return np.zeros((0, getattr(self, 'dimension', 0)), dtype=np.float32)
+        return np.vstack(batches)
+
+    def get_sentence_embedding_dimension(self):
+        return self.dimension
+
+    def token_lengths(self, texts):
+        # Padding is enabled on the tokenizer, so count real tokens via the attention mask
+        return [sum(e.attention_mask) for e in self.tokenizer.encode_batch(list(texts))]
+
+
+def token_lengths(model, texts):
+    """Token count per text from the backend's tokenizer (rough chars/4 estimate otherwise)"""
+    counter = getattr(model, 'token_lengths', None)
+    if counter is not None:
+        return np.asarray(counter(texts), dtype=np.int64)
+    return np.array([len(text) // 4 + 2 for text in texts], dtype=np.int64)
+
+
+def length_bucketed_batches(lengths, token_budget=EMBEDDING_TOKEN_BUDGET, max_batch_size=EMBEDDING_MAX_BATCH_SIZE):
+    """Group positions, shortest first, into batches whose padded size (count × longest) fits the budget"""
+    batches, current = [], []
+    for position in np.argsort(lengths, kind='stable').tolist():
+        # Ascending order: the position being added is the longest in its batch
+        padded = (len(current) + 1) * max(int(lengths[position]), 1)
+        if current and (padded > token_budget or len(current) >= max_batch_size):
+            batches.append(current)
+            current = []
+        current.append(position)
+    if current:
+        batches.append(current)
+    return batches
+
+
+def encode_length_bucketed(model, texts, token_budget=EMBEDDING_TOKEN_BUDGET,
+                           max_batch_size=EMBEDDING_MAX_BATCH_SIZE, on_encoded=None, **encode_kwargs):
+    """Encode texts in length-sorted, token-budgeted batches and return rows in the original order.
+
+    on_encoded(count) is called after each batch with the number of texts it encoded.
+    """
+    encode_kwargs.pop('batch_size', None)
+    if len(texts) <= 1:
+        vectors = np.asarray(model.encode(list(texts), **encode_kwargs), dtype=np.float32)
+        if on_encoded:
+            on_encoded(len(texts))
+        return vectors
+
+    vectors = None
+    for batch in length_bucketed_batches(token_lengths(model, texts), token_budget, max_batch_size):
+        encoded = np.asarray(model.encode([texts[i] for i in batch], batch_size=len(batch), **encode_kwargs),
+                             dtype=np.float32)
+        if vectors is None:
+            vectors = np.zeros((len(texts), encoded.shape[1]), dtype=np.float32)
+        vectors[batch] = encoded
+        if on_encoded:
+            on_encoded(len(batch))
+    return vectors
+
+
+def load_embedding_backend(model_name, backend=EMBEDDING_BACKEND):
+    """Instantiate the configured backend, falling back to PyTorch if ONNX Runtime can't be used"""
+    if backend in ('onnx', 'onnx-int8'):
+        try:
+            return OnnxEmbeddingBackend(model_name, quantize=(backend == 'onnx-int8'))
+        except Exception as e:
+            print(f"❌ ONNX embedding backend unavailable ({e}), falling back to PyTorch")
+    elif backend != 'torch':
+        print(f"⚠️ Unknown EMBEDDING_BACKEND '{backend}', using PyTorch")
+    return TorchEmbeddingBackend(model_name)
+
+
+def embedding_parity(reference, candidate, texts, batch_size=32):
+    """Row-wise cosine agreement between two backends' embeddings of the same texts"""
+    a = reference.encode(texts, batch_size=batch_size)
+    b = candidate.encode(texts, batch_size=batch_size)
+    a = a / np.clip(np.linalg.norm(a, axis=1, keepdims=True), 1e-12, None)
+    b = b / np.clip(np.linalg.norm(b, axis=1, keepdims=True), 1e-12, None)
+    cosines = (a * b).sum(axis=1)
+    return {'min': float(cosines.min()), 'mean': float(cosines.mean()), 'texts': len(texts)}
+
+
+def chunk_key(model_name, text):
+    """Content address of a chunk embedding: 16-byte blake2b of (model name, text)"""
+    return hashlib.blake2b(f"{model_name}\0{text}".encode('utf-8'), digest_size=KEY_BYTES).digest()
+
+
+class EmbeddingCache:
+    """Disk-backed LRU cache of embeddings in memory-mapped arrays"""
+
+    def __init__(self, directory, model_name, dimension, capacity=EMBEDDING_CACHE_MAX_ENTRIES):
+        self.model_name = model_name
+        self.dimension = dimension
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(directory, exist_ok=True)
+        meta_path = os.path.join(directory, "meta.json")
+        meta = {'model_name': model_name, 'dimension': dimension, 'capacity': capacity}
+        existing = None
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                existing = json.load(f)
+        # A different model or shape invalidates every stored vector
+        mode = 'r+' if existing == meta else 'w+'
+        if mode == 'w+':
+            with open(meta_path, 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+
+        self.vectors = np.memmap(os.path.join(directory, "vectors.f32"), dtype=np.float32,
+                                 mode=mode, shape=(capacity, dimension))
+        self.keys = np.memmap(os.path.join(directory, "keys.bin"), dtype=np.uint8,
+                              mode=mode, shape=(capacity, KEY_BYTES))
+        # Last-access tick per slot; 0 marks an empty slot
+        self.ticks = np.memmap(os.path.join(directory, "ticks.i64"), dtype=np.int64,
+                               mode=mode, shape=(capacity,))
+
+        used = np.flatnonzero(self.ticks)
+        self.slots = {self.keys[slot].tobytes(): int(slot) for slot in used}
+        self.free_slots = np.flatnonzero(self.ticks == 0).tolist()[::-1]
+        self.clock = int(self.ticks.max()) if len(used) else 0
+        print(f"🗄️ Embedding cache ready: {len(self.slots)}/{capacity} entries in {directory}")
+
+    def __len__(self):
+        return len(self.slots)
+
+    def lookup(self, keys):
+        """Return (vectors, missing positions); rows for missing keys are left as zeros"""
+        vectors = np.zeros((len(keys), self.dimension), dtype=np.float32)
+        missing = []
+        with self.lock:
+            for position, key in enumerate(keys):
+                slot = self.slots.get(key)
+                if slot is None:
+                    missing.append(position)
+                    continue
+                vectors[position] = self.vectors[slot]
+                self.clock += 1
+                self.ticks[slot] = self.clock
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+        return vectors, missing
+
+    def _evict(self, count):
+        # Free the least recently used slots in one pass over the tick array
+        used = np.flatnonzero(self.ticks)
+        if not len(used):
+            return
+        count = min(count, len(used))
+        oldest = used[np.argpartition(self.ticks[used], count - 1)[:count]]
+        for slot in oldest.tolist():
+            self.slots.pop(self.keys[slot].tobytes(), None)
+            self.ticks[slot] = 0
+            self.free_slots.append(slot)
+        self.evictions += count
+
+    def store(self, keys, vectors):
+        """Insert new embeddings, evicting least recently used entries when full"""
+        with self.lock:
+            # One slot per key: keys already held and repeats within the batch are skipped
+            new = {}
+            for key, vector in zip(keys, vectors):
+                if key not in self.slots:
+                    new.setdefault(key, vector)
+            new = list(new.items())[-self.capacity:]
+            if len(new) > len(self.free_slots):
+                self._evict(len(new) - len(self.free_slots))
+            for key, vector in new:
+                slot = self.free_slots.pop()
+                self.vectors[slot] = vector
+                self.keys[slot] = np.frombuffer(key, dtype=np.uint8)
+                self.clock += 1
+                self.ticks[slot] = self.clock
+                self.slots[key] = slot
+
+    def flush(self):
+        with self.lock:
+            self.vectors.flush()
+            self.keys.flush()
+            self.ticks.flush()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.slots),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            'evictions': self.evictions
+        }
+
+
+def open_embedding_cache(model_name, dimension):
+    """Open the shared on-disk cache for a model, or None when caching is disabled/unavailable"""
+    if not EMBEDDING_CACHE_ENABLED:
+        return None
+    directory = os.path.join(EMBEDDING_CACHE_DIR, model_name.replace('/', '_'))
+    try:
+        os.makedirs(directory, exist_ok=True)
+        # Slots are assigned in-process, so only one process may write a cache directory
+        lock_file = open(os.path.join(directory, "cache.lock"), 'w')
+        try:
+            import fcntl
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except ImportError:
+            pass
+        except OSError:
+            lock_file.close()
+            directory = os.path.join(directory, f"worker-{os.getpid()}")
+            print(f"⚠️ Embedding cache in use by another process, using {directory}")
+            return open_embedding_cache_at(directory, model_name, dimension)
+        cache = open_embedding_cache_at(directory, model_name, dimension)
+        if cache is not None:
+            cache.lock_file = lock_file
+        return cache
+    except Exception as e:
+        print(f"❌ Failed to open embedding cache: {e}")
+        return None
+
+
+def open_embedding_cache_at(directory, model_name, dimension):
+    try:
+        return EmbeddingCache(directory, model_name, dimension)
+    except Exception as e:
+        print(f"❌ Failed to open embedding cache at {directory}: {e}")
+        return None
+
+
+def encode_with_cache(model, texts, cache=None, model_name='', on_encoded=None, **encode_kwargs):
+    """Encode texts, skipping the model forward pass for every chunk already in the cache"""
+    if cache is None or not texts:
+        return encode_length_bucketed(model, texts, on_encoded=on_encoded, **encode_kwargs)
+
+    keys = [chunk_key(model_name or cache.model_name, text) for text in texts]
+    vectors, missing = cache.lookup(keys)
+    if on_encoded and len(texts) > len(missing):
+        on_encoded(len(texts) - len(missing))
+    if missing:
+        # Repeated chunks (page headers, boilerplate) are encoded once and scattered back
+        unique = {}
+        for i in missing:
+            unique.setdefault(keys[i], []).append(i)
+        if on_encoded and len(missing) > len(unique):
+            on_encoded(len(missing) - len(unique))
+        fresh = encode_length_bucketed(model, [texts[positions[0]] for positions in unique.values()],
+                                       on_encoded=on_encoded, **encode_kwargs)
+        for row, positions in enumerate(unique.values()):
+            vectors[positions] = fresh[row]
+        cache.store(list(unique), fresh)
+        cache.flush()
+    print(f"🗄️ Embedding cache: {len(texts) - len(missing)}/{len(texts)} chunks served from cache")
+    return vectors
+
+
+class Histogram:
+    """Counts observations into fixed upper-bound buckets (last bucket is open-ended)"""
+
+    def __init__(self, buckets=HISTOGRAM_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0
+        self.observations = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += value
+        self.observations += 1
+
+    def to_dict(self):
+        labels = [f"<={bound}" for bound in self.buckets] + [f">{self.buckets[-1]}"]
+        return {
+            'buckets': dict(zip(labels, self.counts)),
+            'count': self.observations,
+            'mean': round(self.total / self.observations, 2) if self.observations else 0.0
+        }
+
+
+class QueryBatcher:
+    """Background worker that batches concurrent query embeddings into one encode call"""
+
+    def __init__(self, model, wait_ms=EMBEDDING_BATCH_WAIT_MS, max_batch_size=EMBEDDING_BATCH_MAX_SIZE):
+        self.model = model
+        self.wait_seconds = wait_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self.pending = queue.Queue()
+        self.stats_lock = threading.Lock()
+        self.queue_depth = Histogram()
+        self.batch_sizes = Histogram()
+        self.batches = 0
+        self.worker = threading.Thread(target=self._run, name="query-embedding-batcher", daemon=True)
+        self.worker.start()
+
+    def submit(self, text):
+        """Queue a query and return a Future resolving to its embedding row"""
+        future = Future()
+        self.pending.put((text, future))
+        with self.stats_lock:
+            self.queue_depth.observe(self.pending.qsize())
+        return future
+
+    def encode(self, text, timeout=None):
+        """Embed one query, shaped (1, dimension) like model.encode([text])"""
+        return self.submit(text).result(timeout).reshape(1, -1)
+
+    def _collect(self):
+        # Block for the first query, then keep the window open until it closes or the batch fills
+        batch = [self.pending.get()]
+        deadline = time.monotonic() + self.wait_seconds
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.pending.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            texts = [text for text, _ in batch]
+            try:
+                vectors = np.asarray(self.model.encode(texts, show_progress_bar=False), dtype=np.float32)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            with self.stats_lock:
+                self.batch_sizes.observe(len(batch))
+                self.batches += 1
+            for (_, future), vector in zip(batch, vectors):
+                future.set_result(vector)
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                'wait_ms': self.wait_seconds * 1000.0,
+                'max_batch_size': self.max_batch_size,
+                'current_queue_depth': self.pending.qsize(),
+                'batches': self.batches,
+                'queue_depth': self.queue_depth.to_dict(),
+                'batch_size': self.batch_sizes.to_dict()
+            }
@@ -0,0 +1,421 @@
+"""
+Streaming text extraction for uploaded documents.
+
+Extractors read straight from the spooled upload (a BytesIO, or a named
+temporary file for large uploads, see ingest.spool_upload) and yield text a page
+or paragraph at a time, so an upload is never copied again or assembled into
+one large string. Segments are contiguous pieces of the document text: joining
+them gives the full text.
+
+Extractors are registered by name with the extensions and MIME types they
+handle (register_extractor). The format is decided by sniffing the first bytes
+of the upload (PDF, OLE2 for Word 97-2003 .doc, a ZIP holding a Word document
+for .docx), then by extension, then by MIME type, so a .doc that is really a
+.docx, or a PDF uploaded without an extension, still reaches the right parser.
+PDF text comes from PyPDF2 or pypdfium2 (PDF_BACKEND).
+
+Large PDFs are extracted in parallel: the page range is split across one
+long-lived pool of worker processes shared by all uploads (pdf_worker_pool,
+started with the server), each opening the spooled file by path, and pages are
+yielded back in order as their ranges complete. Each document gets a wall-clock
+timeout, and every worker an address-space cap, so a malformed PDF can't wedge
+or exhaust the server.
+"""
+import io
+import os
+import re
+import time
+import tempfile
+import struct
+import zipfile
+import threading
+import multiprocessing
+import concurrent.futures
+
+TEXT_READ_CHARS = 64 * 1024
+
+PDF_EXTRACT_WORKERS = int(os.getenv('PDF_EXTRACT_WORKERS', str(os.cpu_count() or 1)))
+PDF_PARALLEL_MIN_PAGES = int(os.getenv('PDF_PARALLEL_MIN_PAGES', '24'))   # 0 = isolate every PDF
+PDF_EXTRACT_TIMEOUT = float(os.getenv('PDF_EXTRACT_TIMEOUT', '120'))        # seconds per document
+PDF_EXTRACT_MEMORY_MB = int(os.getenv('PDF_EXTRACT_MEMORY_MB', '1024'))    # extra address space per worker
+PAGES_PER_TASK = 8
+PDF_BACKEND = os.getenv('PDF_BACKEND', 'pypdf2').lower()                  # 'pypdf2' or 'pypdfium2'
+PDF_BACKENDS = ('pypdf2', 'pypdfium2')
+
+OLE_MAGIC = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+SNIFF_BYTES = 8
+
+EXTRACTORS = {}             # {name: callable(stream) -> iterator of text segments}
+EXTENSION_EXTRACTORS = {}   # {'.pdf': 'pdf', ...}
+MIME_EXTRACTORS = {}        # {'application/pdf': 'pdf', ...}
+
+# pdfium is not thread-safe: one call at a time per process
+_PDFIUM_LOCK = threading.Lock()
+
+
+class ExtractionError(Exception):
+    """A document could not be extracted within its time or memory limits"""
+
+
+def register_extractor(name, extensions=(), mime_types=()):
+    """Decorator adding a segment generator to the registry under name"""
+    def register(function):
+        EXTRACTORS[name] = function
+        for extension in extensions:
+            EXTENSION_EXTRACTORS[extension] = name
+        for mime_type in mime_types:
+            MIME_EXTRACTORS[mime_type] = name
+        return function
+    return register
+
+
+def sniff_format(stream):
+    """Extractor name implied by the file's leading bytes, or None; the stream position is restored"""
+    position = stream.tell()
+    head = stream.read(SNIFF_BYTES)
+    stream.seek(position)
+    if head.startswith(b'%PDF-'):
+        return 'pdf'
+    if head.startswith(OLE_MAGIC):
+        return 'doc'
+    if head.startswith(b'PK\x03\x04'):
+        try:
+            is_word = 'word/document.xml' in zipfile.ZipFile(stream).namelist()
+        except zipfile.BadZipFile:
+            is_word = False
+        stream.seek(position)
+        return 'docx' if is_word else None
+    return None
+
+
+def resolve_extractor(stream, filename, mime_type=None):
+    """Name of the extractor for an upload: sniffed content, then extension, then MIME type"""
+    name = sniff_format(stream)
+    if name:
+        return name
+    extension = os.path.splitext(filename.lower())[1]
+    if extension in EXTENSION_EXTRACTORS:
+        return EXTENSION_EXTRACTORS[extension]
+    mime_type = (mime_type or '').split(';')[0].strip().lower()
+    return MIME_EXTRACTORS.get(mime_type, 'text')
+
+
+def upload_path(stream):
+    """Path of an upload spooled to a named file on disk, or None while it is held in memory"""
+    name = getattr(stream, 'name', None)
+    return name if isinstance(name, str) and os.path.isfile(name) else None
+
+
+def _pdf_page_count(source):
+    # pdfium only; PyPDF2 counts pages with the reader that goes on to extract them
+    import pypdfium2
+    with _PDFIUM_LOCK:
+        document = pypdfium2.PdfDocument(source)
+        try:
+            return len(document)
+        finally:
+            document.close()
+
+
+def _pdf_page_texts(source, backend, start=0, end=None):
+    """Text of pages [start, end) of a PDF given as a path, stream, bytes or (PyPDF2) an open reader"""
+    if backend == 'pypdfium2':
+        import pypdfium2
+        with _PDFIUM_LOCK:
+            document = pypdfium2.PdfDocument(source)
+        try:
+            for number in range(start, len(document) if end is None else end):
+                with _PDFIUM_LOCK:
+                    page = document[number]
+                    textpage = page.get_textpage()
+                    text = textpage.get_text_range()
+                    textpage.close()
+                    page.close()
+                yield text.replace('\r\n', '\n').replace('\r', '\n')
+        finally:
+            with _PDFIUM_LOCK:
+                document.close()
+        return
+    import PyPDF2
+    reader = source
+    if not isinstance(reader, PyPDF2.PdfReader):
+        reader = PyPDF2.PdfReader(io.BytesIO(source) if isinstance(source, bytes) else source)
+    for number in range(start, len(reader.pages) if end is None else end):
+        yield reader.pages[number].extract_text() or ""
+
+
+def iter_pdf_text(stream, backend=None):
+    """One segment per PDF page"""
+    backend = backend or PDF_BACKEND
+    # pdfium opens a spooled file by path, an in-memory one as bytes; PyPDF2 reads the stream lazily
+    source = (upload_path(stream) or stream.read()) if backend == 'pypdfium2' else stream
+    for text in _pdf_page_texts(source, backend):
+        yield text + "\n"
+
+
+def _init_worker(memory_mb):
+    # Cap the worker's address space at its start-up size plus memory_mb
+    try:
+        import resource
+        with open('/proc/self/status', 'r') as f:
+            vm_size_kb = next(int(line.split()[1]) for line in f if line.startswith('VmSize:'))
+        limit = vm_size_kb * 1024 + memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (ImportError, OSError, StopIteration, ValueError):
+        pass
+
+
+def _extract_page_range(path, start, end, backend):
+    if backend == 'pypdfium2':
+        return [text + "\n" for text in _pdf_page_texts(path, backend, start, end)]
+    with open(path, 'rb') as f:
+        return [text + "\n" for text in _pdf_page_texts(f, backend, start, end)]
+
+
+def _terminate(executor):
+    # ProcessPoolExecutor can't cancel a running task; kill the workers outright
+    processes = list((getattr(executor, '_processes', None) or {}).values())
+    for process in processes:
+        process.terminate()
+    executor.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.join(timeout=1)
+
+
+class PdfWorkerPool:
+    """The long-lived worker processes shared by every PDF extraction in this process.
+
+    Workers come from a forkserver (spawn where that is unavailable), never from
+    forking the multithreaded server, and their number is a global cap: concurrent
+    uploads queue for the same PDF_EXTRACT_WORKERS processes. A document that
+    times out restarts the pool, since its running tasks can't be cancelled.
+    """
+
+    def __init__(self, workers=PDF_EXTRACT_WORKERS, memory_mb=PDF_EXTRACT_MEMORY_MB):
+        self.workers = workers
+        self.memory_mb = memory_mb
+        self.start_method = next(method for method in ('forkserver', 'spawn')
+                                 if method in multiprocessing.get_all_start_methods())
+        self.executor = None
+        self.generation = 0         # bumped on every restart
+        self.restarts = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Create the executor and its forkserver; call once at server start-up"""
+        with self.lock:
+            if self.executor is None:
+                context = multiprocessing.get_context(self.start_method)
+                if self.start_method == 'forkserver':
+                    # Workers only need this module, not the web app
+                    context.set_forkserver_preload(['extractors'])
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=context,
+                    initializer=_init_worker, initargs=(self.memory_mb,))
+                print(f"📄 PDF worker pool ready ({self.workers} {self.start_method} workers)")
+            return self.executor, self.generation
+
+    def submit(self, *args):
+        """(future, generation) of a task on the current executor"""
+        executor, generation = self.start()
+        return executor.submit(*args), generation
+
+    def restart(self, generation):
+        """Kill the workers of generation (if still current); a fresh executor starts on next use"""
+        with self.lock:
+            if generation != self.generation or self.executor is None:
+                return
+            executor, self.executor = self.executor, None
+            self.generation += 1
+            self.restarts += 1
+        print("🔁 Restarting PDF worker pool")
+        _terminate(executor)
+
+    def stats(self):
+        with self.lock:
+            return {'workers': self.workers, 'start_method': self.start_method,
+                    'running': self.executor is not None, 'restarts': self.restarts}
+
+
+pdf_worker_pool = PdfWorkerPool()
+
+
+def iter_pdf_text_parallel(source, page_count, backend=None, pool=None,
+                           timeout=PDF_EXTRACT_TIMEOUT):
+    """Page segments of a PDF extracted by the shared worker pool, yielded in page order.
+
+    source is the path of the PDF, which every worker opens itself, or its bytes.
+    """
+    pool = pool or pdf_worker_pool
+    backend = backend or PDF_BACKEND
+    deadline = time.monotonic() + timeout
+    path, temporary = source, False
+    futures = []
+    try:
+        if isinstance(source, bytes):
+            # An in-memory upload: give the workers a file instead of its bytes with every task
+            fd, path = tempfile.mkstemp(suffix='.pdf')
+            temporary = True
+            with os.fdopen(fd, 'wb') as f:
+                f.write(source)
+        ranges = [(start, min(start + PAGES_PER_TASK, page_count)) for start in range(0, page_count, PAGES_PER_TASK)]
+        futures = [pool.submit(_extract_page_range, path, start, end, backend) for start, end in ranges]
+        retried = False
+        for position in range(len(ranges)):
+            while True:
+                future, generation = futures[position]
+                try:
+                    pages = future.result(timeout=max(deadline - time.monotonic(), 0))
+                    break
+                except concurrent.futures.TimeoutError:
+                    pool.restart(generation)
+                    raise ExtractionError(f"PDF extraction exceeded {timeout:g}s")
+                except MemoryError:
+                    raise ExtractionError(f"PDF extraction exceeded the {pool.memory_mb} MB memory cap")
+                except (concurrent.futures.CancelledError, concurrent.futures.process.BrokenProcessPool):
+                    if generation == pool.generation or retried:
+                        # A worker died (killed at its memory cap): replace the broken executor
+                        pool.restart(generation)
+                        raise ExtractionError(f"PDF extraction exceeded the {pool.memory_mb} MB memory cap")
+                    # Another document's timeout restarted the pool under us: resubmit the unfinished ranges once
+                    retried = True
+                    futures[position:] = [pool.submit(_extract_page_range, path, start, end, backend)
+                                          for start, end in ranges[position:]]
+            yield from pages
+    finally:
+        for future, _ in futures:
+            future.cancel()
+        if temporary:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+@register_extractor('pdf', extensions=('.pdf',), mime_types=('application/pdf',))
+def iter_pdf_document(stream, backend=None):
+    """PDF page segments: parallel for large documents, in-process streaming otherwise.
+
+    A disk-spooled upload is read in place (workers open its path); only uploads
+    small enough to be held in memory are handed over as bytes.
+    """
+    backend = backend or PDF_BACKEND
+    path = upload_path(stream)
+    if backend == 'pypdfium2':
+        source = path or stream.read()
+        page_count = _pdf_page_count(source)
+    else:
+        import PyPDF2
+        # Parsed once: the reader that counts the pages also extracts them in-process
+        source = PyPDF2.PdfReader(stream)
+        page_count = len(source.pages)
+    if page_count < PDF_PARALLEL_MIN_PAGES:
+        return (text + "\n" for text in _pdf_page_texts(source, backend))
+    print(f"📄 Extracting {page_count} PDF pages on the shared {PDF_EXTRACT_WORKERS}-process pool ({backend})")
+    if path is None and not isinstance(source, bytes):
+        stream.seek(0)
+        source = stream.read()
+    return iter_pdf_text_parallel(path or source, page_count, backend)
+
+
+@register_extractor('docx', extensions=('.docx',), mime_types=(
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',))
+def iter_docx_text(stream):
+    """One segment per DOCX paragraph or table row, in document order"""
+    from docx import Document
+    from docx.table import Table
+    from docx.text.paragraph import Paragraph
+    document = Document(stream)
+    for element in document.element.body.iterchildren():
+        tag = element.tag.rsplit('}', 1)[-1]
+        if tag == 'p':
+            yield Paragraph(element, document).text + "\n"
+        elif tag == 'tbl':
+            for row in Table(element, document).rows:
+                yield "\t".join(cell.text for cell in row.cells) + "\n"
+
+
+# Word control characters: paragraph/cell/line/page marks become whitespace, the rest is dropped
+WORD_CONTROL = {0x0D: '\n', 0x07: '\t', 0x0B: '\n', 0x0C: '\n', 0x1E: '-', 0x1F: None}
+WORD_CONTROL.update({code: None for code in range(0x20) if code not in WORD_CONTROL and code not in (0x09, 0x0A)})
+# Field codes are stored as \x13 instruction \x14 result \x15; only the result is text
+WORD_FIELD_RE = re.compile(r'\x13[^\x13\x14\x15]*(?:\x14|(?=\x15))')
+
+
+@register_extractor('doc', extensions=('.doc',), mime_types=('application/msword',))
+def iter_doc_text(stream):
+    """Word 97-2003 (.doc) text, one segment per piece of the document's piece table"""
+    import olefile
+    ole = olefile.OleFileIO(stream)
+    try:
+        word = ole.openstream('WordDocument').read()
+        n_fib, flags = struct.unpack_from('<H', word, 0x02)[0], struct.unpack_from('<H', word, 0x0A)[0]
+        if n_fib < 0xC1:
+            raise ExtractionError("Word 6/95 documents are not supported; save the file as .docx")
+        if flags & 0x0100:
+            raise ExtractionError("Encrypted Word documents are not supported")
+        table = ole.openstream('1Table' if flags & 0x0200 else '0Table').read()
+        fc_clx, lcb_clx = struct.unpack_from('<II', word, 0x01A2)
+        clx = table[fc_clx:fc_clx + lcb_clx]
+
+        position = 0
+        while position < len(clx) and clx[position] == 0x01:
+            # Formatting (Prc) entries precede the piece table
+            position += 3 + struct.unpack_from('<h', clx, position + 1)[0]
+        if position >= len(clx) or clx[position] != 0x02:
+            raise ExtractionError("Unrecognised Word piece table")
+        size = struct.unpack_from('<I', clx, position + 1)[0]
+        plc = clx[position + 5:position + 5 + size]
+        pieces = (size - 4) // 12
+        cps = struct.unpack_from(f'<{pieces + 1}I', plc)
+        for i in range(pieces):
+            fc = struct.unpack_from('<I', plc, 4 * (pieces + 1) + 8 * i + 2)[0]
+            characters = cps[i + 1] - cps[i]
+            if fc & 0x40000000:
+                start = (fc & ~0x40000000) // 2      # compressed piece: one cp1252 byte per character
+                text = word[start:start + characters].decode('cp1252', errors='replace')
+            else:
+                text = word[fc:fc + 2 * characters].decode('utf-16-le', errors='replace')
+            yield WORD_FIELD_RE.sub('', text).translate(WORD_CONTROL)
+    finally:
+        ole.close()
+
+
+@register_extractor('text', extensions=('.txt', '.md'), mime_types=('text/plain', 'text/markdown'))
+def iter_plain_text(stream):
+    """Fixed-size blocks of UTF-8 text (undecodable bytes are dropped)"""
+    reader = io.TextIOWrapper(stream, encoding='utf-8', errors='ignore', newline='')
+    try:
+        while True:
+            block = reader.read(TEXT_READ_CHARS)
+            if not block:
+                break
+            yield block
+    finally:
+        # Hand the underlying upload stream back instead of closing it with the wrapper
+        reader.detach()
+
+
+def iter_document_text(stream, filename, mime_type=None):
+    """Text segments of an uploaded file from the extractor its content, extension or MIME type selects"""
+    return EXTRACTORS[resolve_extractor(stream, filename, mime_type)](stream)
+
+
+class TextStream:
+    """Iterable over extracted segments that counts what went through it"""
+
+    def __init__(self, segments, progress=None):
+        self.segments = segments
+        self.progress = progress     # optional callback(count, characters) after each segment
+        self.characters = 0          # all characters yielded
+        self.content_characters = 0  # excluding surrounding whitespace of each segment
+        self.count = 0               # pages / paragraphs / blocks yielded
+
+    def __iter__(self):
+        for segment in self.segments:
+            self.count += 1
+            self.characters += len(segment)
+            self.content_characters += len(segment.strip())
+            if self.progress:
+                self.progress(self.count, self.characters)
+            yield segment
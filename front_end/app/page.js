@@ -282,7 +282,22 @@ else if (msg.role === 'assistant') {
         },
       });
 
-      if (response.data.status === 'success') {
+      // Processing happens in a background job; poll it until the document is indexed
+      let result = response.data;
+      while (result.status === 'queued' || ['extracting', 'embedding', 'indexing'].includes(result.status)) {
+        const progress = result.progress || {};
+        setUploadStatus(progress.chunks_total
+          ? `⏳ Indexing document... ${progress.chunks_done}/${progress.chunks_total} chunks`
+          : `⏳ Reading document... ${progress.pages_done || 0} pages`);
+        await new Promise(resolve => setTimeout(resolve, 1000));
+        const statusResponse = await axios.get(`${API_BASE}/api/ingest/${response.data.job_id}`);
+        result = statusResponse.data;
+      }
+      if (result.status === 'ready') {
+        result = { ...result, status: 'success' };
+      }
+
+      if (result.status === 'success') {
         setUploadStatus('✅ Document uploaded successfully! You can now ask questions about it.');
         
         // FIXED: Add a simple system message instead of a complex assistant message
@@ -298,7 +313,7 @@ else if (msg.role === 'assistant') {
         // Reload conversations to update sidebar
         await loadConversations(userEmail);
       } else {
-        setUploadStatus(`❌ Upload failed: ${response.data.error}`);
+        setUploadStatus(`❌ Upload failed: ${result.error}`);
       }
     } catch (error) {
       console.error('Error uploading file:', error);
@@ -0,0 +1,390 @@
+"""
+Background document ingestion jobs.
+
+/upload copies the upload into a spooled buffer (kept in memory, spilling to a
+named temporary file past INGEST_SPOOL_MAX_MEMORY), hashing it on the way, registers an
+IngestJob and returns its id straight away. A bounded pool of worker threads runs extract -> chunk -> embed ->
+index for each job and records progress the status endpoint can report.
+
+Within a job the stages are pipelined (run_pipeline): chunking pulls text from
+the extractor on one thread, embedding runs on another, and the caller's thread
+adds embedded batches to the index. Bounded queues between them keep memory
+flat and let extraction of page N+1 overlap embedding of page N.
+"""
+import io
+import os
+import time
+import uuid
+import queue
+import tempfile
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from artifacts import content_hasher
+
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', '2'))
+INGEST_MAX_PENDING = int(os.getenv('INGEST_MAX_PENDING', '16'))          # queued + running jobs
+INGEST_JOB_RETENTION_SECONDS = int(os.getenv('INGEST_JOB_RETENTION_SECONDS', '3600'))
+INGEST_SPOOL_MAX_MEMORY = 1024 * 1024
+INGEST_EMBED_BATCH = int(os.getenv('INGEST_EMBED_BATCH', '64'))        # chunks per embedding batch
+INGEST_QUEUE_DEPTH = int(os.getenv('INGEST_QUEUE_DEPTH', '4'))         # batches buffered between stages
+INGEST_BATCH_MAX_FILES = int(os.getenv('INGEST_BATCH_MAX_FILES', '50'))  # files per /upload/batch request
+INGEST_BATCH_WORKERS = int(os.getenv('INGEST_BATCH_WORKERS', '4'))      # concurrent extractions per batch
+INGEST_MIN_CHARACTERS = 10                                               # less text than this: rejected as empty
+
+JOB_STAGES = ('queued', 'extracting', 'embedding', 'indexing', 'ready', 'failed')
+
+
+class IngestJob:
+    """State and progress of one uploaded document"""
+
+    def __init__(self, conversation_id, filename, source, doc_id=None, content_hash=None, mime_type=None):
+        self.job_id = uuid.uuid4().hex
+        self.conversation_id = conversation_id
+        self.filename = filename
+        self.doc_id = doc_id or uuid.uuid4().hex[:12]
+        self.source = source              # spooled copy of the upload, closed when the job ends
+        self.content_hash = content_hash  # SHA-256 of the upload, keys the artifact store
+        self.mime_type = mime_type        # as sent by the client; a fallback when sniffing is inconclusive
+        self.status = 'queued'
+        self.pages_done = 0               # extracted pages (PDF) or text segments
+        self.characters = 0
+        self.chunks_total = None          # known once the document is fully chunked
+        self.chunks_done = 0              # chunks embedded so far
+        self.message = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def finished(self):
+        return self.status in ('ready', 'failed')
+
+    def update(self, status=None, **counts):
+        """Progress callback used by the ingest pipeline"""
+        with self.lock:
+            if status:
+                self.status = status
+            for name, value in counts.items():
+                setattr(self, name, value)
+
+    def finish(self, message):
+        with self.lock:
+            self.status = 'ready'
+            self.message = message
+            self.finished_at = time.time()
+
+    def fail(self, error):
+        with self.lock:
+            self.status = 'failed'
+            self.error = error
+            self.finished_at = time.time()
+
+    def close(self):
+        """Release the spooled upload once the job has ended"""
+        try:
+            self.source.close()
+        except Exception:
+            pass
+        self.source = None
+
+    def to_dict(self):
+        with self.lock:
+            end = self.finished_at or time.time()
+            return {
+                'job_id': self.job_id,
+                'conversation_id': self.conversation_id,
+                'doc_id': self.doc_id,
+                'filename': self.filename,
+                'status': self.status,
+                'progress': {
+                    'pages_done': self.pages_done,
+                    'characters': self.characters,
+                    'chunks_done': self.chunks_done,
+                    'chunks_total': self.chunks_total
+                },
+                'chunk_count': self.chunks_total if self.status == 'ready' else None,
+                'message': self.message,
+                'error': self.error,
+                'created_at': datetime.fromtimestamp(self.created_at).isoformat(),
+                'queued_seconds': round((self.started_at or end) - self.created_at, 3),
+                'elapsed_seconds': round(end - self.started_at, 3) if self.started_at else None
+            }
+
+
+class BatchIngestJob(IngestJob):
+    """Several files uploaded together: extracted concurrently, embedded in shared batches, indexed once"""
+
+    def __init__(self, conversation_id, files):
+        super().__init__(conversation_id, ", ".join(f['filename'] for f in files), None)
+        self.doc_id = None
+        # One entry per file: filename, doc_id, source, content_hash plus the per-file status below
+        self.files = [dict(f, status='queued', characters=0, chunks=0, extract_seconds=None,
+                           message=None, error=None) for f in files]
+        self.embed_seconds = None         # shared across files: one embedding pass, one index update
+        self.index_seconds = None
+
+    def update_file(self, position, **fields):
+        with self.lock:
+            self.files[position].update(fields)
+
+    def close(self):
+        for f in self.files:
+            try:
+                f['source'].close()
+            except Exception:
+                pass
+            f['source'] = None
+
+    def to_dict(self):
+        result = super().to_dict()
+        with self.lock:
+            result['files'] = [{name: value for name, value in f.items() if name != 'source'} for f in self.files]
+            result['timings'] = {'embed_seconds': self.embed_seconds, 'index_seconds': self.index_seconds}
+        return result
+
+
+_END = object()
+
+
+class PipelineStats:
+    """Busy time per stage; wall time well below their sum means the stages overlapped"""
+
+    def __init__(self):
+        self.chunks = 0
+        self.batches = 0
+        self.chunk_seconds = 0.0     # includes extraction, which the chunker pulls from
+        self.embed_seconds = 0.0
+        self.index_seconds = 0.0
+        self.wall_seconds = 0.0
+
+    def __str__(self):
+        return (f"{self.chunks} chunks in {self.batches} batches, {self.wall_seconds:.2f}s wall "
+                f"(extract+chunk {self.chunk_seconds:.2f}s, embed {self.embed_seconds:.2f}s, "
+                f"index {self.index_seconds:.2f}s)")
+
+
+class EmptyDocumentError(ValueError):
+    pass
+
+
+def require_content(chunks, min_characters=INGEST_MIN_CHARACTERS):
+    """Pass chunks through once the document has shown at least min_characters of text.
+
+    Chunks are held back until then, so an empty or near-empty document raises
+    EmptyDocumentError before anything reaches the embed and index stages.
+    """
+    held, characters = [], 0
+    for chunk in chunks:
+        if held is None:
+            yield chunk
+            continue
+        held.append(chunk)
+        characters += len(chunk['text'].strip())
+        if characters >= min_characters:
+            yield from held
+            held = None
+    if held is not None:
+        raise EmptyDocumentError('File appears to be empty')
+
+
+def run_pipeline(chunks, embed, index, batch_size=INGEST_EMBED_BATCH, depth=INGEST_QUEUE_DEPTH, on_chunked=None):
+    """Run chunk -> embed -> index as three threads joined by bounded queues.
+
+    chunks is an iterable of chunks (iterating it drives extraction and
+    chunking), embed(batch) returns their vectors and index(batch, vectors)
+    stores a batch. on_chunked(total) is called once chunking has finished.
+    The first error from any stage stops the others and is re-raised here.
+    """
+    to_embed = queue.Queue(maxsize=depth)
+    to_index = queue.Queue(maxsize=depth)
+    failed = threading.Event()
+    errors = []
+    stats = PipelineStats()
+
+    def put(target, item):
+        # Poll so a stage blocked on a full queue notices when another stage has failed
+        while not failed.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(source):
+        while not failed.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _END
+
+    def chunk_stage():
+        try:
+            batch = []
+            iterator = iter(chunks)
+            while True:
+                started = time.perf_counter()
+                chunk = next(iterator, _END)
+                stats.chunk_seconds += time.perf_counter() - started
+                if chunk is _END:
+                    break
+                batch.append(chunk)
+                stats.chunks += 1
+                if len(batch) >= batch_size:
+                    if not put(to_embed, batch):
+                        return
+                    batch = []
+            if batch and not put(to_embed, batch):
+                return
+            if on_chunked:
+                on_chunked(stats.chunks)
+            put(to_embed, _END)
+        except Exception as e:
+            errors.append(e)
+            failed.set()
+
+    def embed_stage():
+        try:
+            while True:
+                batch = get(to_embed)
+                if batch is _END:
+                    put(to_index, _END)
+                    return
+                started = time.perf_counter()
+                vectors = embed(batch)
+                stats.embed_seconds += time.perf_counter() - started
+                if not put(to_index, (batch, vectors)):
+                    return
+        except Exception as e:
+            errors.append(e)
+            failed.set()
+
+    wall_start = time.perf_counter()
+    threads = [threading.Thread(target=chunk_stage, name="ingest-chunk", daemon=True),
+               threading.Thread(target=embed_stage, name="ingest-embed", daemon=True)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            item = get(to_index)
+            if item is _END:
+                break
+            started = time.perf_counter()
+            index(*item)
+            stats.index_seconds += time.perf_counter() - started
+            stats.batches += 1
+    except Exception as e:
+        errors.append(e)
+        failed.set()
+    finally:
+        for thread in threads:
+            thread.join()
+    stats.wall_seconds = time.perf_counter() - wall_start
+    if errors:
+        raise errors[0]
+    return stats
+
+
+def spool_upload(stream):
+    """Copy an upload stream into a buffer that outlives the request (disk-backed past 1 MB).
+
+    Small uploads stay in memory; larger ones move to a named temporary file, deleted
+    on close, whose path PDF extraction workers open directly instead of a copy.
+    Returns (spool, content_hash): the SHA-256 of the bytes is computed during the copy.
+    """
+    spool = io.BytesIO()
+    hasher = content_hasher()
+    while True:
+        block = stream.read(64 * 1024)
+        if not block:
+            break
+        hasher.update(block)
+        if isinstance(spool, io.BytesIO) and spool.tell() + len(block) > INGEST_SPOOL_MAX_MEMORY:
+            spilled = tempfile.NamedTemporaryFile(prefix="upload-", suffix=".spool")
+            spilled.write(spool.getvalue())
+            spool = spilled
+        spool.write(block)
+    spool.seek(0)
+    return spool, hasher.hexdigest()
+
+
+class IngestJobManager:
+    """Bounded worker pool running ingest jobs, with a registry of recent jobs for status polling"""
+
+    def __init__(self, run_job, run_batch=None, workers=INGEST_WORKERS, max_pending=INGEST_MAX_PENDING,
+                 retention_seconds=INGEST_JOB_RETENTION_SECONDS, pdf_pool=None):
+        self.run_job = run_job                   # callable(job): performs the ingest, raises on failure
+        self.run_batch = run_batch               # callable(batch_job) for multi-file uploads
+        self.pdf_pool = pdf_pool                 # worker processes every job's PDF extraction shares
+        if pdf_pool is not None:
+            pdf_pool.start()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest")
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.retention_seconds = retention_seconds
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, conversation_id, filename, source, doc_id=None, content_hash=None, mime_type=None):
+        """Queue a job; returns None when the queue is full (the caller should answer 503)"""
+        if not self.slots.acquire(blocking=False):
+            return None
+        job = IngestJob(conversation_id, filename, source, doc_id, content_hash, mime_type)
+        self._enqueue(job, self.run_job)
+        print(f"📥 Queued ingest job {job.job_id} for {filename} (conversation {conversation_id})")
+        return job
+
+    def submit_batch(self, conversation_id, files):
+        """Queue a multi-file job (one queue slot for the whole batch); None when the queue is full"""
+        if not self.slots.acquire(blocking=False):
+            return None
+        job = BatchIngestJob(conversation_id, files)
+        self._enqueue(job, self.run_batch)
+        print(f"📥 Queued batch ingest job {job.job_id} for {len(files)} files (conversation {conversation_id})")
+        return job
+
+    def _enqueue(self, job, run):
+        with self.lock:
+            self._prune()
+            self.jobs[job.job_id] = job
+        self.executor.submit(self._run, job, run)
+
+    def _run(self, job, run):
+        job.update('extracting', started_at=time.time())
+        try:
+            run(job)
+        except Exception as e:
+            print(f"❌ Ingest job {job.job_id} failed: {e}")
+            job.fail(str(e))
+        finally:
+            if not job.finished:
+                job.fail("Ingest ended without a result")
+            job.close()
+            self.slots.release()
+            print(f"📦 Ingest job {job.job_id} {job.status} in {time.time() - job.started_at:.2f}s")
+
+    def _prune(self):
+        cutoff = time.time() - self.retention_seconds
+        for job_id in [job_id for job_id, job in self.jobs.items()
+                       if job.finished and job.finished_at < cutoff]:
+            del self.jobs[job_id]
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def jobs_for_conversation(self, conversation_id):
+        with self.lock:
+            return [job for job in self.jobs.values() if job.conversation_id == conversation_id]
+
+    def stats(self):
+        with self.lock:
+            counts = {stage: 0 for stage in JOB_STAGES}
+            for job in self.jobs.values():
+                counts[job.status] += 1
+            return {'jobs': counts, 'workers': self.executor._max_workers,
+                    'pdf_pool': self.pdf_pool.stats() if self.pdf_pool is not None else None}
@@ -0,0 +1,242 @@
+"""
+BM25 keyword index kept next to each conversation's FAISS index.
+
+Postings are held per uploaded document as flat NumPy arrays (chunk id, term id,
+term frequency) and compiled on demand into one CSR layout sorted by term, so a
+query touches only the postings of its own terms. Removing a document leaves
+its terms in the vocabulary; once enough of them are dead, the next compile
+renumbers the live terms and drops the rest. Dense and lexical rankings are
+merged with reciprocal-rank fusion.
+"""
+import os
+import re
+import sys
+import math
+from collections import Counter
+import numpy as np
+
+RAG_BM25_K1 = float(os.getenv('RAG_BM25_K1', '1.2'))
+RAG_BM25_B = float(os.getenv('RAG_BM25_B', '0.75'))
+RAG_RRF_K = int(os.getenv('RAG_RRF_K', '60'))
+# Share of vocabulary terms left without postings (their documents were removed) that triggers a rebuild
+RAG_BM25_DEAD_TERM_FRACTION = float(os.getenv('RAG_BM25_DEAD_TERM_FRACTION', '0.25'))
+
+# Words plus identifiers such as "4.2.1", "sku-1138" or "v2/api" kept whole
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:[._\-/:#][a-z0-9]+)*")
+PART_RE = re.compile(r"[._\-/:#]")
+QUOTED_RE = re.compile(r'"([^"]+)"')
+
+STOPWORDS = frozenset("""
+a an and are as at be but by can could did do does for from had has have how i if in into is it its
+me my of on or our should so that the their them then there these they this to was we were what when
+where which who why will with would you your about tell give show explain please document documents
+""".split())
+
+
+def tokenize(text):
+    """Lowercased terms; compound identifiers are indexed whole and by their parts"""
+    terms = []
+    for token in TOKEN_RE.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        terms.append(token)
+        if PART_RE.search(token):
+            terms.extend(part for part in PART_RE.split(token) if part and part not in STOPWORDS)
+    return terms
+
+
+def identifier_terms(query):
+    """Terms a user expects to match literally: quoted phrases and compound codes ("sku-1138", "4.2.1").
+
+    Plain numbers and ALLCAPS words are left out; "changes in 2024" or "AI safety"
+    still need the dense ranking.
+    """
+    identifiers = set()
+    for phrase in QUOTED_RE.findall(query):
+        identifiers.update(tokenize(phrase))
+    for token in TOKEN_RE.findall(query.lower()):
+        if PART_RE.search(token) and any(ch.isdigit() for ch in token):
+            identifiers.add(token)
+    return identifiers
+
+
+def reciprocal_rank_fusion(rankings, k=RAG_RRF_K):
+    """Merge ranked id lists into [(rrf_score, id)], best first"""
+    fused = {}
+    for ranking in rankings:
+        for rank, item_id in enumerate(ranking):
+            fused[item_id] = fused.get(item_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(((score, item_id) for item_id, score in fused.items()), reverse=True)
+
+
+class LexicalIndex:
+    """Array-backed BM25 inverted index over chunk ids"""
+
+    def __init__(self):
+        self.vocab = {}        # {term: term_id}
+        self.terms = []        # term_id -> term
+        self.segments = {}     # {doc_id: dict of postings/length arrays for that document}
+        self._compiled = None  # CSR view over all segments, rebuilt after mutations
+
+    def __len__(self):
+        return sum(len(segment['chunk_ids']) for segment in self.segments.values())
+
+    def _term_id(self, term):
+        term_id = self.vocab.get(term)
+        if term_id is None:
+            term_id = self.vocab[term] = len(self.terms)
+            self.terms.append(term)
+        return term_id
+
+    def add_document(self, doc_id, chunk_ids, texts):
+        """Tokenize chunks into their document's postings segment (appending if it already exists)"""
+        posting_chunks, posting_terms, posting_tfs, lengths = [], [], [], []
+        for chunk_id, text in zip(chunk_ids, texts):
+            counts = Counter(tokenize(text))
+            lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                posting_chunks.append(chunk_id)
+                posting_terms.append(self._term_id(term))
+                posting_tfs.append(tf)
+        segment = {
+            'chunk_ids': np.asarray(chunk_ids, dtype=np.int64),
+            'lengths': np.asarray(lengths, dtype=np.float32),
+            'posting_chunk': np.asarray(posting_chunks, dtype=np.int64),
+            'posting_term': np.asarray(posting_terms, dtype=np.int32),
+            'posting_tf': np.asarray(posting_tfs, dtype=np.float32)
+        }
+        existing = self.segments.get(doc_id)
+        if existing:
+            segment = {name: np.concatenate([existing[name], array]) for name, array in segment.items()}
+        self.segments[doc_id] = segment
+        self._compiled = None
+
+    def remove_document(self, doc_id):
+        if self.segments.pop(doc_id, None) is not None:
+            self._compiled = None
+
+    def _compile(self):
+        if self._compiled is not None:
+            return self._compiled
+        segments = list(self.segments.values())
+        if not segments:
+            self.vocab, self.terms = {}, []
+            self._compiled = {'chunk_ids': np.zeros(0, dtype=np.int64)}
+            return self._compiled
+        self._compact_vocabulary(segments)
+
+        chunk_ids = np.concatenate([s['chunk_ids'] for s in segments])
+        lengths = np.concatenate([s['lengths'] for s in segments])
+        order = np.argsort(chunk_ids)
+        chunk_ids, lengths = chunk_ids[order], lengths[order]
+
+        posting_term = np.concatenate([s['posting_term'] for s in segments])
+        rows = np.searchsorted(chunk_ids, np.concatenate([s['posting_chunk'] for s in segments]))
+        posting_tf = np.concatenate([s['posting_tf'] for s in segments])
+        order = np.argsort(posting_term, kind='stable')
+        posting_term = posting_term[order]
+
+        avgdl = max(float(lengths.mean()), 1.0)
+        self._compiled = {
+            'chunk_ids': chunk_ids,
+            'offsets': np.searchsorted(posting_term, np.arange(len(self.terms) + 1)),
+            'rows': rows[order],
+            'tfs': posting_tf[order],
+            # Per-chunk length normalisation from the BM25 denominator
+            'norms': RAG_BM25_K1 * (1.0 - RAG_BM25_B + RAG_BM25_B * lengths / avgdl)
+        }
+        return self._compiled
+
+    def _compact_vocabulary(self, segments):
+        # Terms no remaining document uses still hold vocab entries and CSR offsets
+        live = np.unique(np.concatenate([s['posting_term'] for s in segments]))
+        if len(self.terms) - len(live) <= RAG_BM25_DEAD_TERM_FRACTION * len(self.terms):
+            return
+        remap = np.full(len(self.terms), -1, dtype=np.int32)
+        remap[live] = np.arange(len(live), dtype=np.int32)
+        for segment in segments:
+            segment['posting_term'] = remap[segment['posting_term']]
+        self.terms = [self.terms[term_id] for term_id in live.tolist()]
+        self.vocab = {term: term_id for term_id, term in enumerate(self.terms)}
+
+    def search(self, query, top_k=10):
+        """Return [(bm25_score, chunk_id)] for chunks sharing at least one term with the query"""
+        compiled = self._compile()
+        total = len(compiled['chunk_ids'])
+        term_ids = {self.vocab[term] for term in tokenize(query) if term in self.vocab}
+        if not total or not term_ids:
+            return []
+
+        offsets, rows, tfs, norms = compiled['offsets'], compiled['rows'], compiled['tfs'], compiled['norms']
+        scores = np.zeros(total, dtype=np.float32)
+        for term_id in term_ids:
+            start, end = offsets[term_id], offsets[term_id + 1]
+            if start == end:
+                continue
+            idf = math.log(1.0 + (total - (end - start) + 0.5) / ((end - start) + 0.5))
+            term_rows, term_tfs = rows[start:end], tfs[start:end]
+            # Each chunk appears once per term, so fancy-index accumulation is safe
+            scores[term_rows] += idf * term_tfs * (RAG_BM25_K1 + 1.0) / (term_tfs + norms[term_rows])
+
+        matched = np.flatnonzero(scores)
+        if len(matched) > top_k:
+            matched = matched[np.argpartition(-scores[matched], top_k - 1)[:top_k]]
+        matched = matched[np.argsort(-scores[matched])]
+        return [(float(scores[row]), int(compiled['chunk_ids'][row])) for row in matched]
+
+    def nbytes(self):
+        """Approximate resident size: postings segments, compiled CSR view and vocabulary"""
+        arrays = [array for segment in self.segments.values() for array in segment.values()]
+        if self._compiled:
+            arrays.extend(self._compiled.values())
+        # Each term is held by both the vocab dict and the terms list (~100 bytes of slots/entries)
+        vocabulary = sum(sys.getsizeof(term) + 100 for term in self.terms)
+        return int(sum(array.nbytes for array in arrays) + vocabulary)
+
+    def to_arrays(self):
+        """Flatten every segment into named arrays for np.savez (no pickled objects)"""
+        doc_ids = list(self.segments)
+        segments = [self.segments[doc_id] for doc_id in doc_ids]
+
+        def joined(name, dtype):
+            return np.concatenate([s[name] for s in segments]) if segments else np.zeros(0, dtype=dtype)
+
+        return {
+            'terms': np.array(self.terms, dtype=str),
+            'doc_ids': np.array(doc_ids, dtype=str),
+            'doc_chunks': np.array([len(s['chunk_ids']) for s in segments], dtype=np.int64),
+            'doc_postings': np.array([len(s['posting_chunk']) for s in segments], dtype=np.int64),
+            'chunk_ids': joined('chunk_ids', np.int64),
+            'lengths': joined('lengths', np.float32),
+            'posting_chunk': joined('posting_chunk', np.int64),
+            'posting_term': joined('posting_term', np.int32),
+            'posting_tf': joined('posting_tf', np.float32)
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        lexical = cls()
+        lexical.terms = arrays['terms'].tolist()
+        lexical.vocab = {term: term_id for term_id, term in enumerate(lexical.terms)}
+        chunk_bounds = np.concatenate([[0], np.cumsum(arrays['doc_chunks'])])
+        posting_bounds = np.concatenate([[0], np.cumsum(arrays['doc_postings'])])
+        for i, doc_id in enumerate(arrays['doc_ids'].tolist()):
+            c0, c1 = chunk_bounds[i], chunk_bounds[i + 1]
+            p0, p1 = posting_bounds[i], posting_bounds[i + 1]
+            lexical.segments[doc_id] = {
+                'chunk_ids': arrays['chunk_ids'][c0:c1],
+                'lengths': arrays['lengths'][c0:c1],
+                'posting_chunk': arrays['posting_chunk'][p0:p1],
+                'posting_term': arrays['posting_term'][p0:p1],
+                'posting_tf': arrays['posting_tf'][p0:p1]
+            }
+        return lexical
+
+    @classmethod
+    def from_chunks(cls, documents, chunks):
+        """Rebuild from a chunk registry (indexes persisted before BM25 existed)"""
+        lexical = cls()
+        for doc_id, document in documents.items():
+            chunk_ids = [chunk_id for chunk_id in document['chunk_ids'] if chunk_id in chunks]
+            lexical.add_document(doc_id, chunk_ids, [chunks[chunk_id]['text'] for chunk_id in chunk_ids])
+        return lexical
@@ -0,0 +1,186 @@
+"""
+Exact-match cache of LLM responses.
+
+Many prompts are byte-identical: the website summary prompt for the same URL,
+a summary requested again for the same text, the same question answered from
+the same search results. Responses are cached under a SHA-256 of (model,
+generation config, prompt), so a repeated prompt never pays for a second
+round trip, while the same prompt with a different token cap or temperature
+is a different entry.
+
+The memory tier is an LRU bounded by the total size of the cached text
+(LLM_CACHE_MAX_MB). Entries older than LLM_CACHE_TTL seconds are treated as
+missing. Setting LLM_CACHE_DIR adds a disk tier shared by worker processes
+and restarts: one JSON file per key, written atomically. Disk hits are
+promoted into memory, and the directory is pruned to LLM_CACHE_DISK_MAX_MB,
+least recently used first.
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+LLM_CACHE_ENABLED = os.getenv('LLM_CACHE', 'true').lower() in ('1', 'true', 'yes')
+LLM_CACHE_TTL = int(os.getenv('LLM_CACHE_TTL', '3600'))
+LLM_CACHE_MAX_MB = float(os.getenv('LLM_CACHE_MAX_MB', '64'))
+LLM_CACHE_DIR = os.getenv('LLM_CACHE_DIR', '')          # empty: memory only
+LLM_CACHE_DISK_MAX_MB = float(os.getenv('LLM_CACHE_DISK_MAX_MB', '512'))
+DISK_PRUNE_EVERY = 100                                  # disk writes between prunes
+
+
+def response_key(model_name, generation_config, prompt):
+    header = json.dumps({'model': model_name, 'config': generation_config}, sort_keys=True)
+    digest = hashlib.sha256(header.encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(prompt.encode('utf-8'))
+    return digest.hexdigest()
+
+
+class LLMResponseCache:
+    """Response text by prompt key: a byte-bounded LRU in memory with an optional disk tier"""
+
+    def __init__(self, ttl=LLM_CACHE_TTL, max_bytes=int(LLM_CACHE_MAX_MB * 1024 * 1024), directory=None,
+                 disk_max_bytes=int(LLM_CACHE_DISK_MAX_MB * 1024 * 1024)):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.disk_max_bytes = disk_max_bytes
+        self.entries = OrderedDict()     # {key: (created, text, size)}, least recently used first
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_writes = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _insert(self, key, created, text):
+        # Caller holds the lock
+        size = len(text.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[2]
+        self.entries[key] = (created, text, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, _, evicted_size) = self.entries.popitem(last=False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+
+    def _read_disk(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            os.utime(path)
+            return entry['created'], entry['text']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def get(self, key):
+        """Cached response text, or None if missing or expired"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if now - entry[0] <= self.ttl:
+                    self.entries.move_to_end(key)
+                    self.memory_hits += 1
+                    return entry[1]
+                del self.entries[key]
+                self.bytes -= entry[2]
+        if self.directory:
+            stored = self._read_disk(key)
+            if stored is not None and now - stored[0] <= self.ttl:
+                with self.lock:
+                    self._insert(key, stored[0], stored[1])
+                    self.disk_hits += 1
+                return stored[1]
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, text):
+        created = time.time()
+        with self.lock:
+            self._insert(key, created, text)
+        if not self.directory:
+            return
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'created': created, 'text': text}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"⚠️ Could not persist LLM response {key[:12]}: {e}")
+            return
+        with self.lock:
+            self.disk_writes += 1
+            prune = self.disk_writes % DISK_PRUNE_EVERY == 0
+        if prune:
+            self.prune_disk()
+
+    def prune_disk(self):
+        """Drop expired files, then least recently used ones until the directory fits its budget"""
+        now = time.time()
+        files = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            # Reads touch the file, so an mtime older than the TTL means it was written (and expired) before that
+            if now - stat.st_mtime > self.ttl:
+                self._remove(entry.path)
+            else:
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= self.disk_max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def stats(self):
+        with self.lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': round((self.memory_hits + self.disk_hits) / lookups, 3) if lookups else None,
+                'disk_tier': bool(self.directory)
+            }
+
+
+def open_llm_cache():
+    """The shared response cache, or None when disabled"""
+    if not LLM_CACHE_ENABLED:
+        return None
+    try:
+        return LLMResponseCache(directory=LLM_CACHE_DIR or None)
+    except OSError as e:
+        print(f"❌ Failed to open LLM cache directory: {e}")
+        return LLMResponseCache()
@@ -0,0 +1,223 @@
+"""
+Long-lived Gemini client shared by every LLM call site.
+
+The SDK is configured once, on first use, and GenerativeModel instances are kept
+per model name. genai.configure() replaces the SDK's transport clients, so
+calling it per request threw away the open gRPC channel (or pooled REST
+session) and paid for a fresh connection and TLS handshake on every answer;
+with one configuration the same connections are reused for the life of the
+process.
+
+Every call carries a real generation_config. Output length dominates Gemini
+latency, so each call site passes the max_output_tokens it actually needs, plus
+a temperature suited to the task (low for summaries and factual answers).
+generate_stream() yields the text as it is generated, for responses that are
+streamed to the browser.
+
+Responses go through the exact-prompt cache in llm_cache. While one request
+is generating a prompt, identical concurrent requests wait for its answer
+instead of starting their own call.
+
+A timeout (seconds) bounds a call end to end: it is sent as the RPC deadline,
+so the SDK cancels the request when it runs out, streaming included.
+"""
+import os
+import time
+import threading
+
+from llm_cache import open_llm_cache, response_key
+
+GEMINI_MODEL = os.getenv('GEMINI_MODEL', 'gemini-1.5-pro')
+GEMINI_TRANSPORT = os.getenv('GEMINI_TRANSPORT', 'grpc')      # grpc | rest
+GEMINI_MAX_OUTPUT_TOKENS = int(os.getenv('GEMINI_MAX_OUTPUT_TOKENS', '700'))
+GEMINI_TEMPERATURE = float(os.getenv('GEMINI_TEMPERATURE', '0.7'))
+
+
+def response_text(response):
+    """Text of a Gemini response, or None if it was blocked or empty"""
+    try:
+        return response.text
+    except (ValueError, AttributeError):
+        # .text raises when the candidate has no parts (safety block, MAX_TOKENS before any text)
+        return None
+
+
+def request_options(timeout):
+    return {'timeout': max(timeout, 0.001)} if timeout is not None else None
+
+
+class GeminiClient:
+    """One configured SDK and its models, reused across requests"""
+
+    def __init__(self, model_name=GEMINI_MODEL, transport=GEMINI_TRANSPORT, cache=None):
+        self.model_name = model_name
+        self.transport = transport
+        self.cache = cache
+        self.inflight = {}              # {cache key: Event set when its generation finishes}
+        self.models = {}
+        self.configured = False
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+        self.seconds = 0.0
+        self.output_chars = 0
+        self.streams = 0
+        self.first_text_seconds = 0.0
+
+    def _model(self, model_name):
+        with self.lock:
+            if not self.configured:
+                api_key = os.getenv("GEMINI_API_KEY")
+                if not api_key:
+                    print("❌ GEMINI_API_KEY not found in environment variables.")
+                    return None
+                import google.generativeai as genai
+                genai.configure(api_key=api_key, transport=self.transport)
+                self.configured = True
+                print(f"🤖 Gemini client configured ({self.transport} transport)")
+            model = self.models.get(model_name)
+            if model is None:
+                import google.generativeai as genai
+                model = self.models[model_name] = genai.GenerativeModel(model_name)
+            return model
+
+    def generation_config(self, max_output_tokens=None, temperature=None):
+        return {
+            'max_output_tokens': max_output_tokens or GEMINI_MAX_OUTPUT_TOKENS,
+            'temperature': GEMINI_TEMPERATURE if temperature is None else temperature
+        }
+
+    def generate(self, prompt, max_output_tokens=None, temperature=None, model_name=None, timeout=None):
+        """Response text for prompt, or None on failure"""
+        model_name = model_name or self.model_name
+        config = self.generation_config(max_output_tokens, temperature)
+        if self.cache is None:
+            return self._generate(model_name, config, prompt, timeout)
+        key = response_key(model_name, config, prompt)
+        text = self.cache.get(key)
+        if text is not None:
+            print(f"🎯 LLM cache hit ({len(text)} characters)")
+            return text
+        with self.lock:
+            pending = self.inflight.get(key)
+            leader = pending is None
+            if leader:
+                pending = self.inflight[key] = threading.Event()
+        if not leader:
+            # The same prompt is being generated; use its answer, or make our own call if it failed
+            started = time.time()
+            if not pending.wait(timeout):
+                return None
+            text = self.cache.get(key)
+            if text is not None:
+                return text
+            return self._generate(model_name, config, prompt,
+                                  None if timeout is None else timeout - (time.time() - started))
+        try:
+            text = self._generate(model_name, config, prompt, timeout)
+            if text:
+                self.cache.put(key, text)
+            return text
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            pending.set()
+
+    def _generate(self, model_name, config, prompt, timeout=None):
+        model = self._model(model_name)
+        if model is None:
+            return None
+        started = time.time()
+        try:
+            response = model.generate_content(prompt, generation_config=config,
+                                              request_options=request_options(timeout))
+        except Exception:
+            with self.lock:
+                self.failures += 1
+            raise
+        finally:
+            elapsed = time.time() - started
+            with self.lock:
+                self.calls += 1
+                self.seconds += elapsed
+        text = response_text(response)
+        if text:
+            with self.lock:
+                self.output_chars += len(text)
+        print(f"⏱️ Gemini call: {elapsed:.2f}s (max {config['max_output_tokens']} tokens, "
+              f"temperature {config['temperature']})")
+        return text
+
+    def generate_stream(self, prompt, max_output_tokens=None, temperature=None, model_name=None, timeout=None):
+        """Yield response text pieces as Gemini generates them (a cached response comes as one piece)"""
+        model_name = model_name or self.model_name
+        config = self.generation_config(max_output_tokens, temperature)
+        key = response_key(model_name, config, prompt) if self.cache is not None else None
+        if key:
+            cached = self.cache.get(key)
+            if cached is not None:
+                print(f"🎯 LLM cache hit ({len(cached)} characters)")
+                yield cached
+                return
+        model = self._model(model_name)
+        if model is None:
+            return
+        started = time.time()
+        first_text, chars, failed = None, 0, False
+        pieces = []
+        try:
+            for chunk in model.generate_content(prompt, generation_config=config, stream=True,
+                                                request_options=request_options(timeout)):
+                text = response_text(chunk)
+                if not text:
+                    continue
+                if first_text is None:
+                    first_text = time.time() - started
+                chars += len(text)
+                pieces.append(text)
+                yield text
+            # Only complete responses are cached; an abandoned stream is not
+            if key and pieces:
+                self.cache.put(key, "".join(pieces))
+        except Exception:
+            failed = True
+            raise
+        finally:
+            # Also reached when the consumer stops early (client disconnected)
+            elapsed = time.time() - started
+            with self.lock:
+                self.calls += 1
+                self.failures += failed
+                self.seconds += elapsed
+                self.output_chars += chars
+                if first_text is not None:
+                    self.streams += 1
+                    self.first_text_seconds += first_text
+            if first_text is not None:
+                print(f"⏱️ Gemini stream: first text after {first_text:.2f}s, {chars} chars in {elapsed:.2f}s")
+
+    def stats(self):
+        with self.lock:
+            return {
+                'model': self.model_name,
+                'transport': self.transport,
+                'calls': self.calls,
+                'failures': self.failures,
+                'avg_seconds': round(self.seconds / self.calls, 3) if self.calls else None,
+                'output_chars': self.output_chars,
+                'avg_first_text_seconds': round(self.first_text_seconds / self.streams, 3) if self.streams else None,
+                'cache': self.cache.stats() if self.cache else None
+            }
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_llm_client():
+    """The process-wide Gemini client"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = GeminiClient(cache=open_llm_cache())
+        return _client
@@ -13,14 +13,15 @@ import sys
 import tempfile
 import io
 import traceback
+import uuid
 import numpy as np
 import faiss
 import re
 import PyPDF2
 from datetime import datetime
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from werkzeug.utils import secure_filename
-from supabase import create_client, Client
+from supabase import create_client, Client, ClientOptions
 from dotenv import load_dotenv
 from urllib.parse import urlparse
 from bs4 import BeautifulSoup
@@ -28,9 +29,22 @@ from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.common.by import By
 import time
+from concurrent.futures import ThreadPoolExecutor
 from google.generativeai import list_models
 import google.generativeai as genai
 from newspaper import Article
+from rag_store import ConversationIndex, RagStateRegistry, save_conversation_index, load_conversation_index, conversation_index_mtime
+from extractors import iter_document_text, TextStream, EXTENSION_EXTRACTORS, pdf_worker_pool
+from chunking import iter_chunks, join_chunks, CHUNK_SIZE_TOKENS, CHUNK_OVERLAP_TOKENS
+from artifacts import open_artifact_store
+from summaries import DocumentSummarizer, SUMMARY_PRECOMPUTE, text_hash, extractive_summary
+from ingest import (IngestJobManager, spool_upload, run_pipeline, require_content, EmptyDocumentError,
+                    INGEST_BATCH_MAX_FILES, INGEST_BATCH_WORKERS, INGEST_MIN_CHARACTERS)
+from llm_client import get_llm_client
+from answer_cache import open_answer_cache, is_cacheable_query
+from deadline import (Deadline, DeadlineStats, NEWS_DEADLINE_SECONDS, LLM_MIN_SECONDS, WEB_SEARCH_MIN_SECONDS,
+                      BROWSER_MIN_SECONDS, SUPABASE_TIMEOUT_SECONDS)
+from embeddings import EMBEDDING_BACKEND, load_embedding_backend, open_embedding_cache, encode_with_cache, QueryBatcher
 
 # Add this right after the RAG imports section:
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
@@ -39,8 +53,13 @@ os.environ["MKL_NUM_THREADS"] = "1"
 
 print("🔍 Checking RAG dependencies...")
 try:
-    from sentence_transformers import SentenceTransformer
-    print("✅ sentence_transformers imported successfully")
+    if EMBEDDING_BACKEND in ('onnx', 'onnx-int8'):
+        import onnxruntime
+        from tokenizers import Tokenizer
+        print("✅ onnxruntime imported successfully")
+    else:
+        from sentence_transformers import SentenceTransformer
+        print("✅ sentence_transformers imported successfully")
 
     import faiss
     print("✅ faiss imported successfully")
@@ -60,12 +79,25 @@ except ImportError as e:
 load_dotenv()
 
 # Initialize variables for web-only mode
+EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
 embedding_model = None
-conversation_documents = {}      # {conversation_id: [chunks]}
-conversation_embeddings = {}     # {conversation_id: np.array}
-conversation_faiss_index = {}    # {conversation_id: faiss.IndexFlatIP}
+embedding_cache = None
+query_batcher = None
+answer_cache = None
+artifact_store = None
 document_usage_tracker = {}
 
+def release_conversation_tracking(conversation_id, reason, reloadable):
+    # Budget evictions are reloaded transparently; idle, archived or unrecoverable conversations lose their flags
+    if reason != 'budget' or not reloadable:
+        document_usage_tracker.pop(conversation_id, None)
+
+# Loaded conversation indexes under a memory budget (RAG_MEMORY_BUDGET_MB) with LRU/TTL eviction
+rag_registry = RagStateRegistry(on_evict=release_conversation_tracking)
+
+# Stage timings and deadline misses of /api/news requests
+news_deadline_stats = DeadlineStats()
+
 print("✅ Backend starting in WEB-ONLY mode (RAG disabled)")
 
 print("🚀 Starting PERFECTLY INTEGRATED AI Backend...")
@@ -85,7 +117,9 @@ class ConversationManager:
             return
 
         try:
-            self.supabase: Client = create_client(supabase_url, supabase_key)
+            # Bounded so a slow Supabase call can't outlast a request's deadline
+            self.supabase: Client = create_client(supabase_url, supabase_key,
+                                                  options=ClientOptions(postgrest_client_timeout=SUPABASE_TIMEOUT_SECONDS))
             print("✅ Connected to Supabase successfully!")
         except Exception as e:
             print(f"❌ Failed to connect to Supabase: {e}")
@@ -303,23 +337,28 @@ os.environ['GEMINI_API_KEY'] = os.getenv('GEMINI_API_KEY', 'AIzaSyDOmcCIWHcLM1Kp
 
 # Replace the call_GEMINI_ai function with this corrected version:
 
-def call_gemini_ai(prompt, max_tokens=700):
-    """Call Gemini AI API for intelligent response generation"""
+# Generation settings of the /api/news answers, shared by the JSON and streaming responses
+WEB_ONLY_GENERATION = {'max_tokens': 700, 'temperature': 0.4}
+RAG_ANSWER_GENERATION = {'max_tokens': 600, 'temperature': 0.5}
+
+def call_gemini_ai(prompt, max_tokens=700, temperature=None, deadline=None):
+    """Call Gemini AI API for intelligent response generation.
+
+    With a deadline the call is skipped (None) when too little budget is left,
+    and cancelled when the budget runs out.
+    """
+    if deadline is not None and not deadline.allows('llm', LLM_MIN_SECONDS):
+        return None
+    started = time.monotonic()
     try:
         print("🤖 Calling Gemini AI...")
         print(f"📝 Prompt length: {len(prompt)} characters")
 
-        api_key = os.getenv("GEMINI_API_KEY")
-        if not api_key:
-            print("❌ GEMINI_API_KEY not found in environment variables.")
-            return None
-
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel("gemini-1.5-pro")
-        response = model.generate_content(prompt)
-        if hasattr(response, 'text'):
-            print(f"✅ Gemini AI response received: {len(response.text)} characters")
-            return response.text
+        text = get_llm_client().generate(prompt, max_output_tokens=max_tokens, temperature=temperature,
+                                         timeout=deadline.timeout() if deadline else None)
+        if text:
+            print(f"✅ Gemini AI response received: {len(text)} characters")
+            return text
         else:
             print("❌ Gemini response missing text")
             return None
@@ -328,19 +367,91 @@ def call_gemini_ai(prompt, max_tokens=700):
         import traceback
         traceback.print_exc()
         return None
+    finally:
+        if deadline is not None:
+            deadline.record('llm', started)
+
+
+def stream_gemini_ai(prompt, max_tokens=700, temperature=None, deadline=None):
+    """Yield Gemini response text as it is generated; stops early (and logs) on failure or deadline"""
+    if deadline is not None and not deadline.allows('llm', LLM_MIN_SECONDS):
+        return
+    print("🤖 Streaming Gemini AI...")
+    print(f"📝 Prompt length: {len(prompt)} characters")
+    started = time.monotonic()
+    try:
+        yield from get_llm_client().generate_stream(prompt, max_output_tokens=max_tokens, temperature=temperature,
+                                                    timeout=deadline.timeout() if deadline else None)
+    except Exception as e:
+        print(f"❌ Gemini streaming call failed: {e}")
+        traceback.print_exc()
+    finally:
+        if deadline is not None:
+            deadline.record('llm', started)
 
 
-def call_gemini_ai_web_only(query, conversation_context=""):
+def call_gemini_ai_web_only(query, conversation_context="", deadline=None):
     """
     Call Gemini AI for a direct answer to a user's query (web-only, no document context).
     Uses a highly detailed, accurate prompt for maximum precision and completeness.
     Optionally includes previous conversation context.
+    If the deadline leaves no time for the LLM, answers from the web results without it.
     """
+    prompt_context = conversation_context
+    if is_shared_web_query(query):
+        cached = cached_web_answer(query)
+        if cached:
+            return cached
+        # The answer is shared with every user, so it must not be shaped by this user's conversation
+        prompt_context = ""
+
     print("🤖 [Web-only] Calling Gemini AI for direct query...")
+    started = time.time()
 
     # Fetch more web results for richer context
-    web_results = get_universal_web_search(query, num_results=5)
+    web_results = get_universal_web_search(query, num_results=5, deadline=deadline)
+    prompt = create_web_only_prompt(query, web_results, prompt_context)
+    ai_response = call_gemini_ai(prompt, **WEB_ONLY_GENERATION, deadline=deadline)
+    if ai_response:
+        cache_web_answer(query, ai_response, time.time() - started, prompt_context)
+    elif deadline is not None and deadline.remaining() < LLM_MIN_SECONDS:
+        return generate_guaranteed_fallback_response(query, web_results, None, conversation_context)
+    return ai_response
+
+
+def is_shared_web_query(query):
+    """Self-contained question answered through the process-wide answer cache (from a context-free prompt)"""
+    return answer_cache is not None and is_cacheable_query(query)
+
 
+def cached_web_answer(query):
+    """Recent answer to the same (or a near-identical) self-contained question, or None"""
+    if not is_shared_web_query(query):
+        return None
+    try:
+        hit = answer_cache.lookup(query)
+    except Exception as e:
+        print(f"⚠️ Answer cache lookup failed: {e}")
+        return None
+    return hit[0] if hit else None
+
+
+def cache_web_answer(query, ai_response, seconds, prompt_context):
+    """Keep a generated web-only answer for near-duplicate questions; seconds is what it cost.
+
+    Only answers generated without conversation context (prompt_context) are
+    stored: the cache is shared by all users.
+    """
+    if prompt_context or not is_shared_web_query(query):
+        return
+    try:
+        answer_cache.store(query, ai_response, seconds)
+    except Exception as e:
+        print(f"⚠️ Answer cache store failed: {e}")
+
+
+def create_web_only_prompt(query, web_results, conversation_context=""):
+    """Reference-rich prompt for a direct answer from web results"""
     # Build a reference-rich prompt
     web_refs = ""
     for i, result in enumerate(web_results):
@@ -379,7 +490,7 @@ def call_gemini_ai_web_only(query, conversation_context=""):
         f"---\n"
         f"Answer:"
     )
-    return call_gemini_ai(prompt, max_tokens=700)
+    return prompt
 
 
 
@@ -424,7 +535,16 @@ def generate_enhanced_fallback_response(query, web_results, rag_context, convers
 if RAG_AVAILABLE:
     try:
         print("🧠 Loading embedding model...")
-        embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+        embedding_model = load_embedding_backend(EMBEDDING_MODEL_NAME)
+        # Backends embed slightly differently, so each gets its own cache namespace
+        embedding_cache = open_embedding_cache(embedding_model.model_id, embedding_model.get_sentence_embedding_dimension())
+        query_batcher = QueryBatcher(embedding_model)
+        # Near-duplicate web-only questions are answered from recent answers
+        answer_cache = open_answer_cache(query_batcher.encode, embedding_model.get_sentence_embedding_dimension())
+        # Stored chunks and vectors are only reusable under the settings that produced them
+        artifact_store = open_artifact_store({'model': embedding_model.model_id,
+                                              'chunk_tokens': CHUNK_SIZE_TOKENS,
+                                              'overlap_tokens': CHUNK_OVERLAP_TOKENS})
         document_store = []
         document_embeddings = None
         faiss_index = None
@@ -461,7 +581,7 @@ CORS(app,
      methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
      supports_credentials=True)
 UPLOAD_FOLDER = os.path.join(tempfile.gettempdir(), "user_uploads")
-ALLOWED_EXTENSIONS = {'txt', 'pdf', 'doc', 'docx', 'md'}
+ALLOWED_EXTENSIONS = {extension.lstrip('.') for extension in EXTENSION_EXTRACTORS}   # txt, md, pdf, doc, docx
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
@@ -469,90 +589,20 @@ app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def extract_text_from_file(file_content, filename):
-    """Extract text from various file formats"""
+def extract_text_from_file(file_content, filename, mime_type=None):
+    """Extract text from various file formats (see the extractor registry in extractors.py)"""
     try:
-        filename_lower = filename.lower()
-
-        if filename_lower.endswith('.txt') or filename_lower.endswith('.md'):
-            return file_content
-
-        elif filename_lower.endswith('.pdf'):
-            try:
-                import PyPDF2
-                import io
-                text = ""
-                pdf_bytes = file_content if isinstance(file_content, bytes) else file_content.encode('utf-8')
-                pdf_file = io.BytesIO(pdf_bytes)
-                reader = PyPDF2.PdfReader(pdf_file)
-                for page in reader.pages:
-                    text += page.extract_text() + "\n"
-                return text
-            except ImportError:
-                return "PDF processing requires PyPDF2. Install with: pip install PyPDF2"
-
-        elif filename_lower.endswith('.docx'):
-            try:
-                from docx import Document
-                import io
-                docx_bytes = file_content if isinstance(file_content, bytes) else file_content.encode('utf-8')
-                doc_file = io.BytesIO(docx_bytes)
-                doc = Document(doc_file)
-                text = ""
-                for paragraph in doc.paragraphs:
-                    text += paragraph.text + "\n"
-                return text
-            except ImportError:
-                return "DOCX processing requires python-docx. Install with: pip install python-docx"
-
-        else:
-            return file_content
-
+        if isinstance(file_content, str):
+            if EXTENSION_EXTRACTORS.get(os.path.splitext(filename.lower())[1], 'text') == 'text':
+                return file_content
+            file_content = file_content.encode('utf-8')
+        return "".join(iter_document_text(io.BytesIO(file_content), filename, mime_type))
+
+    except ImportError as e:
+        return f"Document processing requires an extra package ({e}). Install PyPDF2 / python-docx / olefile."
     except Exception as e:
         return f"Error reading file: {str(e)}"
 
-# FIXED: RAG Functions with better implementation
-# Replace the process_document function:
-
-def process_document(text, chunk_size=500):
-    print(f"🔍 Processing document: {len(text)} chars, chunk_size={chunk_size}")
-
-    if not text:
-        print("❌ Empty text provided")
-        return []
-
-    chunks = []
-    print("🔄 Splitting into paragraphs...")
-    paragraphs = text.split('\n\n')
-    print(f"📋 Found {len(paragraphs)} paragraphs")
-
-    for i, paragraph in enumerate(paragraphs):
-        if len(paragraph.strip()) > 0:
-            if len(paragraph) > chunk_size:
-                print(f"📏 Paragraph {i} too long ({len(paragraph)} chars), splitting by sentences...")
-                sentences = paragraph.split('. ')
-                current_chunk = ""
-
-                for sentence in sentences:
-                    if len(current_chunk + sentence) < chunk_size:
-                        current_chunk += sentence + ". "
-                    else:
-                        if current_chunk:
-                            chunks.append(current_chunk.strip())
-                        current_chunk = sentence + ". "
-
-                if current_chunk:
-                    chunks.append(current_chunk.strip())
-            else:
-                chunks.append(paragraph.strip())
-
-    print(f"✅ Created {len(chunks)} chunks")
-    if chunks:
-        print(f"📝 First chunk preview: {chunks[0][:100]}...")
-        print(f"📏 Chunk lengths: {[len(c) for c in chunks[:5]]}");  # Show first 5 lengths
-
-    return chunks
-
 
 
 #patterns for summary detection
@@ -811,93 +861,144 @@ def is_document_summary_query(query):
 
 
 
-def add_document_to_rag_simple(document_text, filename="uploaded_doc", conversation_id=None):
-    """Simplified RAG for large documents"""
-    global conversation_documents, conversation_embeddings, conversation_faiss_index
-
-    print(f"🔄 Simple RAG processing: {filename} ({len(document_text)} chars) for conversation {conversation_id}")
-
-    try:
-        # Create smaller, meaningful chunks
-        chunks = []
-
-        # Split by paragraphs and sentences more aggressively
-        paragraphs = document_text.split('\n\n')
-        for paragraph in paragraphs:
-            if len(paragraph.strip()) > 100:  # Only meaningful paragraphs
-                if len(paragraph) > 400:  # Split long paragraphs
-                    sentences = paragraph.split('. ')
-                    current_chunk = ""
-                    for sentence in sentences:
-                        if len(current_chunk + sentence) < 400:
-                            current_chunk += sentence + ". "
-                        else:
-                            if len(current_chunk.strip()) > 50:
-                                chunks.append(current_chunk.strip())
-                            current_chunk = sentence + ". "
-                    if len(current_chunk.strip()) > 50:
-                        chunks.append(current_chunk.strip())
-                else:
-                    chunks.append(paragraph.strip())
+def add_document_to_rag_simple(document_text, filename="uploaded_doc", conversation_id=None, doc_id=None, progress=None,
+                               content_hash=None, artifacts=None):
+    """Simplified RAG for large documents: appends one document to the conversation's index.
 
-        # Limit chunks to avoid memory issues
-        if len(chunks) > 200:
-            print(f"📏 Limiting to first 200 chunks (was {len(chunks)})")
-            chunks = chunks[:200]
-
-        print(f"✅ Created {len(chunks)} chunks for processing")
-
-        # Always overwrite previous document chunks for this conversation
-        conversation_documents[conversation_id] = [{'text': chunk, 'filename': filename} for chunk in chunks]
+    document_text is either the full text or an iterable of streamed text segments
+    (see extractors.py). Chunking, embedding and indexing run as a pipeline, so
+    batches are embedded and indexed while later pages are still being extracted.
+    progress, if given, is called as progress(stage, **counts) (see IngestJob.update).
+    artifacts, an ArtifactWriter, receives every embedded batch for reuse by later uploads.
+    """
+    progress = progress or (lambda status=None, **counts: None)
+    doc_id = doc_id or uuid.uuid4().hex[:12]
+    size = f"{len(document_text)} chars" if isinstance(document_text, str) else "streamed"
+    print(f"🔄 Simple RAG processing: {filename} ({size}) as document {doc_id} for conversation {conversation_id}")
+
+    if not RAG_AVAILABLE or not embedding_model:
+        return False, "Embedding model unavailable (text-only mode)"
+
+    segments = [document_text] if isinstance(document_text, str) else document_text
+    encoded = [0]
+
+    def on_encoded(count):
+        encoded[0] += count
+        progress(chunks_done=encoded[0])
+
+    def embed(chunks):
+        # Chunks already embedded for any conversation come straight from the shared cache
+        return encode_with_cache(embedding_model, [chunk['text'] for chunk in chunks], embedding_cache,
+                                 on_encoded=on_encoded, show_progress_bar=False)
+
+    # One writer per conversation: the index is loaded once, grown batch by batch, then saved
+    with rag_registry.write_lock(conversation_id):
+        conversation_index = ensure_conversation_index_loaded(conversation_id)
+        if conversation_index is not None and doc_id in conversation_index.documents:
+            conversation_index.remove_document(doc_id)
+
+        def index(chunks, vectors):
+            nonlocal conversation_index
+            if conversation_index is None:
+                conversation_index = ConversationIndex(vectors.shape[1])
+            # Only this document's chunks are embedded and added; earlier uploads stay untouched
+            conversation_index.append_chunks(doc_id, filename, [chunk['text'] for chunk in chunks], vectors,
+                                             offsets=[(chunk['start'], chunk['end']) for chunk in chunks],
+                                             content_hash=content_hash, pending=True)
+            if artifacts is not None:
+                artifacts.add(chunks, vectors)
 
-        if not RAG_AVAILABLE or not embedding_model:
-            return True, f"Added {len(chunks)} chunks (text-only mode)"
+        try:
+            # Empty documents fail here, before a single chunk is indexed or anything is saved
+            stats = run_pipeline(require_content(iter_chunks(segments)), embed, index,
+                                 on_chunked=lambda total: progress('embedding', chunks_total=total))
+        except EmptyDocumentError as e:
+            return False, str(e)
+        except Exception as e:
+            print(f"❌ Simple RAG failed: {e}")
+            if conversation_index is not None:
+                conversation_index.remove_document(doc_id)
+            return False, f"Processing error: {str(e)}"
+
+        print(f"✅ Ingest pipeline: {stats}")
+        if not stats.chunks:
+            return False, "No meaningful text chunks found in document"
+
+        # Every chunk is indexed: only now may the document be searched or summarised
+        conversation_index.mark_ready(doc_id)
+
+        # Persist so the document survives restarts and is visible to other workers
+        progress('indexing')
+        saved = save_conversation_index(conversation_id, conversation_index)
+        rag_registry.put(conversation_id, conversation_index, conversation_index_mtime(conversation_id) if saved else None)
+
+    return True, f"Added {stats.chunks} chunks successfully ({len(conversation_index.documents)} documents in conversation)"
+
+def remove_document_from_rag(conversation_id, doc_id):
+    """Delete one document's chunks from a conversation index without touching the others"""
+    with rag_registry.write_lock(conversation_id):
+        conversation_index = ensure_conversation_index_loaded(conversation_id)
+        if conversation_index is None:
+            return 0
+        removed = conversation_index.remove_document(doc_id)
+        if removed:
+            saved = save_conversation_index(conversation_id, conversation_index)
+            rag_registry.put(conversation_id, conversation_index, conversation_index_mtime(conversation_id) if saved else None)
+    print(f"🗑️ Removed {removed} chunks of document {doc_id} from conversation {conversation_id}")
+    return removed
+
+def ensure_conversation_index_loaded(conversation_id):
+    """Return a conversation's ConversationIndex, lazily (re)loading the persisted copy; None if it has none"""
+    if not conversation_id:
+        return None
 
-        batch_emb = embedding_model.encode(chunks, show_progress_bar=False)
-        new_embeddings = np.vstack([batch_emb])
+    disk_mtime = conversation_index_mtime(conversation_id)
+    resident = rag_registry.get(conversation_id)
+    if resident is not None:
+        held_mtime = rag_registry.mtime(conversation_id)
+        # Unsaved local changes win; otherwise reload if another worker re-indexed the conversation
+        if disk_mtime is None or held_mtime is None or disk_mtime == held_mtime:
+            return resident
 
-        # Always overwrite embeddings and FAISS index for this conversation
-        conversation_embeddings[conversation_id] = new_embeddings.astype(np.float32)
+    if disk_mtime is None:
+        return resident
 
-        dimension = new_embeddings.shape[1]
-        conversation_faiss_index[conversation_id] = faiss.IndexFlatIP(dimension)
-        faiss.normalize_L2(conversation_embeddings[conversation_id])
-        conversation_faiss_index[conversation_id].reset()
-        conversation_faiss_index[conversation_id].add(conversation_embeddings[conversation_id])
+    conversation_index = load_conversation_index(conversation_id)
+    if conversation_index is None:
+        return resident
 
-        return True, f"Added {len(chunks)} chunks successfully"
+    rag_registry.put(conversation_id, conversation_index, disk_mtime)
+    return conversation_index
 
-    except Exception as e:
-        print(f"❌ Simple RAG failed: {e}")
-        return False, f"Processing error: {str(e)}"
+def get_conversation_chunks(conversation_id):
+    """All chunk dicts ({'text', 'filename', 'doc_id', 'start', 'end'}) uploaded to a conversation, in order"""
+    conversation_index = ensure_conversation_index_loaded(conversation_id)
+    if conversation_index is None:
+        return []
+    return conversation_index.ordered_chunks()
 
 # FIXED: Better RAG search with structured results
 def search_documents(query, top_k=3, conversation_id=None):
-    global conversation_documents, conversation_embeddings, conversation_faiss_index
-
-    if not conversation_id or conversation_id not in conversation_documents:
+    conversation_index = ensure_conversation_index_loaded(conversation_id)
+    if conversation_index is None:
         return "No documents uploaded yet for this conversation."
 
-    if not RAG_AVAILABLE or not embedding_model or conversation_id not in conversation_faiss_index:
+    if not RAG_AVAILABLE or not embedding_model:
         return "No documents uploaded yet for this conversation."
 
     try:
-        query_embedding = embedding_model.encode([query])
-        faiss.normalize_L2(query_embedding)
+        def embed_query():
+            # Concurrent requests share one batched forward pass instead of encoding one query each
+            return query_batcher.encode(query) if query_batcher else embedding_model.encode([query])
 
-        index = conversation_faiss_index[conversation_id]
-        docs = conversation_documents[conversation_id]
-        embeddings = conversation_embeddings[conversation_id]
-
-        scores, indices = index.search(query_embedding, min(top_k, len(docs)))
+        # Dense + BM25 fused; identifier-style queries may never need the embedding
+        matches = conversation_index.hybrid_search(query, embed_query, top_k, min_dense_score=0.10)
 
         results = []
-        for i in range(len(indices[0])):
-            if indices[0][i] != -1 and scores[0][i] > 0.10:
-                doc_idx = indices[0][i]
-                doc_text = docs[doc_idx]['text']
-                if len(doc_text) > 30:
-                    results.append(doc_text[:300])
+        for score, chunk in matches:
+            doc_text = chunk['text']
+            if len(doc_text) > 30:
+                results.append(doc_text[:300])
 
         if results:
             return " | ".join(results)
@@ -909,20 +1010,26 @@ def search_documents(query, top_k=3, conversation_id=None):
 
 
 # Web Search Functions
-def get_universal_web_search(query, num_results=1):
+def get_universal_web_search(query, num_results=1, deadline=None):
     print(f"🌐 STEP 1: Web search for: {query}")
 
+    started = time.monotonic()
     try:
         articles = []
 
-        # Try Serper first
+        # Try Serper first, unless the request's deadline leaves no time for it
         serper_key = os.environ.get('SERPER_API_KEY')
-        if serper_key:
+        if serper_key and (deadline is None or deadline.allows('web_search', WEB_SEARCH_MIN_SECONDS)):
             url = "https://google.serper.dev/search"
             headers = {'X-API-KEY': serper_key, 'Content-Type': 'application/json'}
             data = {'q': query, 'num': num_results}
 
-            response = requests.post(url, headers=headers, json=data, timeout=10)
+            try:
+                response = requests.post(url, headers=headers, json=data,
+                                         timeout=deadline.timeout(10) if deadline else 10)
+            finally:
+                if deadline is not None:
+                    deadline.record('web_search', started)
 
             if response.status_code == 200:
                 results = response.json()
@@ -1010,7 +1117,7 @@ Instructions:
 11. Do NOT reference previous conversations or answers.
 
 Please provide your response by combining both sources if available or using the single available source:"""# Try Gemini AI first with lower token limit for concise response
-    ai_response = call_gemini_ai(prompt, max_tokens=500)
+    ai_response = call_gemini_ai(prompt, max_tokens=500, temperature=0.5)
 
     if ai_response and len(ai_response.strip()) > 50:
         print(f"✅ Using Gemini AI response: {len(ai_response)} characters")
@@ -1208,12 +1315,8 @@ def create_comprehensive_web_response(query, web_results):
     return response
 
 # Update the debug_response_generation function
-def debug_response_generation(query, web_results, rag_context, conversation_context=""):
-    """Generate concise response for regular search queries"""
-    print("  Generating concise response for regular search...")
-    print(f"🔍 Query: {query}")
-    print(f"🔍 Web results: {len(web_results) if web_results else 0}")
-
+def create_rag_answer_prompt(query, web_results, rag_context, conversation_context=""):
+    """Prompt combining document context and web results for a regular search query"""
     # Use the same concise logic as website processing
     # Build context for AI
     context_parts = []
@@ -1260,9 +1363,19 @@ Instructions:
 11. Do NOT reference previous conversations or answers.
 
 Please provide your comprehensive response by combining BOTH sources if available, or using the single available source:"""
+    return prompt
+
+
+def debug_response_generation(query, web_results, rag_context, conversation_context="", deadline=None):
+    """Generate concise response for regular search queries"""
+    print("  Generating concise response for regular search...")
+    print(f"🔍 Query: {query}")
+    print(f"🔍 Web results: {len(web_results) if web_results else 0}")
+
+    prompt = create_rag_answer_prompt(query, web_results, rag_context, conversation_context)
 
     # Try Gemini AI first with higher token limit for comprehensive response
-    ai_response = call_gemini_ai(prompt, max_tokens=600)
+    ai_response = call_gemini_ai(prompt, **RAG_ANSWER_GENERATION, deadline=deadline)
 
     if ai_response and len(ai_response.strip()) > 50:
         print(f"✅ Using Gemini AI concise response: {len(ai_response)} characters")
@@ -1532,50 +1645,35 @@ def upload_file():
                 'error': 'Document upload is temporarily disabled. The system is running in web-only mode.'
             }), 400
 
-        # Extract text content
+        # Hand the upload to a background ingest job; the client polls /api/ingest/<job_id>
         try:
-            if file.filename.lower().endswith(('.txt', '.md')):
-                file_content = file.read().decode('utf-8', errors='ignore')
-                text_content = file_content
-            else:
-                filename = secure_filename(file.filename)
-                temp_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(temp_path)
-
-                with open(temp_path, 'rb') as f:
-                    file_bytes = f.read()
-
-                if filename.lower().endswith('.pdf'):
-                    try:
-                        import PyPDF2
-                        import io
-                        pdf_file = io.BytesIO(file_bytes)
-                        reader = PyPDF2.PdfReader(pdf_file)
-                        text_content = ""
-                        for page in reader.pages:
-                            text_content += page.extract_text() + "\n"
-                    except ImportError:
-                        return jsonify({'status': 'error', 'error': 'PDF processing requires PyPDF2'}), 400
-                else:
-                    text_content = file_bytes.decode('utf-8', errors='ignore')
-
-                os.remove(temp_path)
-
-            if len(text_content.strip()) < 10:
-                return jsonify({'status': 'error', 'error': 'File appears to be empty'}), 400
-              # Process with RAG
-            success, message = add_document_to_rag_simple(text_content, file.filename, conversation_id)
-
-            if success:
-                document_usage_tracker[conversation_id] = True
+            source, content_hash = spool_upload(file.stream)
+            attached = attach_known_document(conversation_id, file.filename, content_hash)
+            if attached:
+                source.close()
+                doc_id, message = attached
                 return jsonify({
-                    'status': 'success',
+                    'status': 'ready',
                     'message': f'File "{file.filename}" uploaded successfully. {message}',
                     'filename': file.filename,
-                    'characters': len(text_content)
-                })
-            else:
-                return jsonify({'status': 'error', 'error': f'Processing failed: {message}'}), 500
+                    'doc_id': doc_id,
+                    'reused': True
+                }), 200
+
+            job = ingest_jobs.submit(conversation_id, file.filename, source, content_hash=content_hash,
+                                     mime_type=file.mimetype)
+            if job is None:
+                source.close()
+                return jsonify({'status': 'error', 'error': 'Too many documents are being processed. Please retry shortly.'}), 503
+
+            return jsonify({
+                'status': 'queued',
+                'message': f'File "{file.filename}" received and queued for processing.',
+                'filename': file.filename,
+                'job_id': job.job_id,
+                'doc_id': job.doc_id,
+                'status_url': f'/api/ingest/{job.job_id}'
+            }), 202
 
         except Exception as e:
             return jsonify({'status': 'error', 'error': f'Error: {str(e)}'}), 400
@@ -1584,14 +1682,481 @@ def upload_file():
         print(f'❌ Upload error: {e}')
         return jsonify({'status': 'error', 'error': f'Upload failed: {str(e)}'}), 500
 
+def attach_known_document(conversation_id, filename, content_hash):
+    """Attach a previously ingested upload without extracting or embedding it.
+
+    Returns (doc_id, message), or None when these bytes have not been ingested before.
+    """
+    with rag_registry.write_lock(conversation_id):
+        conversation_index = ensure_conversation_index_loaded(conversation_id)
+        existing = conversation_index.find_document(content_hash) if conversation_index is not None else None
+        if existing:
+            # Same file uploaded again into the same conversation (e.g. after a page refresh)
+            print(f"♻️ {filename} is already document {existing} of conversation {conversation_id}")
+            document_usage_tracker[conversation_id] = True
+            return existing, "This document was already uploaded to this conversation."
+
+        stored = artifact_store.get(content_hash) if artifact_store is not None else None
+        if stored is None or not stored.texts:
+            return None
+        doc_id = uuid.uuid4().hex[:12]
+        if conversation_index is None:
+            conversation_index = ConversationIndex(stored.vectors.shape[1])
+        conversation_index.append_chunks(doc_id, filename, stored.texts, stored.vectors,
+                                         offsets=stored.offsets, content_hash=content_hash)
+        saved = save_conversation_index(conversation_id, conversation_index)
+        rag_registry.put(conversation_id, conversation_index, conversation_index_mtime(conversation_id) if saved else None)
+
+    print(f"♻️ Attached stored artifacts of {filename} ({len(stored.texts)} chunks) as document {doc_id}")
+    document_usage_tracker[conversation_id] = True
+    schedule_document_summary(conversation_id, doc_id)
+    return doc_id, f"Reused {len(stored.texts)} already processed chunks ({len(conversation_index.documents)} documents in conversation)"
+
+def run_ingest_job(job):
+    """Extract -> chunk -> embed -> index one queued upload (runs on an ingest worker thread)"""
+    writer = artifact_store.writer(job.content_hash) if artifact_store is not None and job.content_hash else None
+    segments = iter_document_text(job.source, job.filename, job.mime_type)
+    text_stream = TextStream(segments,
+                             progress=lambda count, characters: job.update(pages_done=count, characters=characters))
+    try:
+        # Rejects empty files inside the pipeline, so a failed job never leaves a document behind
+        success, message = add_document_to_rag_simple(text_stream, job.filename, job.conversation_id, job.doc_id,
+                                                      progress=job.update, content_hash=job.content_hash,
+                                                      artifacts=writer)
+        if not success:
+            raise RuntimeError(f'Processing failed: {message}')
+    except Exception:
+        if writer:
+            writer.abort()
+        raise
+    if writer:
+        writer.commit(job.filename)
+    schedule_document_summary(job.conversation_id, job.doc_id)
+
+    # Only now is the document searchable, so only now should the next question use it
+    document_usage_tracker[job.conversation_id] = True
+    job.finish(f'File "{job.filename}" uploaded successfully. {message}')
+
+def run_batch_ingest_job(job):
+    """Extract a batch's files concurrently, embed all their chunks together and update the index once"""
+    def extract(position):
+        upload = job.files[position]
+        started = time.perf_counter()
+        job.update_file(position, status='extracting')
+        writer = artifact_store.writer(upload['content_hash']) if artifact_store is not None else None
+        try:
+            segments = iter_document_text(upload['source'], upload['filename'], upload['mime_type'])
+            text_stream = TextStream(segments)
+            chunks = list(iter_chunks(text_stream))
+            if text_stream.content_characters < INGEST_MIN_CHARACTERS or not chunks:
+                raise ValueError('File appears to be empty')
+        except Exception as e:
+            if writer:
+                writer.abort()
+            job.update_file(position, status='failed', error=str(e),
+                            extract_seconds=round(time.perf_counter() - started, 3))
+            return None
+        job.update_file(position, status='extracted', characters=text_stream.characters, chunks=len(chunks),
+                        extract_seconds=round(time.perf_counter() - started, 3))
+        return position, chunks, writer
+
+    with ThreadPoolExecutor(max_workers=INGEST_BATCH_WORKERS, thread_name_prefix="ingest-extract") as pool:
+        extracted = [result for result in pool.map(extract, range(len(job.files))) if result]
+    if not extracted:
+        raise ValueError('None of the files could be processed')
+
+    writers = [writer for _, _, writer in extracted if writer]
+    try:
+        # One embedding pass over every file's chunks: length-bucketed batches mix files freely
+        all_chunks = [chunk for _, chunks, _ in extracted for chunk in chunks]
+        job.update('embedding', pages_done=len(extracted), chunks_total=len(all_chunks))
+        encoded = [0]
+
+        def on_encoded(count):
+            encoded[0] += count
+            job.update(chunks_done=encoded[0])
+
+        started = time.perf_counter()
+        vectors = encode_with_cache(embedding_model, [chunk['text'] for chunk in all_chunks], embedding_cache,
+                                    on_encoded=on_encoded, show_progress_bar=False)
+        job.update('indexing', embed_seconds=round(time.perf_counter() - started, 3))
+
+        documents, offset = [], 0
+        for position, chunks, writer in extracted:
+            upload = job.files[position]
+            document_vectors = vectors[offset:offset + len(chunks)]
+            offset += len(chunks)
+            documents.append({
+                'doc_id': upload['doc_id'],
+                'filename': upload['filename'],
+                'texts': [chunk['text'] for chunk in chunks],
+                'embeddings': document_vectors,
+                'offsets': [(chunk['start'], chunk['end']) for chunk in chunks],
+                'content_hash': upload['content_hash']
+            })
+            if writer:
+                writer.add(chunks, document_vectors)
+
+        started = time.perf_counter()
+        with rag_registry.write_lock(job.conversation_id):
+            conversation_index = ensure_conversation_index_loaded(job.conversation_id)
+            if conversation_index is None:
+                conversation_index = ConversationIndex(vectors.shape[1])
+            conversation_index.append_documents(documents)
+            saved = save_conversation_index(job.conversation_id, conversation_index)
+            rag_registry.put(job.conversation_id, conversation_index,
+                             conversation_index_mtime(job.conversation_id) if saved else None)
+        job.update(index_seconds=round(time.perf_counter() - started, 3))
+    except Exception:
+        for writer in writers:
+            writer.abort()
+        raise
+
+    for position, chunks, writer in extracted:
+        upload = job.files[position]
+        if writer:
+            writer.commit(upload['filename'])
+        job.update_file(position, status='ready')
+        schedule_document_summary(job.conversation_id, upload['doc_id'])
+
+    document_usage_tracker[job.conversation_id] = True
+    job.finish(f"Added {len(all_chunks)} chunks from {len(extracted)}/{len(job.files)} files "
+               f"({len(conversation_index.documents)} documents in conversation)")
+
+ingest_jobs = IngestJobManager(run_ingest_job, run_batch=run_batch_ingest_job, pdf_pool=pdf_worker_pool)
+
+# Document summaries, generated in the background after ingest and cached by content hash
+document_summarizer = DocumentSummarizer(
+    lambda prompt, max_tokens: call_gemini_ai(prompt, max_tokens=max_tokens, temperature=0.2))
+
+def document_summary_source(conversation_index, doc_id):
+    """(cache key, text loader) for one finished document's summary"""
+    if not conversation_index.is_ready(doc_id):
+        # A partial text must never be summarised under the whole file's content hash
+        raise ValueError(f"Document {doc_id} is still being ingested")
+    chunks = conversation_index.document_chunks(doc_id)
+    load_text = lambda: join_chunks(chunks)
+    return conversation_index.documents[doc_id].get('content_hash') or text_hash(load_text()), load_text
+
+def schedule_document_summary(conversation_id, doc_id):
+    if not SUMMARY_PRECOMPUTE:
+        return
+    conversation_index = ensure_conversation_index_loaded(conversation_id)
+    if conversation_index is None or not conversation_index.is_ready(doc_id):
+        return
+    document_summarizer.schedule(*document_summary_source(conversation_index, doc_id))
+
+def summarize_conversation_documents(conversation_id, deadline=None):
+    """Summary of each document in a conversation, from the summary cache where possible.
+
+    A summary that isn't ready before the deadline is replaced by an extractive one
+    (its job keeps running, so the next request gets the real summary).
+    """
+    conversation_index = ensure_conversation_index_loaded(conversation_id)
+    if conversation_index is None:
+        return None
+    parts = []
+    for doc_id, document in list(conversation_index.documents.items()):
+        if not conversation_index.is_ready(doc_id):
+            continue
+        key, load_text = document_summary_source(conversation_index, doc_id)
+        timeout = deadline.timeout() if deadline else None
+        summary = document_summarizer.summary(key, load_text, timeout=timeout) or extractive_summary(load_text())
+        if summary:
+            parts.append((document['filename'], summary))
+    if len(parts) == 1:
+        return parts[0][1]
+    return "\n\n".join(f"**{filename}**\n\n{summary}" for filename, summary in parts)
+
+@app.route('/upload/batch', methods=['POST'])
+def upload_batch():
+    """Several files ('files' fields) in one request, processed as one background job"""
+    try:
+        conversation_id = request.form.get('conversation_id')
+        if not conversation_id:
+            return jsonify({'status': 'error', 'error': 'Missing conversation_id'}), 400
+        uploads = [upload for upload in request.files.getlist('files') if upload and upload.filename]
+        if not uploads:
+            return jsonify({'status': 'error', 'error': 'No files provided'}), 400
+        if len(uploads) > INGEST_BATCH_MAX_FILES:
+            return jsonify({'status': 'error', 'error': f'At most {INGEST_BATCH_MAX_FILES} files per upload.'}), 400
+        rejected = [upload.filename for upload in uploads if not allowed_file(upload.filename)]
+        if rejected:
+            return jsonify({'status': 'error', 'error': f'File type not allowed: {", ".join(rejected)}. Use txt, pdf, doc, docx, or md files.'}), 400
+        if not RAG_AVAILABLE or not embedding_model:
+            return jsonify({
+                'status': 'error',
+                'error': 'Document upload is temporarily disabled. The system is running in web-only mode.'
+            }), 400
+
+        files, settled = [], []
+        for upload in uploads:
+            source, content_hash = spool_upload(upload.stream)
+            attached = attach_known_document(conversation_id, upload.filename, content_hash)
+            duplicate = next((f for f in files if f['content_hash'] == content_hash), None)
+            if attached or duplicate:
+                source.close()
+                settled.append({
+                    'filename': upload.filename,
+                    'doc_id': attached[0] if attached else duplicate['doc_id'],
+                    'status': 'ready' if attached else 'duplicate',
+                    'reused': True,
+                    'message': attached[1] if attached else f'Same content as {duplicate["filename"]}'
+                })
+                continue
+            files.append({'filename': upload.filename, 'doc_id': uuid.uuid4().hex[:12], 'source': source,
+                          'content_hash': content_hash, 'mime_type': upload.mimetype})
+
+        if not files:
+            return jsonify({'status': 'ready', 'files': settled}), 200
+        job = ingest_jobs.submit_batch(conversation_id, files)
+        if job is None:
+            for f in files:
+                f['source'].close()
+            return jsonify({'status': 'error', 'error': 'Too many documents are being processed. Please retry shortly.'}), 503
+
+        return jsonify({
+            'status': 'queued',
+            'message': f'{len(files)} files received and queued for processing.',
+            'job_id': job.job_id,
+            'status_url': f'/api/ingest/{job.job_id}',
+            'files': [{'filename': f['filename'], 'doc_id': f['doc_id'], 'status': 'queued'} for f in files] + settled
+        }), 202
+
+    except Exception as e:
+        print(f'❌ Batch upload error: {e}')
+        return jsonify({'status': 'error', 'error': f'Upload failed: {str(e)}'}), 500
+
+@app.route('/api/ingest/<job_id>', methods=['GET'])
+def ingest_job_status(job_id):
+    """Progress of a background upload: stage, pages and chunks done, final chunk count"""
+    job = ingest_jobs.get(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'error': 'Unknown job id'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/api/conversation/<conversation_id>/ingest', methods=['GET'])
+def conversation_ingest_jobs(conversation_id):
+    return jsonify({'jobs': [job.to_dict() for job in ingest_jobs.jobs_for_conversation(conversation_id)]})
+
 # Replace the handle_universal_search function:
 
 
 
+def resolve_conversation(query, user_email, conversation_id):
+    """The request's conversation (created if needed) and its context; saves the user's message"""
+    # Conversation context
+    conversation = None
+    conversation_context = ""
+    if conversation_manager and conversation_manager.supabase:
+        try:
+            if conversation_id:
+                print(f"🔄 Using existing conversation: {conversation_id}")
+                result = conversation_manager.supabase.table('conversations').select('*').eq('id', conversation_id).single().execute()
+                if result.data:
+                    conversation = result.data
+                    conversation_context = conversation_manager.build_conversation_context(conversation['id'])
+                    print(f"✅ Using existing conversation: {conversation['id']}")
+                else:
+                    print(f"❌ Conversation {conversation_id} not found, creating new one")
+                    conversation = conversation_manager.get_or_create_conversation(user_email, force_new=False)
+            else:
+                print("🆕 No conversation ID provided, getting or creating conversation")
+                conversation = conversation_manager.get_or_create_conversation(user_email, force_new=False)
+            if conversation:
+                conversation_manager.save_message(conversation['id'], 'user', query, 'general')
+                print(f"  Saved user message to conversation: {conversation['id']}")
+                if not conversation_context:
+                    conversation_context = conversation_manager.build_conversation_context(conversation['id'])
+        except Exception as e:
+            print(f"⚠️ Context error: {e}")
+            conversation = conversation_manager.get_or_create_conversation(user_email, force_new=True)
+    return conversation, conversation_context
+
+
+def answer_document_summary(conversation, deadline=None):
+    """Summary of the conversation's documents, usually precomputed at upload"""
+    docs = get_conversation_chunks(conversation['id'] if conversation else None)
+    if not docs or len(docs) == 0:
+        return "No document has been uploaded for this conversation yet."
+    # The LLM is only called if the summary isn't ready yet
+    summary = summarize_conversation_documents(conversation['id'] if conversation else None, deadline)
+    if not summary:
+        summary = "The document could not be summarized due to insufficient content."
+    if conversation and conversation['id'] in document_usage_tracker:
+        document_usage_tracker[conversation['id']] = False
+    return summary
+
+
+def document_web_query(query, rag_context):
+    """Web search query for a RAG answer: the document context if any was found, else the query"""
+    if rag_context and "No relevant" not in rag_context and "Document search error" not in rag_context:
+        doc_based_query = rag_context.split('|')[0][:200]
+        print(f"🌐 Using document context for web search: {doc_based_query}")
+        return doc_based_query
+    print("🌐 No relevant document context, using original query for web search.")
+    return query
+
+
+def generic_overview_response(query):
+    """Last-resort answer when no usable response could be generated"""
+    return f"Based on the current information about {query}, here's a comprehensive overview: " + \
+           f"The analysis shows multiple factors are relevant to understanding {query}. " + \
+           f"Current research indicates ongoing developments in this area. " + \
+           f"For more specific information, please provide additional context about what aspect interests you most."
+
+
+def web_only_fallback(query, web_results, conversation_context, deadline):
+    """Answer without the LLM: the guaranteed fallback if the deadline cut it off, else the generic overview"""
+    if deadline.remaining() < LLM_MIN_SECONDS:
+        return generate_guaranteed_fallback_response(query, web_results, None, conversation_context)
+    return generic_overview_response(query)
+
+
+def save_assistant_message(conversation, ai_response, query_type, web_results=None, rag_context=None):
+    if conversation_manager and conversation_manager.supabase and conversation:
+        try:
+            conversation_manager.save_message(
+                conversation['id'], 'assistant', ai_response, query_type,
+                web_results, rag_context, ai_response
+            )
+            print("✅ Saved response to conversation")
+        except Exception as e:
+            print(f"⚠️ Save error: {e}")
+
+
+def sse_event(event, data):
+    """One Server-Sent Events message"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+def wants_event_stream(data):
+    """Streaming is opt-in: {"stream": true} in the body or an Accept: text/event-stream header"""
+    return bool(data.get('stream')) or 'text/event-stream' in request.headers.get('Accept', '')
+
+
+def stream_answer(prompt, generation, fallback, min_chars=50, on_answer=None, deadline=None):
+    """Yield 'token' events as the answer is generated and return the full answer.
+
+    If the LLM fails, says too little or is skipped or cut off by the deadline,
+    fallback() is used instead and sent as a 'replace' event, which supersedes
+    any text already streamed. on_answer is called with the generated answer
+    only when it is used.
+    """
+    parts = []
+    for text in stream_gemini_ai(prompt, **generation, deadline=deadline):
+        parts.append(text)
+        yield sse_event('token', {'text': text})
+    ai_response = "".join(parts)
+    if len(ai_response.strip()) > min_chars:
+        if on_answer:
+            on_answer(ai_response)
+        return ai_response
+    print("⚠️ Streamed answer unusable, sending fallback response")
+    ai_response = fallback()
+    yield sse_event('replace', {'text': ai_response})
+    return ai_response
+
+
+def stream_universal_search(query, user_email, conversation_id, deadline):
+    """/api/news as Server-Sent Events.
+
+    Emits 'stage' events as each step finishes (conversation, website, rag,
+    web_search), 'token' events with the answer as Gemini generates it, and a
+    final 'done' event carrying the same fields as the JSON response. The full
+    answer is saved to the conversation before 'done' is sent. Stages share
+    the request's deadline like the JSON path.
+    """
+    try:
+        with deadline.stage('conversation'):
+            conversation, conversation_context = resolve_conversation(query, user_email, conversation_id)
+            if not conversation and conversation_manager:
+                # Retried before the first event so the client learns the conversation id up front
+                conversation = conversation_manager.get_or_create_conversation(user_email, force_new=True)
+        yield sse_event('stage', {'stage': 'conversation', 'conversation_id': conversation['id'] if conversation else None})
+
+        web_results, rag_context = None, None
+        if is_document_summary_query(query):
+            mode = query_type = 'document_summary'
+            ai_response = answer_document_summary(conversation, deadline)
+            yield sse_event('token', {'text': ai_response})
+        else:
+            website_data = None
+            detected_urls = detect_urls_in_query(query)
+            if detected_urls:
+                with deadline.stage('website'):
+                    website_data = fetch_website_content(detected_urls[0], deadline)
+                yield sse_event('stage', {'stage': 'website', 'status': 'done' if website_data else 'failed',
+                                          'url': detected_urls[0]})
+            if website_data:
+                mode = query_type = 'website_summary'
+                ai_response = create_website_summary_response(query, website_data, deadline)
+                yield sse_event('token', {'text': ai_response})
+            else:
+                docs = get_conversation_chunks(conversation['id'] if conversation else None)
+                doc_allowed = bool(conversation and document_usage_tracker.get(conversation['id']))
+                if docs and doc_allowed:
+                    mode = 'rag_search'
+                    with deadline.stage('rag'):
+                        rag_context = search_documents(query, 3, conversation['id'])
+                    document_usage_tracker[conversation['id']] = False
+                    yield sse_event('stage', {'stage': 'rag', 'status': 'done',
+                                              'context_length': len(rag_context) if rag_context else 0})
+                    web_results = get_universal_web_search(document_web_query(query, rag_context), 1, deadline)
+                    yield sse_event('stage', {'stage': 'web_search', 'status': 'done', 'results': len(web_results)})
+                    used_rag = rag_context and "No relevant" not in rag_context and "Document search error" not in rag_context
+                    query_type = 'rag_search' if used_rag else 'general'
+                    prompt = create_rag_answer_prompt(query, web_results, rag_context, conversation_context)
+                    ai_response = yield from stream_answer(
+                        prompt, RAG_ANSWER_GENERATION, lambda: create_comprehensive_web_response(query, web_results),
+                        deadline=deadline)
+                else:
+                    mode = query_type = 'web_search_only'
+                    ai_response = cached_web_answer(query)
+                    if ai_response:
+                        yield sse_event('stage', {'stage': 'answer_cache', 'status': 'hit'})
+                        yield sse_event('token', {'text': ai_response})
+                    else:
+                        started = time.time()
+                        # Shared (cached) answers come from a prompt without this user's conversation
+                        prompt_context = "" if is_shared_web_query(query) else conversation_context
+                        web_results = get_universal_web_search(query, num_results=5, deadline=deadline)
+                        yield sse_event('stage', {'stage': 'web_search', 'status': 'done', 'results': len(web_results)})
+                        prompt = create_web_only_prompt(query, web_results, prompt_context)
+                        ai_response = yield from stream_answer(
+                            prompt, WEB_ONLY_GENERATION,
+                            lambda: web_only_fallback(query, web_results, conversation_context, deadline), min_chars=10,
+                            on_answer=lambda answer: cache_web_answer(query, answer, time.time() - started,
+                                                                      prompt_context),
+                            deadline=deadline)
+
+        with deadline.stage('save'):
+            save_assistant_message(conversation, ai_response, query_type, web_results, rag_context)
+        yield sse_event('done', {
+            'status': 'success',
+            'result': ai_response,
+            'ai_response': ai_response,
+            'web_results': web_results,
+            'rag_context': rag_context,
+            'conversation_id': conversation['id'] if conversation else None,
+            'mode': mode,
+            'latency': deadline.finish(),
+            'timestamp': datetime.now().isoformat()
+        })
+    except Exception as e:
+        print(f"❌ Error in stream_universal_search: {e}")
+        traceback.print_exc()
+        message = f"I encountered an error while processing your query about {query}. Please try again or rephrase your question."
+        yield sse_event('error', {'status': 'error', 'error': f'Search failed: {e}', 'result': message, 'ai_response': message,
+                                  'latency': deadline.finish()})
+
+
 @app.route('/api/news', methods=['POST'])
 def handle_universal_search():
     print("==== /api/news endpoint called ====")
     sys.stdout.flush()
+    # Latency budget for the whole request; each stage's timeout comes out of it
+    deadline = Deadline(NEWS_DEADLINE_SECONDS, news_deadline_stats)
     try:
         data = request.get_json()
         query = data.get('query', 'latest information')
@@ -1602,60 +2167,21 @@ def handle_universal_search():
         print(f"👤 User: {user_email}")
         print(f"💬 Conversation ID: {conversation_id}")
 
-        # Conversation context
-        conversation = None
-        conversation_context = ""
-        if conversation_manager and conversation_manager.supabase:
-            try:
-                if conversation_id:
-                    print(f"🔄 Using existing conversation: {conversation_id}")
-                    result = conversation_manager.supabase.table('conversations').select('*').eq('id', conversation_id).single().execute()
-                    if result.data:
-                        conversation = result.data
-                        conversation_context = conversation_manager.build_conversation_context(conversation['id'])
-                        print(f"✅ Using existing conversation: {conversation['id']}")
-                    else:
-                        print(f"❌ Conversation {conversation_id} not found, creating new one")
-                        conversation = conversation_manager.get_or_create_conversation(user_email, force_new=False)
-                else:
-                    print("🆕 No conversation ID provided, getting or creating conversation")
-                    conversation = conversation_manager.get_or_create_conversation(user_email, force_new=False)
-                if conversation:
-                    conversation_manager.save_message(conversation['id'], 'user', query, 'general')
-                    print(f"  Saved user message to conversation: {conversation['id']}")
-                    if not conversation_context:
-                        conversation_context = conversation_manager.build_conversation_context(conversation['id'])
-            except Exception as e:
-                print(f"⚠️ Context error: {e}")
-                conversation = conversation_manager.get_or_create_conversation(user_email, force_new=True)
+        if wants_event_stream(data):
+            print("📡 Streaming response as Server-Sent Events")
+            return Response(stream_with_context(stream_universal_search(query, user_email, conversation_id, deadline)),
+                            mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+        with deadline.stage('conversation'):
+            conversation, conversation_context = resolve_conversation(query, user_email, conversation_id)
 
         print(f"DEBUG: Query for summary detection: '{query}'")
         print(f"DEBUG: is_document_summary_query: {is_document_summary_query(query)}")
 
         if is_document_summary_query(query):
             print("📝 Detected document summary query!")
-            docs = conversation_documents.get(conversation['id'] if conversation else None, [])
-            if not docs or len(docs) == 0:
-                ai_response = "No document has been uploaded for this conversation yet."
-            else:
-                doc_text = " ".join([chunk['text'] for chunk in docs])
-                doc_text = doc_text[:4000]
-                prompt = (
-                    "Summarize the following document in 2-3 clear, well-structured paragraphs. "
-                    "Focus on the main topics and key details. Separate each paragraph with a blank line.\n\n"
-                    f"{doc_text}"
-                )
-                summary = call_gemini_ai(prompt, max_tokens=500)
-                if not summary or len(summary.strip().split()) < 20:
-                    sentences = re.split(r'(?<=[.!?])\s+', doc_text)
-                    filtered = [s.strip() for s in sentences if len(s.strip()) > 40]
-                    summary = " ".join(filtered[:6])
-                    if not summary:
-                        summary = "The document could not be summarized due to insufficient content."
-                ai_response = summary
-                # --- ADD THIS LINE ---
-                if conversation and conversation['id'] in document_usage_tracker:
-                    document_usage_tracker[conversation['id']] = False
+            ai_response = answer_document_summary(conversation, deadline)
             if conversation_manager and conversation_manager.supabase and conversation:
                 try:
                     conversation_manager.save_message(
@@ -1670,15 +2196,17 @@ def handle_universal_search():
                 'ai_response': ai_response,
                 'mode': 'document_summary',
                 'conversation_id': conversation['id'] if conversation else None,
+                'latency': deadline.finish(),
             })
 
         detected_urls = detect_urls_in_query(query)
         if detected_urls:
             print(f"🌐 WEBSITE MODE: Found {len(detected_urls)} URL(s) in query")
-            website_data = fetch_website_content(detected_urls[0])
+            with deadline.stage('website'):
+                website_data = fetch_website_content(detected_urls[0], deadline)
             if website_data:
                 print("✅ Successfully fetched website content")
-                ai_response = create_website_summary_response(query, website_data)
+                ai_response = create_website_summary_response(query, website_data, deadline)
                 response_data = {
                     'status': 'success',
                     'result': ai_response,
@@ -1697,6 +2225,7 @@ def handle_universal_search():
                         'content_length': len(website_data.get('content', '')),
                         'response_length': len(ai_response)
                     },
+                    'latency': deadline.finish(),
                     'timestamp': datetime.now().isoformat()
                 }
                 if conversation_manager and conversation_manager.supabase and conversation:
@@ -1714,7 +2243,7 @@ def handle_universal_search():
                 print("❌ Failed to fetch website content, falling back to regular search")
 
         # --- KEY CHANGE: Only use RAG if a document is uploaded for this conversation ---
-        docs = conversation_documents.get(conversation['id'] if conversation else None, [])
+        docs = get_conversation_chunks(conversation['id'] if conversation else None)
         doc_allowed = False
         if conversation and conversation['id'] in document_usage_tracker and document_usage_tracker[conversation['id']]:
             doc_allowed = True
@@ -1722,27 +2251,18 @@ def handle_universal_search():
             conversation = conversation_manager.get_or_create_conversation(user_email, force_new=True)
         if docs and len(docs) > 0 and doc_allowed:
             print("🔄 STEP 1: Document Analysis (RAG)...")
-            rag_context = search_documents(query, 3, conversation['id'] if conversation else None)
+            with deadline.stage('rag'):
+                rag_context = search_documents(query, 3, conversation['id'] if conversation else None)
             print(f"✅ STEP 1 Complete: RAG context length: {len(rag_context) if rag_context else 0}")
             document_usage_tracker[conversation['id']] = False
-            # If RAG context found, use it as the new query for web search
-            if rag_context and "No relevant" not in rag_context and "Document search error" not in rag_context:
-                doc_based_query = rag_context.split('|')[0][:200]
-                print(f"🌐 Using document context for web search: {doc_based_query}")
-                web_results = get_universal_web_search(doc_based_query, 1)
-            else:
-                print("🌐 No relevant document context, using original query for web search.")
-                web_results = get_universal_web_search(query, 1)
+            web_results = get_universal_web_search(document_web_query(query, rag_context), 1, deadline)
             print(f"✅ STEP 2 Complete: Found {len(web_results)} web results")
 
             print("🔄 STEP 3: AI Response Generation...")
-            ai_response = debug_response_generation(query, web_results, rag_context, conversation_context)
+            ai_response = debug_response_generation(query, web_results, rag_context, conversation_context, deadline)
             if not ai_response or len(ai_response.strip()) < 10:
                 print("❌ AI response is empty or too short, generating fallback...")
-                ai_response = f"Based on the current information about {query}, here's a comprehensive overview: " + \
-                             f"The analysis shows multiple factors are relevant to understanding {query}. " + \
-                             f"Current research indicates ongoing developments in this area. " + \
-                             f"For more specific information, please provide additional context about what aspect interests you most."
+                ai_response = generic_overview_response(query)
             print(f"✅ STEP 3 Complete: Generated response length: {len(ai_response)} chars")
             print(f"📝 Response preview: {ai_response[:150]}...")
 
@@ -1780,6 +2300,7 @@ def handle_universal_search():
                     'conversation_context_available': len(conversation_context) > 0,
                     'conversation_id': conversation['id'] if conversation else None
                 },
+                'latency': deadline.finish(),
                 'timestamp': datetime.now().isoformat()
             }
             print("✅ Response generated successfully - sending to frontend")
@@ -1788,12 +2309,9 @@ def handle_universal_search():
         else:
             # No document uploaded: ONLY use Gemini AI for direct answer (web-like)
             print("📄 No document uploaded for this conversation. Using Gemini AI web-only mode.")
-            ai_response = call_gemini_ai_web_only(query, conversation_context)
+            ai_response = call_gemini_ai_web_only(query, conversation_context, deadline)
             if not ai_response or len(ai_response.strip()) < 10:
-                ai_response = f"Based on the current information about {query}, here's a comprehensive overview: " + \
-                             f"The analysis shows multiple factors are relevant to understanding {query}. " + \
-                             f"Current research indicates ongoing developments in this area. " + \
-                             f"For more specific information, please provide additional context about what aspect interests you most."
+                ai_response = generic_overview_response(query)
             if conversation_manager and conversation_manager.supabase and conversation:
                 try:
                     conversation_manager.save_message(
@@ -1824,6 +2342,7 @@ def handle_universal_search():
                     'conversation_context_available': len(conversation_context) > 0,
                     'conversation_id': conversation['id'] if conversation else None
                 },
+                'latency': deadline.finish(),
                 'timestamp': datetime.now().isoformat()
             }
             print("✅ Web-only Gemini response generated successfully - sending to frontend")
@@ -1838,7 +2357,8 @@ def handle_universal_search():
             'status': 'error',
             'error': f'Search failed: {error_msg}',
             'result': f"I encountered an error while processing your query about {query}. Please try again or rephrase your question.",
-            'ai_response': f"I encountered an error while processing your query about {query}. Please try again or rephrase your question."
+            'ai_response': f"I encountered an error while processing your query about {query}. Please try again or rephrase your question.",
+            'latency': deadline.finish()
         })
 # ...existing code...
 # Complete the missing API endpoints
@@ -1895,12 +2415,50 @@ def delete_conversation(conversation_id):
             return jsonify({'error': 'Service unavailable'}), 503
 
         success = conversation_manager.archive_conversation(conversation_id)
+        if success:
+            # Archived conversations are no longer queried; free their in-process RAG state now
+            rag_registry.discard(conversation_id, reason='archived')
+            document_usage_tracker.pop(conversation_id, None)
         return jsonify({'success': success})
 
     except Exception as e:
         print(f"❌ Error deleting conversation: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/conversation/<conversation_id>/documents', methods=['GET'])
+def list_conversation_documents(conversation_id):
+    try:
+        conversation_index = ensure_conversation_index_loaded(conversation_id)
+        if conversation_index is None:
+            return jsonify({'documents': []})
+        return jsonify({'documents': conversation_index.list_documents()})
+
+    except Exception as e:
+        print(f"❌ Error listing conversation documents: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/conversation/<conversation_id>/documents/<doc_id>', methods=['DELETE'])
+def delete_conversation_document(conversation_id, doc_id):
+    try:
+        removed = remove_document_from_rag(conversation_id, doc_id)
+        if not removed:
+            return jsonify({'success': False, 'error': 'Document not found'}), 404
+        return jsonify({'success': True, 'removed_chunks': removed})
+
+    except Exception as e:
+        print(f"❌ Error deleting conversation document: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/rag/state', methods=['GET'])
+def rag_state():
+    """Resident conversation indexes, their sizes and eviction counts"""
+    try:
+        return jsonify(rag_registry.stats())
+
+    except Exception as e:
+        print(f"❌ Error reading RAG state: {e}")
+        return jsonify({'error': str(e)}), 500
+
 # CORS support
 @app.after_request
 def after_request(response):
@@ -1941,14 +2499,29 @@ def index():
     return jsonify({
         'status': 'online',
         'message': 'AI Agent Backend is running!',
-        'endpoints': ['/api/news', '/upload', '/api/conversations', '/health'],
-        'features': ['web_search', 'rag_documents', 'website_content_fetching', 'conversation_history']
+        'endpoints': ['/api/news', '/upload', '/upload/batch', '/api/ingest/<job_id>', '/api/conversations', '/api/metrics', '/api/rag/state', '/health'],
+        'features': ['web_search', 'rag_documents', 'website_content_fetching', 'conversation_history', 'streaming_answers']
     })
 
 @app.route('/health')
 def health():
     return jsonify({'status': 'healthy', 'timestamp': datetime.now().isoformat()})
 
+@app.route('/api/metrics')
+def metrics():
+    """Runtime counters for tuning the embedding layer"""
+    return jsonify({
+        'embedding_cache': embedding_cache.stats() if embedding_cache else None,
+        'query_batcher': query_batcher.stats() if query_batcher else None,
+        'ingest': ingest_jobs.stats(),
+        'artifacts': artifact_store.stats() if artifact_store else None,
+        'summaries': document_summarizer.stats(),
+        'answer_cache': answer_cache.stats() if answer_cache else None,
+        'deadlines': news_deadline_stats.stats(),
+        'llm': get_llm_client().stats(),
+        'timestamp': datetime.now().isoformat()
+    })
+
 # URL detection and website content fetching functions
 def detect_urls_in_query(query):
     """Detect if the query contains website URLs with enhanced YouTube detection"""
@@ -1997,12 +2570,12 @@ def detect_urls_in_query(query):
     return found_urls
 
 
-def fetch_website_content(url):
+def fetch_website_content(url, deadline=None):
     print(f"🌐 Fetching content from: {url}")
 
     # Try newspaper3k first
     try:
-        article = Article(url)
+        article = Article(url, request_timeout=deadline.timeout(7) if deadline else 7)
         article.download()
         article.parse()
         text = article.text
@@ -2023,6 +2596,8 @@ def fetch_website_content(url):
         print("⚠️ Falling back to Selenium + BeautifulSoup...")
 
     # Fallback: Selenium + BeautifulSoup (your existing code)
+    if deadline is not None and not deadline.allows('website_browser', BROWSER_MIN_SECONDS):
+        return None
     try:
         chrome_options = Options()
         chrome_options.add_argument("--headless")
@@ -2031,10 +2606,12 @@ def fetch_website_content(url):
         chrome_options.add_argument("--window-size=1920,1080")
         chrome_options.add_argument("--disable-dev-shm-usage")
         driver = webdriver.Chrome(options=chrome_options)
+        if deadline is not None:
+            driver.set_page_load_timeout(max(deadline.timeout(), 1))
 
         print("🚗 ChromeDriver started, loading URL...")
         driver.get(url)
-        time.sleep(3)
+        time.sleep(min(3, deadline.timeout()) if deadline else 3)
         print("✅ Page loaded, extracting HTML...")
         html = driver.page_source
         driver.quit()
@@ -2494,7 +3071,7 @@ def extract_general_website_content(soup, url):
         print(f"❌ Error extracting general website content: {e}")
         return None
     
-def create_website_summary_response(query, website_data):
+def create_website_summary_response(query, website_data, deadline=None):
     """Create a comprehensive and accurate summary of website content using AI"""
     print(f"📝 Creating AI-powered website summary response...")
 
@@ -2513,11 +3090,11 @@ def create_website_summary_response(query, website_data):
         return f"I was able to access the website '{title}' but couldn't extract enough readable content to provide a summary."
 
     # Fallback to structured summary if content is present
-    return create_structured_website_fallback(query, website_data)
+    return create_structured_website_fallback(query, website_data, deadline)
 
 
 
-def create_structured_website_fallback(query, website_data):
+def create_structured_website_fallback(query, website_data, deadline=None):
     """Create comprehensive structured fallback summary when AI fails"""
     import re
     from datetime import datetime
@@ -2542,7 +3119,7 @@ def create_structured_website_fallback(query, website_data):
           f"Summarize the following website content in 2-3 clear, well-structured paragraphs. "
     f"Focus on the main topics and key details. Separate each paragraph with a blank line.\n\n{content[:1500]}"
         )
-        summary_text = call_gemini_ai(ai_prompt, max_tokens=300)
+        summary_text = call_gemini_ai(ai_prompt, max_tokens=300, temperature=0.2, deadline=deadline)
         # Ensure the summary is at least two paragraphs
         if summary_text and isinstance(summary_text, str) and len(summary_text.strip().split()) > 20:
             # If Gemini returns only one paragraph, split after 2-3 sentences for readability
@@ -0,0 +1,750 @@
+"""
+Per-conversation RAG indexes and their on-disk persistence.
+
+Each conversation owns a ConversationIndex: an ID-mapped FAISS index plus a chunk
+registry keyed by document id. Uploads append only their own chunks and removing
+a document deletes just its vector IDs, so nothing else is re-embedded.
+
+The index type follows corpus size: small conversations stay on an exact flat
+index, larger ones are migrated to IVF (or HNSW when configured) with tuned
+nprobe/efSearch so search latency stays flat as chunk counts grow.
+
+Next to the vectors sits a BM25 keyword index (see lexical.py); searches fuse
+both rankings so exact identifiers that embeddings blur still surface.
+
+Loaded indexes are held by a RagStateRegistry with a byte budget and LRU/TTL
+eviction. With persistence enabled an evicted index is simply reloaded (mmap)
+on its next use.
+
+Indexes are persisted under RAG_INDEX_DIR so uploaded documents survive restarts
+and scale-outs. They are loaded back lazily with memory-mapped, read-only reads,
+which lets several workers share the same files without copying them into RAM.
+"""
+import os
+import re
+import sys
+import time
+import math
+import json
+import tempfile
+import weakref
+import threading
+from datetime import datetime
+from collections import OrderedDict
+import numpy as np
+import faiss
+
+from lexical import LexicalIndex, tokenize, identifier_terms, reciprocal_rank_fusion
+
+RAG_INDEX_DIR = os.getenv('RAG_INDEX_DIR', os.path.join(tempfile.gettempdir(), "rag_indexes"))
+RAG_PERSISTENCE_ENABLED = os.getenv('RAG_PERSISTENCE', 'true').lower() in ('1', 'true', 'yes')
+
+INDEX_FILENAME = "index.faiss"
+CHUNKS_FILENAME = "chunks.json"
+LEXICAL_FILENAME = "lexical.npz"
+
+if RAG_PERSISTENCE_ENABLED:
+    os.makedirs(RAG_INDEX_DIR, exist_ok=True)
+
+# In-process residency: total bytes of loaded conversation state, and idle time before eviction
+RAG_MEMORY_BUDGET_MB = int(os.getenv('RAG_MEMORY_BUDGET_MB', '512'))
+RAG_STATE_TTL_SECONDS = int(os.getenv('RAG_STATE_TTL_SECONDS', '3600'))
+CHUNK_OVERHEAD_BYTES = 240   # chunk dict, its keys and registry slot, beyond the text itself
+
+# Hybrid retrieval: fuse dense and BM25 rankings (false = dense only)
+RAG_HYBRID_SEARCH = os.getenv('RAG_HYBRID_SEARCH', 'true').lower() in ('1', 'true', 'yes')
+HYBRID_CANDIDATES = 20   # per-ranker candidates fed into reciprocal-rank fusion
+
+# Index selection: 'auto' picks flat below RAG_ANN_THRESHOLD chunks and IVF above it
+RAG_INDEX_TYPE = os.getenv('RAG_INDEX_TYPE', 'auto').lower()
+RAG_ANN_THRESHOLD = int(os.getenv('RAG_ANN_THRESHOLD', '4096'))
+RAG_IVF_NPROBE = int(os.getenv('RAG_IVF_NPROBE', '0'))       # 0 = derive from nlist
+RAG_HNSW_M = int(os.getenv('RAG_HNSW_M', '32'))
+RAG_HNSW_EF_SEARCH = int(os.getenv('RAG_HNSW_EF_SEARCH', '64'))
+RAG_HNSW_EF_CONSTRUCTION = int(os.getenv('RAG_HNSW_EF_CONSTRUCTION', '80'))
+
+# Vector storage: 'none' (float32), 'fp16', 'int8' (scalar quantized) or 'pq' (product quantized)
+RAG_EMBEDDING_COMPRESSION = os.getenv('RAG_EMBEDDING_COMPRESSION', 'none').lower()
+RAG_PQ_M = int(os.getenv('RAG_PQ_M', '48'))                  # PQ sub-quantizers (bytes per vector)
+
+COMPRESSION_STORAGE = {'none': 'Flat', 'fp16': 'SQfp16', 'int8': 'SQ8', 'pq': 'PQ'}
+
+# PQ codebooks need a few hundred vectors per centroid set; smaller corpora use int8 meanwhile
+PQ_MIN_TRAINING_POINTS = 1024
+
+# A trained index (IVF, int8, PQ) is re-trained once the corpus grows this much past its training size
+RETRAIN_GROWTH = 4
+
+
+def choose_index_type(ntotal):
+    """Pick the index type for a corpus of ntotal chunks"""
+    if RAG_INDEX_TYPE in ('flat', 'ivf', 'hnsw'):
+        return RAG_INDEX_TYPE if ntotal >= RAG_ANN_THRESHOLD else 'flat'
+    return 'ivf' if ntotal >= RAG_ANN_THRESHOLD else 'flat'
+
+
+def choose_compression(ntotal):
+    """Pick the vector storage mode for a corpus of ntotal chunks"""
+    compression = RAG_EMBEDDING_COMPRESSION if RAG_EMBEDDING_COMPRESSION in COMPRESSION_STORAGE else 'none'
+    if compression == 'pq' and ntotal < PQ_MIN_TRAINING_POINTS:
+        return 'int8'
+    return compression
+
+
+def ivf_nlist(ntotal):
+    """Number of IVF lists: ~sqrt(n) keeps list scans short while training stays cheap"""
+    return max(16, min(4096, int(math.sqrt(ntotal))))
+
+
+def ivf_nprobe(nlist):
+    """Lists probed per query; ~nlist/8 keeps recall@10 above 0.95 on MiniLM embeddings"""
+    return RAG_IVF_NPROBE or max(8, nlist // 8)
+
+
+def needs_training(index_type, compression):
+    return index_type == 'ivf' or compression in ('int8', 'pq')
+
+
+def pq_subquantizers(dimension):
+    """Largest sub-quantizer count <= RAG_PQ_M that divides the embedding dimension"""
+    return next(m for m in range(min(RAG_PQ_M, dimension), 0, -1) if dimension % m == 0)
+
+
+def index_description(index_type, compression, ntotal, dimension):
+    """faiss.index_factory string for an index type and storage mode"""
+    storage = COMPRESSION_STORAGE[compression]
+    if compression == 'pq':
+        # 'np' skips polysemous training, which is orders of magnitude slower and unused here
+        storage = f"PQ{pq_subquantizers(dimension)}np"
+    if index_type == 'ivf':
+        return f"IVF{ivf_nlist(ntotal)},{storage}"
+    if index_type == 'hnsw':
+        return f"HNSW{RAG_HNSW_M},{storage}"
+    return storage
+
+
+def apply_search_params(index):
+    """Set runtime search parameters (nprobe / efSearch) from the current config"""
+    base = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap2) else index
+    try:
+        ivf = faiss.extract_index_ivf(base)
+        ivf.nprobe = ivf_nprobe(ivf.nlist)
+        return index
+    except RuntimeError:
+        pass
+    if isinstance(base, faiss.IndexHNSW):
+        base.hnsw.efSearch = RAG_HNSW_EF_SEARCH
+    return index
+
+
+def build_index(index_type, dimension, vectors, ids, compression='none'):
+    """Build an ID-addressable inner-product index, training it on vectors when needed"""
+    description = index_description(index_type, compression, len(vectors), dimension)
+    index = faiss.index_factory(dimension, description, faiss.METRIC_INNER_PRODUCT)
+    if index_type == 'hnsw':
+        index.hnsw.efConstruction = RAG_HNSW_EF_CONSTRUCTION
+    if not index.is_trained:
+        index.train(vectors)
+
+    if index_type == 'ivf':
+        # Hashtable direct map keeps reconstruct() working after remove_ids()
+        index.set_direct_map_type(faiss.DirectMap.Hashtable)
+    else:
+        index = faiss.IndexIDMap2(index)
+
+    apply_search_params(index)
+    index.add_with_ids(vectors, ids)
+    return index
+
+
+class ConversationIndex:
+    """ID-mapped FAISS index for one conversation with a chunk registry keyed by document id"""
+
+    def __init__(self, dimension, index=None, chunks=None, documents=None, next_id=0, read_only=False,
+                 index_type='flat', compression='none', trained_size=0, lexical=None):
+        self.dimension = dimension
+        self.index = index                  # built on first add, when there is data to train on
+        self.index_type = index_type        # 'flat', 'ivf' or 'hnsw'
+        self.compression = compression      # 'none', 'fp16', 'int8' or 'pq'
+        self.trained_size = trained_size    # corpus size the current index was built for
+        self.chunks = chunks or {}          # {chunk_id: {'text', 'filename', 'doc_id', 'start', 'end'}}
+        self.documents = documents or {}    # {doc_id: {'filename', 'chunk_ids', 'added_at', 'content_hash', 'status'}}
+        self.next_id = next_id              # chunk ids are never reused
+        self.read_only = read_only          # True while backed by a shared mmap'd file
+        self.lexical = lexical if lexical is not None else LexicalIndex.from_chunks(self.documents, self.chunks)
+        self.lock = threading.RLock()
+
+    @property
+    def ntotal(self):
+        return int(self.index.ntotal) if self.index is not None else 0
+
+    def _ensure_writable(self):
+        # A memory-mapped index is shared read-only; mutate a private in-memory copy instead
+        if self.read_only and self.index is not None:
+            self.index = faiss.deserialize_index(faiss.serialize_index(self.index))
+            self.read_only = False
+
+    def _rebuild(self, index_type, compression, pending=None):
+        """Move every live vector, plus pending (vectors, ids) not yet indexed, into a fresh index"""
+        pending_ids = set(pending[1].tolist()) if pending else set()
+        ids = np.array([cid for cid in sorted(self.chunks) if cid not in pending_ids], dtype=np.int64)
+        vectors = (self.index.reconstruct_batch(ids) if len(ids)
+                   else np.zeros((0, self.dimension), dtype=np.float32))
+        if pending:
+            vectors = np.vstack([vectors, pending[0]])
+            ids = np.concatenate([ids, pending[1]])
+
+        if not len(ids):
+            self.index, self.index_type, self.compression, self.trained_size = None, 'flat', 'none', 0
+            return
+        if self.index is not None:
+            print(f"🔁 Rebuilding conversation index: {self.index_type}/{self.compression} → "
+                  f"{index_type}/{compression} ({len(ids)} chunks)")
+        self.index = build_index(index_type, self.dimension, vectors, ids, compression)
+        self.index_type = index_type
+        self.compression = compression
+        self.trained_size = len(ids)
+
+    def _target_layout(self, ntotal):
+        return choose_index_type(ntotal), choose_compression(ntotal)
+
+    def _maybe_rebuild(self):
+        index_type, compression = self._target_layout(self.ntotal)
+        if (index_type, compression) != (self.index_type, self.compression):
+            self._rebuild(index_type, compression)
+        elif (needs_training(index_type, compression)
+              and self.ntotal > RETRAIN_GROWTH * max(self.trained_size, 1)):
+            # The corpus outgrew its training sample; re-train so clusters/quantizers stay accurate
+            self._rebuild(index_type, compression)
+
+    def add_document(self, doc_id, filename, texts, embeddings, offsets=None, content_hash=None):
+        """Add (or replace) one document's chunks; only these embeddings are added to the index"""
+        with self.lock:
+            if doc_id in self.documents:
+                self.remove_document(doc_id)
+            return self.append_chunks(doc_id, filename, texts, embeddings, offsets, content_hash)
+
+    def append_chunks(self, doc_id, filename, texts, embeddings, offsets=None, content_hash=None, pending=False):
+        """Add a batch of chunks to a document, creating it on the first batch (streaming ingest).
+
+        offsets, if given, are each chunk's (start, end) character span in the document text;
+        content_hash identifies the uploaded file so a re-upload can be recognised.
+        pending creates the document hidden from search until mark_ready() is called,
+        so a half-ingested upload is never searched or summarised.
+        """
+        with self.lock:
+            self._ensure_writable()
+            chunk_ids = self._register_chunks(doc_id, filename, texts, offsets, content_hash,
+                                              'pending' if pending else 'ready')
+            self._add_vectors(embeddings, chunk_ids)
+            return chunk_ids.tolist()
+
+    def append_documents(self, documents):
+        """Add several documents with a single index update (batch upload).
+
+        documents are dicts with doc_id, filename, texts, embeddings and optionally
+        offsets and content_hash; returns {doc_id: chunk_ids}.
+        """
+        with self.lock:
+            self._ensure_writable()
+            added = {}
+            for document in documents:
+                added[document['doc_id']] = self._register_chunks(
+                    document['doc_id'], document['filename'], document['texts'],
+                    document.get('offsets'), document.get('content_hash'))
+            if added:
+                self._add_vectors(np.vstack([document['embeddings'] for document in documents]),
+                                  np.concatenate(list(added.values())))
+            return {doc_id: chunk_ids.tolist() for doc_id, chunk_ids in added.items()}
+
+    def _register_chunks(self, doc_id, filename, texts, offsets=None, content_hash=None, status='ready'):
+        # Chunk registry, document record and BM25 postings; vectors are added separately
+        chunk_ids = np.arange(self.next_id, self.next_id + len(texts), dtype=np.int64)
+        self.next_id += len(texts)
+
+        for i, (chunk_id, text) in enumerate(zip(chunk_ids.tolist(), texts)):
+            chunk = self.chunks[chunk_id] = {'text': text, 'filename': filename, 'doc_id': doc_id}
+            if offsets is not None:
+                chunk['start'], chunk['end'] = offsets[i]
+        document = self.documents.setdefault(doc_id, {
+            'filename': filename,
+            'chunk_ids': [],
+            'added_at': datetime.now().isoformat(),
+            'content_hash': content_hash,
+            'status': status
+        })
+        document['chunk_ids'].extend(chunk_ids.tolist())
+        self.lexical.add_document(doc_id, chunk_ids.tolist(), texts)
+        return chunk_ids
+
+    def _add_vectors(self, embeddings, chunk_ids):
+        # Normalised in a private copy: callers may pass read-only (memory-mapped) arrays
+        vectors = np.array(embeddings, dtype=np.float32, order='C')
+        faiss.normalize_L2(vectors)
+        if self.index is None:
+            # First vectors for this conversation: train (if needed) on them and build
+            self._rebuild(*self._target_layout(len(self.chunks)), pending=(vectors, chunk_ids))
+        else:
+            self.index.add_with_ids(vectors, chunk_ids)
+            self._maybe_rebuild()
+
+    def remove_document(self, doc_id):
+        """Delete one document's vector IDs and chunks; returns the number of chunks removed"""
+        with self.lock:
+            document = self.documents.pop(doc_id, None)
+            if not document:
+                return 0
+            self._ensure_writable()
+            chunk_ids = document['chunk_ids']
+            for chunk_id in chunk_ids:
+                self.chunks.pop(chunk_id, None)
+            self.lexical.remove_document(doc_id)
+            if self.index_type == 'hnsw':
+                # HNSW graphs cannot delete nodes, so rebuild from the remaining vectors
+                self._rebuild(*self._target_layout(len(self.chunks)))
+            else:
+                self.index.remove_ids(np.array(chunk_ids, dtype=np.int64))
+                self._maybe_rebuild()
+            return len(chunk_ids)
+
+    def mark_ready(self, doc_id):
+        """Make a pending (streamed) document visible once all its chunks are indexed"""
+        with self.lock:
+            document = self.documents.get(doc_id)
+            if document:
+                document['status'] = 'ready'
+
+    def is_ready(self, doc_id):
+        document = self.documents.get(doc_id)
+        # Indexes saved before documents had a status only ever held finished uploads
+        return bool(document) and document.get('status', 'ready') == 'ready'
+
+    def _visible(self, chunk_id):
+        # The chunk, unless it was removed or belongs to a document still being ingested
+        chunk = self.chunks.get(chunk_id)
+        return chunk if chunk is not None and self.is_ready(chunk['doc_id']) else None
+
+    def _dense_search(self, query_embedding, top_k):
+        if self.ntotal == 0:
+            return []
+        query = np.array(query_embedding, dtype=np.float32, order='C').reshape(1, -1)
+        faiss.normalize_L2(query)
+        with self.lock:
+            scores, ids = self.index.search(query, min(top_k, self.ntotal))
+            return [(float(score), int(chunk_id))
+                    for score, chunk_id in zip(scores[0], ids[0])
+                    if chunk_id != -1 and self._visible(int(chunk_id)) is not None]
+
+    def search(self, query_embedding, top_k=3):
+        """Return [(score, chunk)] for the closest chunks to an (unnormalized) query embedding"""
+        return [(score, self.chunks[chunk_id]) for score, chunk_id in self._dense_search(query_embedding, top_k)]
+
+    def hybrid_search(self, query_text, embed_query, top_k=3, min_dense_score=0.10):
+        """Return [(rrf_score, chunk)] fusing dense and BM25 rankings.
+
+        embed_query() is only called when needed: a query whose identifiers
+        (quoted phrases, compound codes) all appear in the best keyword hit is
+        answered from BM25 alone. Everything else is fused with the dense ranking.
+        """
+        if not RAG_HYBRID_SEARCH:
+            return [(score, chunk) for score, chunk in self.search(embed_query(), top_k)
+                    if score > min_dense_score]
+
+        candidates = max(HYBRID_CANDIDATES, top_k)
+        with self.lock:
+            lexical_hits = [(score, chunk_id) for score, chunk_id in self.lexical.search(query_text, candidates)
+                            if self._visible(chunk_id) is not None]
+        identifiers = identifier_terms(query_text)
+        if identifiers and lexical_hits:
+            best = self.chunks.get(lexical_hits[0][1])
+            if best and identifiers <= set(tokenize(best['text'])):
+                print(f"🔤 Lexical match for {sorted(identifiers)}, skipping query embedding")
+                return [(score, self.chunks[chunk_id]) for score, chunk_id in lexical_hits[:top_k]
+                        if chunk_id in self.chunks]
+
+        dense_ids = [chunk_id for score, chunk_id in self._dense_search(embed_query(), candidates)
+                     if score > min_dense_score]
+        fused = reciprocal_rank_fusion([dense_ids, [chunk_id for _, chunk_id in lexical_hits]])
+        return [(score, self.chunks[chunk_id]) for score, chunk_id in fused[:top_k] if chunk_id in self.chunks]
+
+    def memory_bytes(self, index_bytes=None):
+        """Resident size of this conversation: FAISS index, chunk registry and BM25 postings"""
+        with self.lock:
+            if index_bytes is None:
+                index_bytes = index_nbytes(self.index)
+            chunk_bytes = sum(sys.getsizeof(chunk['text']) + CHUNK_OVERHEAD_BYTES for chunk in self.chunks.values())
+            document_bytes = sum(sys.getsizeof(document['chunk_ids']) + 28 * len(document['chunk_ids'])
+                                 for document in self.documents.values())
+            return int(index_bytes + chunk_bytes + document_bytes + self.lexical.nbytes())
+
+    def ordered_chunks(self):
+        """All chunks of finished documents in upload order (documents first-to-last, chunks in reading order)"""
+        return [chunk for chunk in map(self._visible, sorted(self.chunks)) if chunk is not None]
+
+    def document_chunks(self, doc_id):
+        """One document's chunks in reading order"""
+        document = self.documents.get(doc_id)
+        if not document:
+            return []
+        return [self.chunks[chunk_id] for chunk_id in document['chunk_ids'] if chunk_id in self.chunks]
+
+    def find_document(self, content_hash):
+        """doc_id of a document uploaded from identical bytes, or None"""
+        for doc_id, document in self.documents.items():
+            if content_hash and document.get('content_hash') == content_hash:
+                return doc_id
+        return None
+
+    def list_documents(self):
+        return [{
+            'doc_id': doc_id,
+            'filename': document['filename'],
+            'chunks': len(document['chunk_ids']),
+            'added_at': document.get('added_at'),
+            'content_hash': document.get('content_hash'),
+            'status': document.get('status', 'ready')
+        } for doc_id, document in self.documents.items()]
+
+    def to_payload(self):
+        return {
+            'dimension': self.dimension,
+            'ntotal': self.ntotal,
+            'next_id': self.next_id,
+            'index_type': self.index_type,
+            'compression': self.compression,
+            'trained_size': self.trained_size,
+            'documents': self.documents,
+            # JSON object keys must be strings, so chunks are stored as [id, chunk] pairs
+            'chunks': [[chunk_id, chunk] for chunk_id, chunk in self.chunks.items()]
+        }
+
+    @classmethod
+    def from_payload(cls, index, payload, read_only=False, lexical=None):
+        chunks = {int(chunk_id): chunk for chunk_id, chunk in payload.get('chunks', [])}
+        return cls(
+            payload.get('dimension', index.d),
+            index=index,
+            chunks=chunks,
+            documents=payload.get('documents', {}),
+            next_id=payload.get('next_id', max(chunks, default=-1) + 1),
+            read_only=read_only,
+            index_type=payload.get('index_type', 'flat'),
+            compression=payload.get('compression', 'none'),
+            trained_size=payload.get('trained_size', 0),
+            lexical=lexical
+        )
+
+
+def index_nbytes(index):
+    """Approximate bytes held by a FAISS index (codes, ids, centroids, graph links), read off its structure"""
+    if index is None:
+        return 0
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIDMap):
+        # The id array, plus the id -> position hash map IndexIDMap2 keeps next to it
+        per_id = 8 + (40 if isinstance(index, faiss.IndexIDMap2) else 0)
+        return index.ntotal * per_id + index_nbytes(index.index)
+    if isinstance(index, faiss.IndexHNSW):
+        hnsw = index.hnsw
+        return (hnsw.neighbors.size() * 4 + hnsw.levels.size() * 4 + hnsw.offsets.size() * 8
+                + index_nbytes(index.storage))
+    if isinstance(index, faiss.IndexIVF):
+        # Each inverted list entry is a code and an id; the hashtable direct map adds one slot per id
+        return index.ntotal * (index.code_size + 8 + 40) + index_nbytes(index.quantizer) + _trained_nbytes(index)
+    return index.ntotal * index.sa_code_size() + _trained_nbytes(index)
+
+
+def _trained_nbytes(index):
+    # PQ codebooks or scalar quantizer ranges
+    pq = getattr(index, 'pq', None)
+    if pq is not None:
+        return pq.centroids.size() * 4
+    sq = getattr(index, 'sq', None)
+    return sq.trained.size() * 4 if sq is not None else 0
+
+
+def _mmap_read_flags():
+    """FAISS read flags for a shared, memory-mapped, read-only load"""
+    # IO_FLAG_MMAP_IFC (mmap flat codes) only exists in newer faiss builds
+    flags = getattr(faiss, 'IO_FLAG_MMAP_IFC', 0) or faiss.IO_FLAG_MMAP
+    return flags | faiss.IO_FLAG_READ_ONLY
+
+
+def conversation_index_dir(conversation_id):
+    """Directory holding the persisted index for a conversation"""
+    safe_id = re.sub(r'[^A-Za-z0-9_.-]', '_', str(conversation_id))
+    return os.path.join(RAG_INDEX_DIR, safe_id)
+
+
+def conversation_index_mtime(conversation_id):
+    """Modification time of the persisted chunk file, or None if nothing is stored"""
+    if not RAG_PERSISTENCE_ENABLED or not conversation_id:
+        return None
+    try:
+        return os.path.getmtime(os.path.join(conversation_index_dir(conversation_id), CHUNKS_FILENAME))
+    except OSError:
+        return None
+
+
+def save_conversation_index(conversation_id, conversation_index):
+    """Write a conversation's FAISS index and chunk registry to disk atomically"""
+    if not RAG_PERSISTENCE_ENABLED or not conversation_id:
+        return False
+
+    directory = conversation_index_dir(conversation_id)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        index_path = os.path.join(directory, INDEX_FILENAME)
+        chunks_path = os.path.join(directory, CHUNKS_FILENAME)
+
+        # Write to temp files first so concurrent readers never see a half-written index
+        tmp_index_path = f"{index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        tmp_chunks_path = f"{chunks_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        lexical_path = os.path.join(directory, LEXICAL_FILENAME)
+        tmp_lexical_path = f"{lexical_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with conversation_index.lock:
+            # A conversation whose documents were all removed is stored as an empty flat index
+            index = conversation_index.index or faiss.IndexIDMap2(faiss.IndexFlatIP(conversation_index.dimension))
+            faiss.write_index(index, tmp_index_path)
+            with open(tmp_chunks_path, 'w', encoding='utf-8') as f:
+                json.dump(conversation_index.to_payload(), f, ensure_ascii=False)
+            with open(tmp_lexical_path, 'wb') as f:
+                np.savez(f, **conversation_index.lexical.to_arrays())
+
+        # The chunk file is replaced last: its mtime marks a complete write
+        os.replace(tmp_index_path, index_path)
+        os.replace(tmp_lexical_path, lexical_path)
+        os.replace(tmp_chunks_path, chunks_path)
+        print(f"💾 Persisted RAG index for conversation {conversation_id} ({conversation_index.ntotal} vectors)")
+        return True
+    except Exception as e:
+        print(f"❌ Failed to persist RAG index for conversation {conversation_id}: {e}")
+        return False
+
+
+def load_conversation_index(conversation_id, mmap=True):
+    """Load a persisted ConversationIndex, or None if nothing usable is stored"""
+    if not RAG_PERSISTENCE_ENABLED or not conversation_id:
+        return None
+
+    directory = conversation_index_dir(conversation_id)
+    index_path = os.path.join(directory, INDEX_FILENAME)
+    chunks_path = os.path.join(directory, CHUNKS_FILENAME)
+    if not os.path.exists(index_path) or not os.path.exists(chunks_path):
+        return None
+
+    try:
+        with open(chunks_path, 'r', encoding='utf-8') as f:
+            payload = json.load(f)
+
+        index = None
+        read_only = False
+        if mmap:
+            try:
+                index = faiss.read_index(index_path, _mmap_read_flags())
+                read_only = True
+            except Exception as e:
+                print(f"⚠️ Memory-mapped index load failed, reading into memory instead: {e}")
+        if index is None:
+            index = faiss.read_index(index_path)
+
+        if index.ntotal != payload.get('ntotal'):
+            # A writer replaced the index between our two reads; the next access retries
+            print(f"⚠️ Persisted index for conversation {conversation_id} is mid-update, skipping load")
+            return None
+
+        apply_search_params(index)
+        lexical = _load_lexical_index(os.path.join(directory, LEXICAL_FILENAME), payload)
+        print(f"📂 Loaded persisted RAG index for conversation {conversation_id} ({index.ntotal} vectors)")
+        return ConversationIndex.from_payload(index, payload, read_only=read_only, lexical=lexical)
+    except Exception as e:
+        print(f"❌ Failed to load RAG index for conversation {conversation_id}: {e}")
+        return None
+
+
+def _load_lexical_index(lexical_path, payload):
+    """Persisted BM25 postings, or None (rebuilt from chunk text) if missing or out of step"""
+    try:
+        with np.load(lexical_path, allow_pickle=False) as arrays:
+            lexical = LexicalIndex.from_arrays({name: arrays[name] for name in arrays.files})
+    except (OSError, KeyError, ValueError):
+        return None
+    if set(lexical.segments) != set(payload.get('documents', {})) or len(lexical) != len(payload.get('chunks', [])):
+        return None
+    return lexical
+
+
+def persisted_index_nbytes(conversation_id):
+    """On-disk FAISS index size, or None when nothing is persisted"""
+    if not RAG_PERSISTENCE_ENABLED or not conversation_id:
+        return None
+    try:
+        return os.path.getsize(os.path.join(conversation_index_dir(conversation_id), INDEX_FILENAME))
+    except OSError:
+        return None
+
+
+class RagStateRegistry:
+    """Loaded ConversationIndex objects under a byte budget with LRU and idle-TTL eviction.
+
+    mtime is the persisted version an entry corresponds to; None means the
+    in-memory copy was never saved, so it is spilled to disk before eviction.
+    Victims are chosen under the registry lock but spilled after it is released,
+    so a slow disk write never stalls lookups of other conversations.
+    """
+
+    def __init__(self, budget_bytes=RAG_MEMORY_BUDGET_MB * 1024 * 1024, ttl_seconds=RAG_STATE_TTL_SECONDS,
+                 on_evict=None):
+        self.budget_bytes = budget_bytes
+        self.ttl_seconds = ttl_seconds
+        self.on_evict = on_evict            # callback(conversation_id, reason, reloadable)
+        self.entries = OrderedDict()        # {conversation_id: entry}, least recently used first
+        self.spilling = {}                  # {conversation_id: entry} evicted and still being written to disk
+        self.total_bytes = 0
+        self.evictions = {'budget': 0, 'ttl': 0, 'archived': 0}
+        self.spills = 0
+        self.lock = threading.RLock()
+        self.write_locks = weakref.WeakValueDictionary()
+
+    def write_lock(self, conversation_id):
+        """Per-conversation lock serializing load-modify-save of its index (held by writers only)"""
+        with self.lock:
+            lock = self.write_locks.get(conversation_id)
+            if lock is None:
+                lock = self.write_locks[conversation_id] = threading.RLock()
+            return lock
+
+    def __contains__(self, conversation_id):
+        with self.lock:
+            return conversation_id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, conversation_id):
+        """Return the resident index (marking it recently used) or None"""
+        victims = []
+        with self.lock:
+            self._expire(victims)
+            entry = self.entries.get(conversation_id)
+            if entry is None and conversation_id in self.spilling:
+                # Evicted but not on disk yet: take it back rather than let the caller load a stale copy
+                entry = self.entries[conversation_id] = self.spilling.pop(conversation_id)
+                self.total_bytes += entry['bytes']
+            if entry is not None:
+                entry['last_access'] = time.time()
+                self.entries.move_to_end(conversation_id)
+        self._release(victims)
+        return entry['index'] if entry is not None else None
+
+    def mtime(self, conversation_id):
+        with self.lock:
+            entry = self.entries.get(conversation_id)
+            return entry['mtime'] if entry else None
+
+    def put(self, conversation_id, conversation_index, mtime=None):
+        """Register (or re-measure after a mutation) a conversation's index, then enforce the budget"""
+        # A persisted index is memory-mapped, so its file size is what it maps
+        index_bytes = persisted_index_nbytes(conversation_id) if mtime is not None else None
+        size = conversation_index.memory_bytes(index_bytes)
+        now = time.time()
+        victims = []
+        with self.lock:
+            self.spilling.pop(conversation_id, None)
+            previous = self.entries.pop(conversation_id, None)
+            if previous:
+                self.total_bytes -= previous['bytes']
+            self.entries[conversation_id] = {
+                'index': conversation_index,
+                'mtime': mtime,
+                'bytes': size,
+                'loaded_at': previous['loaded_at'] if previous else now,
+                'last_access': now
+            }
+            self.total_bytes += size
+            self._expire(victims)
+            self._enforce_budget(victims, keep=conversation_id)
+        self._release(victims)
+
+    def discard(self, conversation_id, reason='archived'):
+        """Drop a conversation's state immediately (e.g. when it is archived)"""
+        victims = []
+        with self.lock:
+            self.spilling.pop(conversation_id, None)
+            if conversation_id in self.entries:
+                self._evict(conversation_id, reason, victims)
+        self._release(victims)
+        return bool(victims)
+
+    def _expire(self, victims):
+        if self.ttl_seconds <= 0:
+            return
+        cutoff = time.time() - self.ttl_seconds
+        # Entries are in access order, so expired ones are all at the front
+        while self.entries:
+            conversation_id, entry = next(iter(self.entries.items()))
+            if entry['last_access'] >= cutoff:
+                break
+            self._evict(conversation_id, 'ttl', victims)
+
+    def _enforce_budget(self, victims, keep=None):
+        for conversation_id in list(self.entries):
+            if self.total_bytes <= self.budget_bytes:
+                break
+            if conversation_id != keep:
+                self._evict(conversation_id, 'budget', victims)
+
+    def _evict(self, conversation_id, reason, victims):
+        # Caller holds the lock; the entry is spilled and announced by _release once it is dropped
+        entry = self.entries.pop(conversation_id)
+        self.total_bytes -= entry['bytes']
+        self.evictions[reason] += 1
+        if entry['mtime'] is None and reason != 'archived' and RAG_PERSISTENCE_ENABLED:
+            self.spilling[conversation_id] = entry
+        victims.append((conversation_id, entry, reason))
+
+    def _release(self, victims):
+        """Spill unsaved victims to disk and notify on_evict; called without the lock held"""
+        for conversation_id, entry, reason in victims:
+            reloadable = entry['mtime'] is not None and reason != 'archived'
+            if self.spilling.get(conversation_id) is entry:
+                # Never persisted (e.g. an earlier save failed): spill so the next access reloads it
+                reloadable = save_conversation_index(conversation_id, entry['index'])
+                with self.lock:
+                    if self.spilling.get(conversation_id) is entry:
+                        del self.spilling[conversation_id]
+                    self.spills += reloadable
+            with self.lock:
+                if conversation_id in self.entries:
+                    continue    # taken back or registered again meanwhile
+            print(f"♻️ Evicted RAG state for conversation {conversation_id} ({reason}, "
+                  f"{entry['bytes'] / 1e6:.2f} MB)")
+            if self.on_evict:
+                self.on_evict(conversation_id, reason, reloadable)
+
+    def stats(self):
+        now = time.time()
+        victims = []
+        with self.lock:
+            self._expire(victims)
+            stats = {
+                'budget_bytes': self.budget_bytes,
+                'resident_bytes': self.total_bytes,
+                'ttl_seconds': self.ttl_seconds,
+                'resident_conversations': len(self.entries),
+                'evictions': dict(self.evictions),
+                'spills': self.spills,
+                'conversations': [{
+                    'conversation_id': conversation_id,
+                    'bytes': entry['bytes'],
+                    'chunks': len(entry['index'].chunks),
+                    'documents': len(entry['index'].documents),
+                    'index_type': entry['index'].index_type,
+                    'memory_mapped': entry['index'].read_only,
+                    'persisted': entry['mtime'] is not None,
+                    'idle_seconds': round(now - entry['last_access'], 1),
+                    'resident_seconds': round(now - entry['loaded_at'], 1)
+                } for conversation_id, entry in reversed(self.entries.items())]
+            }
+        self._release(victims)
+        return stats
@@ -0,0 +1,242 @@
+"""
+Document summaries computed in the background and cached by content hash.
+
+When an upload finishes indexing, its summary is generated on a small worker
+pool, so "summarize this document" is usually answered from the cache without
+waiting for the LLM. Summaries are stored as JSON files under RAG_SUMMARY_DIR
+keyed by the document's content hash (the SHA-256 of the uploaded bytes), so a
+re-upload of the same file into any conversation reuses its summary too.
+
+A request for a summary that is still being generated waits for that job
+instead of starting a second LLM call; only documents that were never
+scheduled are summarized on demand.
+
+Long documents are summarized map-reduce style: the text is cut into sections
+(SUMMARY_SECTION_TOKENS each, on sentence boundaries, using the ingest chunker
+without overlap), sections are summarized concurrently with at most
+SUMMARY_LLM_CONCURRENCY LLM calls in flight, and the partial summaries are
+merged, in rounds if they don't fit one prompt, into the final summary. Every
+intermediate summary is cached by the hash of its input, so summarizing a
+longer version of a document (e.g. with pages appended) only pays for the
+sections that changed.
+"""
+import os
+import re
+import json
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from chunking import iter_chunks
+
+SUMMARY_PRECOMPUTE = os.getenv('SUMMARY_PRECOMPUTE', 'true').lower() in ('1', 'true', 'yes')
+SUMMARY_WORKERS = int(os.getenv('SUMMARY_WORKERS', '2'))
+RAG_SUMMARY_DIR = os.getenv('RAG_SUMMARY_DIR', os.path.join(tempfile.gettempdir(), "rag_summaries"))
+SUMMARY_LLM_CONCURRENCY = int(os.getenv('SUMMARY_LLM_CONCURRENCY', '4'))   # section calls in flight
+SUMMARY_SECTION_TOKENS = int(os.getenv('SUMMARY_SECTION_TOKENS', '1000'))
+SUMMARY_REDUCE_CHARS = 12000   # partial summaries merged per reduce call
+SUMMARY_MAX_TOKENS = 500       # output cap for the final summary
+SECTION_MAX_TOKENS = 250       # output cap for section / merge summaries (one paragraph)
+SUMMARY_VERSION = 2            # bump when a prompt changes so stale summaries are regenerated
+
+SUMMARY_PROMPT = (
+    "Summarize the following document in 2-3 clear, well-structured paragraphs. "
+    "Focus on the main topics and key details. Separate each paragraph with a blank line.\n\n"
+)
+SECTION_PROMPT = (
+    "Summarize this section of a longer document in one concise paragraph. "
+    "Keep the key facts, names, figures and conclusions.\n\n"
+)
+REDUCE_PROMPT = (
+    "The following are summaries of consecutive sections of one document. "
+    "Combine them into a single summary of the whole document in 2-3 clear, well-structured paragraphs, "
+    "covering its main topics and key details. Separate each paragraph with a blank line.\n\n"
+)
+MERGE_PROMPT = (
+    "The following are summaries of consecutive sections of a longer document. "
+    "Merge them into one concise paragraph that keeps the key facts, names, figures and conclusions.\n\n"
+)
+
+SENTENCE_RE = re.compile(r'(?<=[.!?])\s+')
+
+
+def text_hash(text):
+    """Cache key for text that has no upload hash (documents indexed before hashing)"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def extractive_summary(text, sentences=6):
+    """First few substantial sentences, used when the LLM gives nothing usable"""
+    filtered = [s.strip() for s in SENTENCE_RE.split(text) if len(s.strip()) > 40]
+    return " ".join(filtered[:sentences])
+
+
+def usable(summary, min_words=20):
+    return summary.strip() if summary and len(summary.strip().split()) >= min_words else None
+
+
+def split_sections(text, section_tokens=SUMMARY_SECTION_TOKENS):
+    """Section texts; boundaries depend only on the text before them, so appends keep earlier sections"""
+    return [chunk['text'] for chunk in iter_chunks([text], section_tokens, overlap_tokens=0)]
+
+
+def group_partials(partials, max_chars=SUMMARY_REDUCE_CHARS):
+    """Consecutive runs of partial summaries that fit one reduce prompt.
+
+    Groups hold at least two partials (even if that overflows max_chars), so every
+    merge round shrinks the list and the reduce always terminates.
+    """
+    groups, current, size = [], [], 0
+    for partial in partials:
+        if len(current) >= 2 and size + len(partial) > max_chars:
+            groups.append(current)
+            current, size = [], 0
+        current.append(partial)
+        size += len(partial)
+    if current:
+        groups.append(current)
+    return groups
+
+
+class SummaryCache:
+    """Summaries on disk (one JSON file per content hash) with an in-memory front"""
+
+    def __init__(self, directory=RAG_SUMMARY_DIR):
+        self.directory = directory
+        self.memory = {}
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.v{SUMMARY_VERSION}.json")
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                return self.memory[key]
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                summary = json.load(f)['summary']
+        except (OSError, ValueError, KeyError):
+            return None
+        with self.lock:
+            self.memory[key] = summary
+        return summary
+
+    def put(self, key, summary):
+        with self.lock:
+            self.memory[key] = summary
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'summary': summary}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"⚠️ Could not persist summary {key[:12]}: {e}")
+
+
+class DocumentSummarizer:
+    """Background summary jobs, de-duplicated per content hash"""
+
+    def __init__(self, generate, cache=None, workers=SUMMARY_WORKERS):
+        self.generate = generate         # callable(prompt, max_tokens) -> text or None (the LLM call)
+        self.cache = cache if cache is not None else SummaryCache()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="summary")
+        # Shared by every document so total parallel LLM calls stay bounded
+        self.llm_executor = ThreadPoolExecutor(max_workers=SUMMARY_LLM_CONCURRENCY, thread_name_prefix="summary-llm")
+        self.pending = {}                # {key: Future} for summaries being generated
+        self.lock = threading.Lock()
+        self.served_cached = 0
+        self.served_waited = 0
+        self.generated = 0
+        self.parts_cached = 0            # section / merge summaries reused from the cache
+        self.parts_generated = 0
+
+    def _cached_call(self, prompt, text):
+        """Intermediate summary of text, cached by the hash of prompt and input"""
+        key = "part-" + text_hash(prompt + text)
+        summary = self.cache.get(key)
+        if summary is not None:
+            with self.lock:
+                self.parts_cached += 1
+            return summary
+        summary = usable(self.generate(prompt + text, SECTION_MAX_TOKENS), min_words=5)
+        if summary is None:
+            # Keep the reduce going with the section's own leading sentences; not cached, so it is retried
+            return extractive_summary(text, sentences=3) or text[:500]
+        self.cache.put(key, summary)
+        with self.lock:
+            self.parts_generated += 1
+        return summary
+
+    def summarize_text(self, text):
+        """Map-reduce summary of a document's text; None if the LLM gave nothing usable"""
+        sections = split_sections(text)
+        if len(sections) <= 1:
+            return usable(self.generate(SUMMARY_PROMPT + text, SUMMARY_MAX_TOKENS))
+        print(f"📝 Summarizing {len(sections)} sections ({SUMMARY_LLM_CONCURRENCY} LLM calls at a time)")
+        partials = list(self.llm_executor.map(lambda section: self._cached_call(SECTION_PROMPT, section), sections))
+        groups = group_partials(partials)
+        while len(groups) > 1:
+            partials = list(self.llm_executor.map(
+                lambda group: self._cached_call(MERGE_PROMPT, "\n\n".join(group)), groups))
+            groups = group_partials(partials)
+        return usable(self.generate(REDUCE_PROMPT + "\n\n".join(groups[0]), SUMMARY_MAX_TOKENS))
+
+    def _run(self, key, load_text):
+        try:
+            summary = self.summarize_text(load_text())
+            if summary:
+                self.cache.put(key, summary)
+                with self.lock:
+                    self.generated += 1
+            return summary
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+    def schedule(self, key, load_text):
+        """Start summarizing a document unless it is cached or already in progress"""
+        if self.cache.get(key) is not None:
+            return None
+        with self.lock:
+            future = self.pending.get(key)
+            if future is None:
+                future = self.pending[key] = self.executor.submit(self._run, key, load_text)
+                print(f"📝 Summary of {key[:12]} scheduled")
+            return future
+
+    def summary(self, key, load_text, timeout=None):
+        """The document's summary: cached, awaited from its running job, or generated now.
+
+        None on failure or if it isn't ready within timeout seconds (the job keeps running).
+        """
+        summary = self.cache.get(key)
+        if summary is not None:
+            with self.lock:
+                self.served_cached += 1
+            return summary
+        future = self.schedule(key, load_text)
+        with self.lock:
+            self.served_waited += 1
+        try:
+            return future.result(timeout) if future is not None else self.cache.get(key)
+        except FutureTimeoutError:
+            print(f"⏱️ Summary of {key[:12]} not ready within {timeout:.1f}s")
+            return None
+        except Exception as e:
+            print(f"❌ Summary of {key[:12]} failed: {e}")
+            return None
+
+    def stats(self):
+        with self.lock:
+            return {
+                'pending': len(self.pending),
+                'generated': self.generated,
+                'served_cached': self.served_cached,
+                'served_waited': self.served_waited,
+                'parts_cached': self.parts_cached,
+                'parts_generated': self.parts_generated
+            }
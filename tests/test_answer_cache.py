@@ -0,0 +1,53 @@
+import zlib
+import time
+
+import numpy as np
+import pytest
+
+from answer_cache import SemanticAnswerCache, is_cacheable_query, normalize_query
+
+
+def encode(text):
+    # Bag-of-words hashing: enough to tell identical from unrelated queries without a model
+    vector = np.zeros(64, dtype=np.float32)
+    for word in text.split():
+        vector[zlib.crc32(word.encode()) % 64] += 1
+    return vector.reshape(1, -1)
+
+
+@pytest.mark.parametrize("query", [
+    "tell me more about it",
+    "what about the second one?",
+    "summarize the uploaded pdf",
+    "what does the document say about revenue",
+    "https://example.com/article",
+    "news",
+])
+def test_context_and_document_queries_are_not_cacheable(query):
+    assert not is_cacheable_query(query)
+
+
+def test_self_contained_questions_are_cacheable():
+    assert is_cacheable_query("Latest news on Tesla?")
+    assert normalize_query("  Latest NEWS on Tesla?! ") == "latest news on tesla"
+
+
+def test_lookup_hits_near_duplicates_only():
+    cache = SemanticAnswerCache(encode, 64, threshold=0.9, ttl=60)
+    cache.store("latest news on Tesla", "answer", seconds=2.5)
+    assert cache.lookup("Latest news on Tesla!")[0] == "answer"
+    assert cache.lookup("weather in Paris today") is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['seconds_saved']) == (1, 1, 2.5)
+
+
+def test_entries_expire_and_are_capped():
+    cache = SemanticAnswerCache(encode, 64, threshold=0.9, ttl=60, max_entries=2)
+    for number in range(4):
+        cache.store(f"question number {number} here", str(number), seconds=1)
+    assert cache.stats()['entries'] == 2
+    assert cache.lookup("question number 0 here") is None
+    cache.ttl = 0
+    time.sleep(0.01)
+    assert cache.lookup("question number 3 here") is None
+    assert cache.stats()['entries'] == 0
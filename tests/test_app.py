@@ -0,0 +1,167 @@
+import io
+import json
+import time
+import threading
+
+import numpy as np
+import pytest
+
+main = pytest.importorskip("main", exc_type=ImportError)
+
+import rag_store
+from rag_store import ConversationIndex
+from deadline import Deadline
+from summaries import DocumentSummarizer, SummaryCache
+
+PROSE = "The quarterly report covers revenue, hiring and the new office in some detail today. "
+
+
+@pytest.fixture
+def index_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(rag_store, 'RAG_INDEX_DIR', str(tmp_path / "indexes"))
+    return tmp_path
+
+
+@pytest.fixture
+def summarizer(tmp_path, monkeypatch):
+    prompts = []
+    release = threading.Event()
+    release.set()
+
+    def generate(prompt, max_tokens):
+        prompts.append(prompt)
+        release.wait(5)
+        return "An LLM summary: " + " ".join(["detail"] * 30)
+
+    summarizer = DocumentSummarizer(generate, cache=SummaryCache(str(tmp_path / "summaries")))
+    summarizer.prompts = prompts
+    summarizer.release = release
+    monkeypatch.setattr(main, 'document_summarizer', summarizer)
+    return summarizer
+
+
+def test_pending_documents_are_not_summarised(index_dir, summarizer):
+    index = ConversationIndex(4)
+    index.append_chunks('done', 'done.txt', [PROSE * 3], np.ones((1, 4), dtype=np.float32), content_hash='hash-done')
+    index.append_chunks('half', 'half.txt', ["Half of a document"], np.ones((1, 4), dtype=np.float32),
+                        content_hash='hash-half', pending=True)
+    main.rag_registry.put('conv-pending', index)
+
+    summary = main.summarize_conversation_documents('conv-pending')
+    assert summary.startswith("An LLM summary") and len(summarizer.prompts) == 1
+    main.schedule_document_summary('conv-pending', 'half')
+    assert summarizer.cache.get('hash-half') is None and not summarizer.pending
+
+
+def test_summary_past_the_deadline_falls_back_to_extractive(index_dir, summarizer):
+    index = ConversationIndex(4)
+    index.append_chunks('doc', 'report.txt', [PROSE * 3], np.ones((1, 4), dtype=np.float32), content_hash='hash-slow')
+    main.rag_registry.put('conv-deadline', index)
+    summarizer.release.clear()
+
+    summary = main.summarize_conversation_documents('conv-deadline', Deadline(0.05))
+    assert summary.startswith("The quarterly report covers revenue")
+    # The LLM job kept running and the next request gets its summary
+    job = summarizer.pending['hash-slow']
+    summarizer.release.set()
+    job.result(5)
+    assert main.summarize_conversation_documents('conv-deadline').startswith("An LLM summary")
+    assert len(summarizer.prompts) == 1
+
+
+class FakeEmbeddingModel:
+    def encode(self, texts, **kwargs):
+        return np.array([[len(text), 1.0, 0.0, 0.0] for text in texts], dtype=np.float32)
+
+
+def wait_for_job(client, status_url):
+    for _ in range(200):
+        job = client.get(status_url).get_json()
+        if job['status'] in ('ready', 'failed'):
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"ingest job still {job['status']}")
+
+
+def test_batch_upload_skips_duplicates_and_reports_failed_files(index_dir, summarizer, monkeypatch):
+    monkeypatch.setattr(main, 'RAG_AVAILABLE', True)
+    monkeypatch.setattr(main, 'embedding_model', FakeEmbeddingModel())
+    monkeypatch.setattr(main, 'embedding_cache', None)
+    monkeypatch.setattr(main, 'artifact_store', None)
+    client = main.app.test_client()
+    report = (PROSE * 5).encode('utf-8')
+
+    response = client.post('/upload/batch', data={
+        'conversation_id': 'conv-batch',
+        'files': [(io.BytesIO(report), 'report.txt'), (io.BytesIO(report), 'report-copy.txt'),
+                  (io.BytesIO(b"%PDF-1.4 not really a pdf"), 'broken.pdf')]
+    }, content_type='multipart/form-data')
+    assert response.status_code == 202
+    files = {f['filename']: f for f in response.get_json()['files']}
+    assert files['report.txt']['status'] == 'queued' and files['broken.pdf']['status'] == 'queued'
+    assert files['report-copy.txt']['status'] == 'duplicate'
+    assert files['report-copy.txt']['doc_id'] == files['report.txt']['doc_id']
+
+    job = wait_for_job(client, response.get_json()['status_url'])
+    assert job['status'] == 'ready' and "from 1/2 files" in job['message']
+    statuses = {f['filename']: f for f in job['files']}
+    assert statuses['report.txt']['status'] == 'ready'
+    assert statuses['broken.pdf']['status'] == 'failed' and statuses['broken.pdf']['error']
+    index = main.ensure_conversation_index_loaded('conv-batch')
+    assert [document['filename'] for document in index.list_documents()] == ['report.txt']
+
+
+def sse_events(body):
+    """[(event, data)] of a text/event-stream body"""
+    events = []
+    for message in body.split("\n\n"):
+        if not message.strip():
+            continue
+        event, data = message.split("\n")
+        assert event.startswith("event: ") and data.startswith("data: ")
+        events.append((event[len("event: "):], json.loads(data[len("data: "):])))
+    return events
+
+
+@pytest.fixture
+def web_search(monkeypatch):
+    saved = []
+    results = [{'title': "Solar prices fall", 'url': "https://example.com/solar", 'snippet': "Prices fell."}]
+    monkeypatch.setattr(main, 'cached_web_answer', lambda query: None)
+    monkeypatch.setattr(main, 'cache_web_answer', lambda *args: None)
+    monkeypatch.setattr(main, 'get_universal_web_search', lambda query, num_results=1, deadline=None: results)
+    monkeypatch.setattr(main, 'save_assistant_message', lambda conversation, *args: saved.append(conversation))
+    return results, saved
+
+
+def stream_news(monkeypatch, pieces):
+    monkeypatch.setattr(main, 'stream_gemini_ai', lambda prompt, deadline=None, **generation: iter(pieces))
+    response = main.app.test_client().post('/api/news', json={'query': "latest solar panel prices", 'stream': True})
+    assert response.mimetype == 'text/event-stream'
+    return sse_events(response.get_data(as_text=True))
+
+
+def test_stream_sends_tokens_then_done_with_conversation_and_web_results(monkeypatch, web_search):
+    results, saved = web_search
+    monkeypatch.setattr(main, 'resolve_conversation', lambda query, user_email, conversation_id: ({'id': 'conv-sse'}, ""))
+    events = stream_news(monkeypatch, ["Solar panel prices ", "fell again this quarter, ", "by about ten percent."])
+
+    assert events[0] == ('stage', {'stage': 'conversation', 'conversation_id': 'conv-sse'})
+    tokens = [data['text'] for event, data in events if event == 'token']
+    assert "".join(tokens) == "Solar panel prices fell again this quarter, by about ten percent."
+    event, done = events[-1]
+    assert event == 'done' and done['result'] == "".join(tokens)
+    assert done['conversation_id'] == 'conv-sse' and done['web_results'] == results
+    assert done['mode'] == 'web_search_only' and saved == [{'id': 'conv-sse'}]
+
+
+def test_stream_creates_the_conversation_before_the_first_event(monkeypatch, web_search):
+    monkeypatch.setattr(main, 'resolve_conversation', lambda query, user_email, conversation_id: (None, ""))
+    monkeypatch.setattr(main.conversation_manager, 'get_or_create_conversation',
+                        lambda user_email, force_new=False: {'id': 'conv-new'})
+    monkeypatch.setattr(main, 'web_only_fallback', lambda *args: "Fallback answer from the search results.")
+    events = stream_news(monkeypatch, [])
+
+    assert events[0] == ('stage', {'stage': 'conversation', 'conversation_id': 'conv-new'})
+    assert ('replace', {'text': "Fallback answer from the search results."}) in events
+    assert events[-1][0] == 'done' and events[-1][1]['conversation_id'] == 'conv-new'
@@ -0,0 +1,54 @@
+import os
+
+import numpy as np
+
+from artifacts import ArtifactStore
+
+SETTINGS = {'model': 'model', 'chunk_tokens': 128, 'overlap_tokens': 16}
+
+
+def store_document(store, content_hash, chunks=2):
+    writer = store.writer(content_hash)
+    writer.add([{'text': f"chunk {i}", 'start': i * 10, 'end': i * 10 + 7} for i in range(chunks)],
+               np.ones((chunks, 4), dtype=np.float32))
+    assert writer.commit(f"{content_hash}.txt")
+
+
+def test_stored_document_is_reused(tmp_path):
+    store = ArtifactStore(SETTINGS, directory=str(tmp_path))
+    store_document(store, 'a' * 64)
+    stored = store.get('a' * 64)
+    assert stored.texts == ["chunk 0", "chunk 1"] and stored.offsets == [(0, 7), (10, 17)]
+    assert stored.vectors.shape == (2, 4)
+    assert sorted(os.listdir(stored.directory)) == ['chunks.json', 'embeddings.npy', 'meta.json']
+    assert store.get('b' * 64) is None
+    assert ArtifactStore({**SETTINGS, 'chunk_tokens': 64}, directory=str(tmp_path)).get('a' * 64) is None
+
+
+def test_size_is_tracked_without_rescanning(tmp_path, monkeypatch):
+    store = ArtifactStore(SETTINGS, directory=str(tmp_path))
+    store_document(store, 'a' * 64)
+
+    def walk():
+        raise AssertionError("publishing under budget must not rescan the store")
+
+    monkeypatch.setattr(store, '_entries', walk)
+    store_document(store, 'b' * 64)
+    stats = store.stats()
+    assert stats['entries'] == 2 and stats['bytes'] == sum(store.entry_bytes.values()) > 0
+    monkeypatch.undo()
+    # A new process starts from what is on disk
+    assert ArtifactStore(SETTINGS, directory=str(tmp_path)).stats()['bytes'] == stats['bytes']
+
+
+def test_least_recently_used_entries_are_pruned(tmp_path):
+    store = ArtifactStore(SETTINGS, directory=str(tmp_path))
+    for content_hash in ('a' * 64, 'b' * 64):
+        store_document(store, content_hash)
+    entry_bytes = max(store.entry_bytes.values())
+    os.utime(os.path.join(store.entry_dir('a' * 64), 'meta.json'), (1, 1))
+    store.max_bytes = 2 * entry_bytes + entry_bytes // 2
+    store_document(store, 'c' * 64)
+    assert store.get('a' * 64) is None
+    assert store.get('b' * 64) is not None and store.get('c' * 64) is not None
+    assert store.stats()['entries'] == 2
@@ -0,0 +1,50 @@
+import base64
+import random
+
+import pytest
+
+from chunking import estimate_tokens, iter_chunks, chunk_text, join_chunks
+
+PROSE = " ".join(f"Sentence number {i} talks about topic {i % 7} today." for i in range(300))
+
+
+def test_offsets_point_at_chunk_text():
+    segments = [PROSE[i:i + 97] for i in range(0, len(PROSE), 97)]
+    chunks = list(iter_chunks(segments, chunk_tokens=64, overlap_tokens=16))
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert PROSE[chunk['start']:chunk['end']] == chunk['text']
+        assert chunk['tokens'] <= 64
+    # Neighbours overlap by the carried sentences
+    assert chunks[1]['start'] < chunks[0]['end']
+
+
+def test_streamed_and_whole_text_chunk_the_same():
+    segments = [PROSE[i:i + 13] for i in range(0, len(PROSE), 13)]
+    assert list(iter_chunks(segments, chunk_tokens=48)) == chunk_text(PROSE, chunk_tokens=48)
+
+
+def test_join_chunks_restores_the_text():
+    chunks = chunk_text(PROSE, chunk_tokens=40, overlap_tokens=10)
+    assert join_chunks(chunks) == PROSE
+
+
+def test_list_numbers_are_not_sentence_ends():
+    chunks = chunk_text("1. Scope of the work\n2. Terms", chunk_tokens=6, overlap_tokens=0)
+    assert chunks[0]['text'].startswith("1. Scope")
+
+
+@pytest.mark.parametrize("text", [
+    "东京是日本的首都，也是世界上人口最多的城市之一。" * 200,
+    base64.b64encode(random.Random(0).randbytes(3750)).decode(),
+    "https://example.com/" + "a1b2c3d4" * 500,
+])
+def test_space_free_text_is_not_undercounted(text):
+    # Counting each run as one word reported 5000 characters as a handful of tokens
+    assert estimate_tokens(text) >= len(text) // 5
+    chunks = chunk_text(text, chunk_tokens=128, overlap_tokens=0)
+    for chunk in chunks:
+        assert chunk['tokens'] <= 128
+        assert len(chunk['text']) <= 128 * 5
+        assert text[chunk['start']:chunk['end']] == chunk['text']
+    assert join_chunks(chunks) == text
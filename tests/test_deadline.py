@@ -0,0 +1,30 @@
+import time
+
+from deadline import Deadline, DeadlineStats
+
+
+def test_stage_that_does_not_fit_is_skipped():
+    stats = DeadlineStats()
+    deadline = Deadline(5, stats)
+    assert deadline.allows('search', 1)
+    assert not deadline.allows('llm', 10)
+    assert deadline.stages == [{'stage': 'llm', 'skipped': True}]
+    assert stats.stats()['stages']['llm']['skipped'] == 1
+
+
+def test_timeout_is_capped_by_remaining_budget():
+    deadline = Deadline(5)
+    assert deadline.timeout(2) == 2
+    assert 4 < deadline.timeout() <= 5
+
+
+def test_stage_finishing_late_counts_as_a_miss():
+    stats = DeadlineStats()
+    deadline = Deadline(0.01, stats)
+    with deadline.stage('fetch'):
+        time.sleep(0.02)
+    summary = deadline.finish()
+    assert summary['stages'][0]['missed']
+    assert deadline.timeout() == 0.0
+    assert stats.stats()['stages']['fetch']['misses'] == 1
+    assert stats.stats()['over_budget'] == 1
@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+
+from embeddings import EmbeddingCache, QueryBatcher, chunk_key, encode_with_cache, length_bucketed_batches
+
+
+class CountingModel:
+    """Deterministic stand-in for the embedding model that records what it encoded"""
+
+    def __init__(self, dimension=4):
+        self.dimension = dimension
+        self.encoded = []
+
+    def encode(self, texts, batch_size=32, **kwargs):
+        self.encoded.extend(texts)
+        return np.array([[len(text), i, 1.0, 0.0][:self.dimension] for i, text in enumerate(texts)],
+                        dtype=np.float32)
+
+
+def keys(*texts):
+    return [chunk_key('model', text) for text in texts]
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), 'model', 4, capacity=3)
+    cache.store(keys('a', 'b', 'c'), np.eye(3, 4, dtype=np.float32))
+    cache.lookup(keys('a'))                         # 'b' is now the oldest
+    cache.store(keys('d'), np.ones((1, 4), dtype=np.float32))
+    vectors, missing = cache.lookup(keys('a', 'b', 'c', 'd'))
+    assert missing == [1]
+    assert np.array_equal(vectors[0], [1, 0, 0, 0])
+    assert cache.stats()['evictions'] == 1
+    assert len(cache) == 3
+
+
+def test_cache_survives_reopen_and_resets_on_model_change(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), 'model', 4, capacity=8)
+    cache.store(keys('a'), np.full((1, 4), 2.0, dtype=np.float32))
+    cache.flush()
+    reopened = EmbeddingCache(str(tmp_path), 'model', 4, capacity=8)
+    vectors, missing = reopened.lookup(keys('a'))
+    assert missing == [] and np.array_equal(vectors[0], [2, 2, 2, 2])
+    assert len(EmbeddingCache(str(tmp_path), 'other-model', 4, capacity=8)) == 0
+
+
+def test_encode_with_cache_only_encodes_misses(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), 'model', 4, capacity=8)
+    model = CountingModel()
+    first = encode_with_cache(model, ["one", "three"], cache)
+    model.encoded.clear()
+    second = encode_with_cache(model, ["three", "seven", "one"], cache)
+    assert model.encoded == ["seven"]
+    assert np.array_equal(second[0], first[1]) and np.array_equal(second[2], first[0])
+
+
+def test_repeated_chunks_are_encoded_and_stored_once(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), 'model', 4, capacity=4)
+    model = CountingModel()
+    vectors = encode_with_cache(model, ["Page footer", "Page footer", "a", "b"], cache)
+    assert sorted(model.encoded) == ["Page footer", "a", "b"]
+    assert np.array_equal(vectors[0], vectors[1])
+    assert len(cache) == 3 and len(cache.free_slots) == 1
+    # Duplicate keys handed straight to store() still take one slot each
+    cache.store(keys('c', 'c', 'a'), np.ones((3, 4), dtype=np.float32))
+    assert len(cache) == 4 and cache.free_slots == []
+    cache.store(keys('d'), np.ones((1, 4), dtype=np.float32))
+    assert len(cache) == 4 and len(set(cache.slots.values())) == 4
+
+
+def test_concurrent_queries_share_one_batch():
+    model = CountingModel()
+    batcher = QueryBatcher(model, wait_ms=200, max_batch_size=8)
+    futures = [batcher.submit(text) for text in ["a", "bb", "ccc"]]
+    rows = [future.result(timeout=5) for future in futures]
+    assert model.encoded == ["a", "bb", "ccc"]
+    assert [row[0] for row in rows] == [1, 2, 3]
+    assert batcher.stats()['batches'] == 1
+
+
+def test_failed_batch_fails_every_waiter():
+    class BrokenModel:
+        def encode(self, texts, **kwargs):
+            raise RuntimeError("model crashed")
+
+    batcher = QueryBatcher(BrokenModel(), wait_ms=200, max_batch_size=8)
+    futures = [batcher.submit(text) for text in ["a", "b"]]
+    for future in futures:
+        with pytest.raises(RuntimeError, match="model crashed"):
+            future.result(timeout=5)
+
+
+def test_length_buckets_fit_the_token_budget():
+    lengths = np.array([5, 100, 7, 60, 6, 100, 3])
+    batches = length_bucketed_batches(lengths, token_budget=200, max_batch_size=3)
+    assert sorted(p for batch in batches for p in batch) == list(range(len(lengths)))
+    for batch in batches:
+        assert len(batch) <= 3
+        assert len(batch) == 1 or len(batch) * max(lengths[batch]) <= 200
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("sentence_transformers")
+pytest.importorskip("onnxruntime")
+pytest.importorskip("tokenizers")
+
+import embeddings
+
+MODEL_NAME = 'all-MiniLM-L6-v2'
+SENTENCES = [
+    "The central bank raised interest rates by a quarter point on Wednesday.",
+    "Quarterly revenue grew 12% year over year, driven by cloud subscriptions.",
+    "Section 4.2 describes the termination clause and its notice period.",
+    "short",
+    "東京は日本の首都です。",
+    "Researchers reported a new battery chemistry with twice the energy density of lithium-ion cells, "
+    "though commercial production is still several years away according to the paper's authors.",
+]
+
+
+@pytest.fixture(scope="module")
+def reference():
+    try:
+        return embeddings.TorchEmbeddingBackend(MODEL_NAME)
+    except Exception as e:
+        pytest.skip(f"model unavailable: {e}")
+
+
+@pytest.mark.parametrize("quantize, min_cosine", [(False, 0.999), (True, 0.98)])
+def test_onnx_backend_matches_torch(reference, tmp_path_factory, quantize, min_cosine):
+    try:
+        backend = embeddings.OnnxEmbeddingBackend(MODEL_NAME, quantize=quantize,
+                                                  model_dir=str(tmp_path_factory.getbasetemp() / "onnx"))
+    except Exception as e:
+        pytest.skip(f"ONNX export unavailable: {e}")
+    assert backend.get_sentence_embedding_dimension() == reference.get_sentence_embedding_dimension()
+    parity = embeddings.embedding_parity(reference, backend, SENTENCES, batch_size=4)
+    assert parity['min'] >= min_cosine
+
+
+def test_length_bucketed_encode_keeps_input_order(reference):
+    bucketed = embeddings.encode_length_bucketed(reference, SENTENCES, token_budget=64)
+    plain = reference.encode(SENTENCES, batch_size=len(SENTENCES))
+    assert np.allclose(bucketed, plain, atol=1e-5)
@@ -0,0 +1,211 @@
+import io
+import struct
+import zipfile
+
+import pytest
+
+import extractors
+from extractors import PdfWorkerPool, iter_pdf_text, iter_pdf_text_parallel, resolve_extractor
+
+
+def pdf_with_pages(texts):
+    """Minimal PDF with one line of Helvetica text per page"""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in texts:
+        content = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET".encode()
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content))
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents %d 0 R "
+                       b"/Resources << /Font << /F1 3 0 R >> >> >>" % len(objects))
+        kids.append(b"%d 0 R" % len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(kids), len(kids))
+
+    out, offsets = io.BytesIO(b"%PDF-1.4\n"), []
+    out.seek(0, 2)
+    for number, body in enumerate(objects, 1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n%s\nendobj\n" % (number, body))
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    out.write(b"".join(b"%010d 00000 n \n" % offset for offset in offsets))
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+    return out.getvalue()
+
+
+@pytest.fixture(scope="module")
+def pool():
+    pytest.importorskip("PyPDF2")
+    pool = PdfWorkerPool(workers=2)
+    yield pool
+    pool.restart(pool.generation)
+
+
+def test_parallel_extraction_matches_sequential(pool):
+    pdf = pdf_with_pages([f"Page {number} text" for number in range(20)])
+    sequential = list(iter_pdf_text(io.BytesIO(pdf), 'pypdf2'))
+    parallel = list(iter_pdf_text_parallel(pdf, 20, 'pypdf2', pool=pool))
+    assert parallel == sequential
+    assert parallel[7].startswith("Page 7 text")
+    assert pool.stats()['start_method'] in ('forkserver', 'spawn')
+
+
+def test_documents_share_one_executor(pool):
+    pdf = pdf_with_pages(["one", "two", "three"])
+    list(iter_pdf_text_parallel(pdf, 3, 'pypdf2', pool=pool))
+    executor = pool.executor
+    list(iter_pdf_text_parallel(pdf, 3, 'pypdf2', pool=pool))
+    assert pool.executor is executor and pool.stats()['restarts'] == 0
+
+
+def test_timeout_restarts_the_pool(pool, monkeypatch):
+    monkeypatch.setattr(extractors, 'PAGES_PER_TASK', 1)
+    pdf = pdf_with_pages(["slow"] * 4)
+    with pytest.raises(extractors.ExtractionError, match="exceeded"):
+        list(iter_pdf_text_parallel(pdf, 4, 'pypdf2', pool=pool, timeout=0))
+    assert pool.stats()['restarts'] == 1
+    assert list(iter_pdf_text_parallel(pdf, 4, 'pypdf2', pool=pool))[0].startswith("slow")
+
+
+def test_spooled_upload_is_read_in_place(pool, monkeypatch):
+    from ingest import spool_upload
+    monkeypatch.setattr(extractors, 'pdf_worker_pool', pool)
+    monkeypatch.setattr(extractors, 'PDF_PARALLEL_MIN_PAGES', 2)
+    monkeypatch.setattr(extractors.tempfile, 'mkstemp', None)   # no second copy of the upload
+    pdf = pdf_with_pages([f"Page {number} text " + "x" * 40000 for number in range(30)])
+    spool, _ = spool_upload(io.BytesIO(pdf))
+    assert extractors.upload_path(spool)
+    pages = list(extractors.iter_pdf_document(spool, 'pypdf2'))
+    assert len(pages) == 30 and pages[29].startswith("Page 29 text")
+    spool.close()
+
+
+def test_small_pdf_is_parsed_once(monkeypatch):
+    PyPDF2 = pytest.importorskip("PyPDF2")
+    readers = []
+
+    class CountingReader(PyPDF2.PdfReader):
+        def __init__(self, *args, **kwargs):
+            readers.append(self)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(PyPDF2, 'PdfReader', CountingReader)
+    pages = list(extractors.iter_pdf_document(io.BytesIO(pdf_with_pages(["one", "two"])), 'pypdf2'))
+    assert [page.strip() for page in pages] == ["one", "two"] and len(readers) == 1
+
+
+END_OF_CHAIN, FREE_SECTOR, NO_STREAM = 0xFFFFFFFE, 0xFFFFFFFF, 0xFFFFFFFF
+
+
+def ole_file(streams):
+    """Minimal OLE2 compound file holding the given {name: bytes} streams (each padded to 4 KB)"""
+    streams = {name: data.ljust(4096, b"\0") for name, data in streams.items()}
+    fat, sectors, entries = [0xFFFFFFFD, END_OF_CHAIN], [], []
+    for name, data in streams.items():
+        count = -(-len(data) // 512)
+        start = len(fat)
+        fat.extend(list(range(start + 1, start + count)) + [END_OF_CHAIN])
+        sectors.append(data.ljust(count * 512, b"\0"))
+        entries.append((name, 2, start, len(data)))
+
+    def entry(name, kind, start, size, right=NO_STREAM, child=NO_STREAM):
+        encoded = (name + "\0").encode('utf-16-le')
+        return (encoded.ljust(64, b"\0") + struct.pack('<HBB3I', len(encoded), kind, 1, NO_STREAM, right, child)
+                + b"\0" * 36 + struct.pack('<IQ', start, size))
+
+    # Streams hang off the root as a chain of right siblings
+    directory = entry("Root Entry", 5, END_OF_CHAIN, 0, child=1)
+    for number, (name, kind, start, size) in enumerate(entries, 1):
+        directory += entry(name, kind, start, size, right=number + 1 if number < len(entries) else NO_STREAM)
+    directory = directory.ljust(512, b"\0")
+
+    header = (extractors.OLE_MAGIC + b"\0" * 16 + struct.pack('<HHHHH', 0x3E, 3, 0xFFFE, 9, 6) + b"\0" * 6
+              + struct.pack('<9I', 0, 1, 1, 0, 4096, END_OF_CHAIN, 0, END_OF_CHAIN, 0)
+              + struct.pack('<109I', 0, *[FREE_SECTOR] * 108))
+    fat_sector = struct.pack(f'<{len(fat)}I', *fat).ljust(512, b"\xff")
+    return header + fat_sector + directory + b"".join(sectors)
+
+
+def word_document(pieces, n_fib=0xC1, encrypted=False):
+    """Word 97 .doc whose piece table holds (text, compressed) pieces, with a formatting entry before it"""
+    word = bytearray(4096)
+    flags = 0x0200 | (0x0100 if encrypted else 0)
+    struct.pack_into('<H', word, 0x02, n_fib)
+    struct.pack_into('<H', word, 0x0A, flags)
+    cps, descriptors, offset = [0], b"", 0x800
+    for text, compressed in pieces:
+        data = text.encode('cp1252' if compressed else 'utf-16-le')
+        word[offset:offset + len(data)] = data
+        fc = (offset * 2) | 0x40000000 if compressed else offset
+        descriptors += struct.pack('<HIH', 0, fc, 0)
+        cps.append(cps[-1] + len(text))
+        offset += len(data) + 16
+    plc = struct.pack(f'<{len(cps)}I', *cps) + descriptors
+    clx = b"\x01\x02\x00\xaa\xbb" + b"\x02" + struct.pack('<I', len(plc)) + plc
+    struct.pack_into('<II', word, 0x01A2, 0, len(clx))
+    return ole_file({"WordDocument": bytes(word), "1Table": clx})
+
+
+def test_doc_pieces_decode_compressed_and_unicode_text():
+    pytest.importorskip("olefile")
+    doc = word_document([("Plain \x13 HYPERLINK x \x14link\x15 text\r", True), ("Ünïcode € piece\r", False)])
+    segments = list(extractors.iter_document_text(io.BytesIO(doc), "report.doc"))
+    assert segments == ["Plain link text\n", "Ünïcode € piece\n"]
+
+
+@pytest.mark.parametrize('options, message', [({'n_fib': 0x65}, "Word 6/95"), ({'encrypted': True}, "Encrypted")])
+def test_unsupported_doc_files_are_rejected(options, message):
+    pytest.importorskip("olefile")
+    doc = word_document([("text\r", True)], **options)
+    with pytest.raises(extractors.ExtractionError, match=message):
+        list(extractors.iter_doc_text(io.BytesIO(doc)))
+
+
+def zip_file(names):
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, 'w') as archive:
+        for name in names:
+            archive.writestr(name, "<xml/>")
+    return io.BytesIO(out.getvalue())
+
+
+def test_content_wins_over_extension_and_mime_type():
+    assert resolve_extractor(io.BytesIO(b"%PDF-1.4 ..."), "notes.txt", "text/plain") == 'pdf'
+    assert resolve_extractor(io.BytesIO(extractors.OLE_MAGIC + b"rest"), "letter.docx") == 'doc'
+    assert resolve_extractor(zip_file(["word/document.xml"]), "letter.doc", "application/msword") == 'docx'
+
+
+def test_resolution_falls_back_to_extension_then_mime_type_then_text():
+    stream = zip_file(["data.csv"])              # a ZIP, but not a Word document
+    assert resolve_extractor(stream, "letter.DOCX") == 'docx'
+    assert stream.tell() == 0
+    assert resolve_extractor(io.BytesIO(b"plain"), "upload", "application/pdf; charset=binary") == 'pdf'
+    assert resolve_extractor(io.BytesIO(b"plain"), "upload.md", "application/pdf") == 'text'
+    assert resolve_extractor(io.BytesIO(b"plain"), "upload.bin", "application/octet-stream") == 'text'
+
+
+def test_docx_yields_paragraphs_and_table_rows_in_document_order():
+    docx = pytest.importorskip("docx")
+    document = docx.Document()
+    document.add_paragraph("Before the table")
+    table = document.add_table(rows=2, cols=2)
+    for row, values in zip(table.rows, [("a", "b"), ("c", "d")]):
+        for cell, value in zip(row.cells, values):
+            cell.text = value
+    document.add_paragraph("After the table")
+    out = io.BytesIO()
+    document.save(out)
+    out.seek(0)
+    segments = list(extractors.iter_document_text(out, "upload"))
+    assert segments == ["Before the table\n", "a\tb\n", "c\td\n", "After the table\n"]
+
+
+def test_text_is_streamed_in_blocks_and_the_upload_stays_open(monkeypatch):
+    monkeypatch.setattr(extractors, 'TEXT_READ_CHARS', 4)
+    stream = io.BytesIO("héllo wörld".encode('utf-8') + b"\xff!")
+    counted = []
+    text_stream = extractors.TextStream(extractors.iter_document_text(stream, "notes.txt"),
+                                        progress=lambda count, characters: counted.append((count, characters)))
+    segments = list(text_stream)
+    assert segments == ["héll", "o wö", "rld!"]
+    assert counted[-1] == (3, 12) and text_stream.content_characters == 12
+    assert not stream.closed
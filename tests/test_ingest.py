@@ -0,0 +1,40 @@
+import pytest
+import numpy as np
+
+from chunking import iter_chunks
+from ingest import run_pipeline, require_content, EmptyDocumentError
+
+
+def embed(batch):
+    return np.ones((len(batch), 4), dtype=np.float32)
+
+
+def test_empty_document_is_rejected_before_indexing():
+    indexed = []
+    with pytest.raises(EmptyDocumentError):
+        run_pipeline(require_content(iter_chunks([" \n ", "ok", "\n\n"])), embed,
+                     lambda batch, vectors: indexed.extend(batch))
+    assert indexed == []
+
+
+def test_document_with_content_is_indexed_in_full():
+    indexed = []
+    text = "First sentence of the document. " * 200
+    stats = run_pipeline(require_content(iter_chunks([text])), embed,
+                         lambda batch, vectors: indexed.extend(batch), batch_size=4)
+    assert stats.chunks == len(indexed) > 1
+    assert indexed[0]['start'] == 0
+
+
+def test_pipeline_reraises_stage_errors():
+    def failing_embed(batch):
+        raise RuntimeError("embedding failed")
+
+    with pytest.raises(RuntimeError, match="embedding failed"):
+        run_pipeline(iter_chunks(["Some text. " * 500]), failing_embed, lambda batch, vectors: None, batch_size=2)
+
+    def failing_index(batch, vectors):
+        raise ValueError("index failed")
+
+    with pytest.raises(ValueError, match="index failed"):
+        run_pipeline(iter_chunks(["Some text. " * 500]), embed, failing_index, batch_size=2)
@@ -0,0 +1,55 @@
+from lexical import LexicalIndex, tokenize, identifier_terms, reciprocal_rank_fusion
+
+
+def index():
+    lexical = LexicalIndex()
+    lexical.add_document('a', [0, 1], ["Section 4.2.1 covers refunds", "shipping takes five days"])
+    lexical.add_document('b', [2], ["refunds for SKU-1138 are issued within five days"])
+    return lexical
+
+
+def test_identifiers_are_indexed_whole_and_by_parts():
+    assert tokenize("See SKU-1138 in the doc") == ['see', 'sku-1138', 'sku', '1138', 'doc']
+    assert identifier_terms('what does "error 42" mean for SKU-1138 in 4.2.1?') == {'error', '42', 'sku-1138', '4.2.1'}
+    # Plain numbers, acronyms and hyphenated words are not codes
+    assert identifier_terms("AI safety changes in 2024 for well-known NASA teams") == set()
+
+
+def test_search_ranks_by_bm25():
+    hits = index().search("refunds sku-1138", top_k=2)
+    assert [chunk_id for _, chunk_id in hits] == [2, 0]
+    assert index().search("unrelated words") == []
+
+
+def test_removed_documents_stop_matching():
+    lexical = index()
+    lexical.search("refunds")
+    lexical.remove_document('b')
+    assert [chunk_id for _, chunk_id in lexical.search("refunds")] == [0]
+    assert len(lexical) == 2
+
+
+def test_array_round_trip():
+    lexical = index()
+    restored = LexicalIndex.from_arrays(lexical.to_arrays())
+    assert restored.search("five days") == lexical.search("five days")
+
+
+def test_reciprocal_rank_fusion_rewards_agreement():
+    fused = reciprocal_rank_fusion([[1, 2, 3], [3, 1]])
+    assert [item for _, item in fused] == [1, 3, 2]
+
+
+def test_vocabulary_shrinks_once_enough_terms_are_dead():
+    lexical = index()
+    lexical.add_document('c', [3], ["zebra quokka axolotl narwhal okapi pangolin"])
+    vocabulary = len(lexical.terms)
+    lexical.remove_document('c')
+    hits = lexical.search("refunds five")
+    assert len(lexical.terms) == vocabulary - 6 and 'zebra' not in lexical.vocab
+    assert [chunk_id for _, chunk_id in hits] == [chunk_id for _, chunk_id in index().search("refunds five")]
+    restored = LexicalIndex.from_arrays(lexical.to_arrays())
+    assert restored.search("sku-1138") == lexical.search("sku-1138")
+    lexical.remove_document('a')
+    lexical.remove_document('b')
+    assert lexical.search("refunds") == [] and lexical.terms == []
@@ -0,0 +1,41 @@
+import time
+
+from llm_cache import LLMResponseCache, response_key
+
+
+def test_key_covers_model_config_and_prompt():
+    config = {'max_output_tokens': 100, 'temperature': 0.2}
+    key = response_key('model', config, "prompt")
+    assert key == response_key('model', dict(config), "prompt")
+    assert key != response_key('model', {**config, 'temperature': 0.3}, "prompt")
+    assert key != response_key('other', config, "prompt")
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    cache = LLMResponseCache(ttl=60)
+    cache.put('k', "answer")
+    assert cache.get('k') == "answer"
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 61)
+    assert cache.get('k') is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_memory_is_bounded_by_bytes():
+    cache = LLMResponseCache(max_bytes=10)
+    cache.put('a', "aaaa")
+    cache.put('b', "bbbb")
+    cache.get('a')                      # 'b' becomes least recently used
+    cache.put('c', "cccc")
+    assert cache.get('b') is None
+    assert cache.get('a') == "aaaa" and cache.get('c') == "cccc"
+    assert cache.stats()['bytes'] == 8
+    cache.put('huge', "x" * 11)         # larger than the whole budget: not cached
+    assert cache.get('huge') is None and cache.get('a') == "aaaa"
+
+
+def test_disk_tier_is_shared(tmp_path):
+    LLMResponseCache(directory=str(tmp_path)).put('k', "from disk")
+    other = LLMResponseCache(directory=str(tmp_path))
+    assert other.get('k') == "from disk"
+    assert other.stats()['disk_hits'] == 1
@@ -0,0 +1,82 @@
+import threading
+
+import pytest
+
+from llm_cache import LLMResponseCache
+from llm_client import GeminiClient
+
+
+class Response:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeModel:
+    """generate_content stand-in: blocks until released, then returns (or raises) the next scripted result"""
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.calls = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def generate_content(self, prompt, generation_config=None, request_options=None, stream=False):
+        self.calls.append((prompt, generation_config))
+        self.started.set()
+        self.release.wait(5)
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return Response(result)
+
+
+class InflightRegistry(dict):
+    """client.inflight that signals once a second caller has looked up a running prompt"""
+
+    def __init__(self):
+        super().__init__()
+        self.lookups = 0
+        self.joined = threading.Event()
+
+    def get(self, key, default=None):
+        self.lookups += 1
+        if self.lookups == 2:
+            self.joined.set()
+        return super().get(key, default)
+
+
+def client_with(model):
+    client = GeminiClient(cache=LLMResponseCache())
+    client._model = lambda model_name: model
+    return client
+
+
+def test_identical_concurrent_prompts_share_one_call():
+    model = FakeModel("the answer")
+    client = client_with(model)
+    client.inflight = InflightRegistry()
+    answers = []
+    leader = threading.Thread(target=lambda: answers.append(client.generate("prompt", max_output_tokens=50)))
+    leader.start()
+    assert model.started.wait(5)
+    follower = threading.Thread(target=lambda: answers.append(client.generate("prompt", max_output_tokens=50)))
+    follower.start()
+    assert client.inflight.joined.wait(5)
+    model.release.set()
+    leader.join(5)
+    follower.join(5)
+    assert answers == ["the answer", "the answer"]
+    assert len(model.calls) == 1 and model.calls[0][1]['max_output_tokens'] == 50
+    assert client.inflight == {}
+
+
+def test_failures_are_not_cached():
+    model = FakeModel(RuntimeError("quota"), None, "recovered")
+    model.release.set()
+    client = client_with(model)
+    with pytest.raises(RuntimeError, match="quota"):
+        client.generate("prompt")
+    assert client.generate("prompt") is None
+    assert client.generate("prompt") == "recovered"
+    assert client.generate("prompt") == "recovered" and len(model.calls) == 3
+    assert client.stats()['failures'] == 1
@@ -0,0 +1,183 @@
+import numpy as np
+import pytest
+
+import rag_store
+from rag_store import ConversationIndex, save_conversation_index, load_conversation_index
+
+DIMENSION = 8
+
+
+def vectors(count, seed):
+    return np.random.default_rng(seed).standard_normal((count, DIMENSION)).astype(np.float32)
+
+
+@pytest.fixture
+def index_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(rag_store, 'RAG_INDEX_DIR', str(tmp_path))
+    monkeypatch.setattr(rag_store, 'RAG_PERSISTENCE_ENABLED', True)
+    return tmp_path
+
+
+def conversation():
+    index = ConversationIndex(DIMENSION)
+    index.add_document('doc-a', 'a.txt', ["alpha report SKU-1138", "alpha appendix"], vectors(2, 1),
+                       offsets=[(0, 20), (21, 36)])
+    index.add_document('doc-b', 'b.txt', ["beta summary", "beta figures", "beta notes"], vectors(3, 2))
+    return index
+
+
+def test_save_and_mmap_load_round_trip(index_dir):
+    index = conversation()
+    assert save_conversation_index('conv-1', index)
+    loaded = load_conversation_index('conv-1', mmap=True)
+    assert loaded.read_only
+    assert loaded.ntotal == index.ntotal
+    assert loaded.chunks == index.chunks and loaded.next_id == index.next_id
+    assert loaded.document_chunks('doc-a')[0]['start'] == 0
+    query = vectors(2, 1)[0]
+    assert loaded.search(query, 1)[0][1]['text'] == "alpha report SKU-1138"
+
+    # Mutating a memory-mapped index switches to a private copy and leaves the file alone
+    loaded.remove_document('doc-b')
+    assert not loaded.read_only and loaded.ntotal == 2
+    assert load_conversation_index('conv-1').ntotal == 5
+
+
+def test_load_without_persisted_index(index_dir):
+    assert load_conversation_index('missing') is None
+
+
+def test_add_and_remove_only_touch_one_document():
+    index = conversation()
+    assert index.ntotal == 5
+    assert index.remove_document('doc-a') == 2
+    assert index.ntotal == 3 and set(index.documents) == {'doc-b'}
+    assert index.remove_document('doc-a') == 0
+    # Chunk ids are never reused
+    index.add_document('doc-c', 'c.txt', ["gamma"], vectors(1, 3))
+    assert index.documents['doc-c']['chunk_ids'] == [5]
+
+
+def test_search_finds_the_matching_vector():
+    index = conversation()
+    query = vectors(3, 2)[1]
+    score, chunk = index.search(query, top_k=1)[0]
+    assert chunk['text'] == "beta figures" and score > 0.99
+
+
+def test_index_type_follows_corpus_size(monkeypatch):
+    monkeypatch.setattr(rag_store, 'RAG_ANN_THRESHOLD', 64)
+    index = conversation()
+    assert index.index_type == 'flat'
+    texts = [f"chunk {number}" for number in range(80)]
+    embeddings = vectors(80, 4)
+    index.add_document('doc-c', 'c.txt', texts, embeddings)
+    assert index.index_type == 'ivf' and index.ntotal == 85
+    assert index.search(embeddings[42], top_k=1)[0][1]['text'] == "chunk 42"
+    # Dropping back under the threshold migrates to an exact index again
+    index.remove_document('doc-c')
+    assert index.index_type == 'flat' and index.ntotal == 5
+
+
+@pytest.mark.parametrize('compression', ['fp16', 'int8'])
+def test_compressed_storage_keeps_results(monkeypatch, compression):
+    monkeypatch.setattr(rag_store, 'RAG_EMBEDDING_COMPRESSION', compression)
+    index = conversation()
+    assert index.compression == compression
+    assert index.search(vectors(3, 2)[1], top_k=1)[0][1]['text'] == "beta figures"
+    assert rag_store.index_nbytes(index.index) < rag_store.index_nbytes(
+        rag_store.build_index('flat', DIMENSION, vectors(5, 1), np.arange(5, dtype=np.int64)))
+
+
+def test_pq_falls_back_to_int8_until_there_is_enough_training_data(monkeypatch):
+    monkeypatch.setattr(rag_store, 'RAG_EMBEDDING_COMPRESSION', 'pq')
+    assert rag_store.choose_compression(10) == 'int8'
+    assert rag_store.choose_compression(rag_store.PQ_MIN_TRAINING_POINTS) == 'pq'
+
+
+def test_hybrid_search_answers_identifiers_from_bm25():
+    index = conversation()
+
+    def embed_query():
+        raise AssertionError("identifier lookups should not embed the query")
+
+    hits = index.hybrid_search("what is SKU-1138?", embed_query, top_k=1)
+    assert hits[0][1]['text'] == "alpha report SKU-1138"
+
+
+def test_hybrid_search_fuses_dense_results_for_plain_queries():
+    index = conversation()
+    embedded = []
+
+    def embed_query():
+        embedded.append(True)
+        return vectors(3, 2)[1]
+
+    hits = index.hybrid_search("beta figures for 2024", embed_query, top_k=1)
+    assert embedded and hits[0][1]['text'] == "beta figures"
+
+
+def test_registry_measures_without_serializing(monkeypatch):
+    monkeypatch.setattr(rag_store.faiss, 'serialize_index', None)
+    registry = rag_store.RagStateRegistry(budget_bytes=10 ** 9)
+    registry.put('conv-1', conversation())
+    assert registry.stats()['resident_bytes'] > 5 * DIMENSION * 4
+
+
+def test_budget_eviction_spills_outside_the_registry_lock(index_dir, monkeypatch):
+    evicted, lock_free = [], []
+    registry = rag_store.RagStateRegistry(budget_bytes=1, on_evict=lambda *args: evicted.append(args))
+
+    def save(conversation_id, conversation_index):
+        # Another thread must be able to use the registry while the spill writes to disk
+        def probe():
+            if registry.lock.acquire(timeout=1):
+                registry.lock.release()
+                lock_free.append(True)
+
+        thread = rag_store.threading.Thread(target=probe)
+        thread.start()
+        thread.join()
+        return True
+
+    monkeypatch.setattr(rag_store, 'save_conversation_index', save)
+    registry.put('conv-1', conversation())
+    registry.put('conv-2', conversation())
+    assert lock_free == [True]
+    assert evicted == [('conv-1', 'budget', True)]
+    assert registry.stats()['spills'] == 1 and 'conv-1' not in registry
+
+
+def test_budget_eviction_without_persistence_is_not_reloadable(monkeypatch):
+    monkeypatch.setattr(rag_store, 'RAG_PERSISTENCE_ENABLED', False)
+    evicted = []
+    registry = rag_store.RagStateRegistry(budget_bytes=1, on_evict=lambda *args: evicted.append(args))
+    registry.put('conv-1', conversation())
+    registry.put('conv-2', conversation())
+    assert evicted == [('conv-1', 'budget', False)]
+
+
+def test_get_takes_back_an_index_that_is_still_spilling(index_dir, monkeypatch):
+    registry = rag_store.RagStateRegistry(budget_bytes=1)
+    first = conversation()
+    taken_back = []
+    monkeypatch.setattr(rag_store, 'save_conversation_index',
+                        lambda conversation_id, index: taken_back.append(registry.get(conversation_id)) or True)
+    registry.put('conv-1', first)
+    registry.put('conv-2', conversation())
+    assert taken_back == [first]
+    assert 'conv-1' in registry and registry.mtime('conv-1') is None
+
+
+def test_pending_document_is_hidden_until_ready():
+    index = conversation()
+    index.append_chunks('doc-c', 'c.txt', ["gamma SKU-1138 draft"], vectors(1, 5), pending=True)
+    assert not index.is_ready('doc-c') and index.is_ready('doc-a')
+    assert all(chunk['doc_id'] != 'doc-c' for chunk in index.ordered_chunks())
+    assert all(chunk['doc_id'] != 'doc-c' for _, chunk in index.search(vectors(1, 5)[0], top_k=5))
+    hits = index.hybrid_search("gamma draft", lambda: vectors(1, 5)[0], top_k=5)
+    assert all(chunk['doc_id'] != 'doc-c' for _, chunk in hits)
+
+    index.mark_ready('doc-c')
+    assert index.search(vectors(1, 5)[0], top_k=1)[0][1]['doc_id'] == 'doc-c'
+    assert index.list_documents()[-1]['status'] == 'ready'
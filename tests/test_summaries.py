@@ -0,0 +1,80 @@
+import threading
+
+import summaries
+from summaries import DocumentSummarizer, SummaryCache, split_sections
+
+LONG_TEXT = " ".join(f"Sentence number {i} talks about topic {chr(97 + i % 26)} in some detail." for i in range(600))
+
+
+class FakeLLM:
+    """generate(prompt, max_tokens) stand-in that records prompts and can be held back"""
+
+    def __init__(self):
+        self.prompts = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, prompt, max_tokens):
+        self.prompts.append(prompt)
+        self.release.wait(5)
+        return f"Summary number {len(self.prompts)}: " + " ".join(["point"] * 25)
+
+    def count(self, prefix):
+        return sum(prompt.startswith(prefix) for prompt in self.prompts)
+
+
+def make_summarizer(tmp_path, llm):
+    return DocumentSummarizer(llm, cache=SummaryCache(str(tmp_path)))
+
+
+def test_summary_is_cached_by_content_hash(tmp_path):
+    llm = FakeLLM()
+    first = make_summarizer(tmp_path, llm)
+    summary = first.summary('hash-1', lambda: "A short document about quarterly revenue.")
+    assert summary.startswith("Summary number 1") and llm.count(summaries.SUMMARY_PROMPT) == 1
+    # Another process (or conversation) with the same upload reads it from disk
+    assert make_summarizer(tmp_path, llm).summary('hash-1', lambda: "unused") == summary
+    assert len(llm.prompts) == 1
+
+
+def test_request_waits_for_the_scheduled_job_instead_of_calling_again(tmp_path):
+    llm = FakeLLM()
+    llm.release.clear()
+    summarizer = make_summarizer(tmp_path, llm)
+    summarizer.schedule('hash-1', lambda: "A short document.")
+    assert summarizer.summary('hash-1', lambda: "A short document.", timeout=0.05) is None
+    llm.release.set()
+    assert summarizer.summary('hash-1', lambda: "A short document.", timeout=5).startswith("Summary number 1")
+    assert len(llm.prompts) == 1 and summarizer.stats()['pending'] == 0
+
+
+def test_long_documents_are_summarised_map_reduce(tmp_path):
+    llm = FakeLLM()
+    sections = split_sections(LONG_TEXT)
+    assert len(sections) > 1
+    summary = make_summarizer(tmp_path, llm).summary('hash-long', lambda: LONG_TEXT)
+    assert llm.count(summaries.SECTION_PROMPT) == len(sections)
+    assert llm.count(summaries.REDUCE_PROMPT) == 1 and llm.count(summaries.SUMMARY_PROMPT) == 0
+    reduce_prompt = next(prompt for prompt in llm.prompts if prompt.startswith(summaries.REDUCE_PROMPT))
+    assert summary.startswith(f"Summary number {len(sections) + 1}") and reduce_prompt.count("Summary number") == len(sections)
+
+
+def test_partials_that_do_not_fit_one_prompt_are_merged_in_rounds(tmp_path, monkeypatch):
+    # Every partial is larger than the limit: rounds still pair them up until one group is left
+    monkeypatch.setattr(summaries, 'group_partials',
+                        lambda partials, max_chars=200, group=summaries.group_partials: group(partials, max_chars))
+    llm = FakeLLM()
+    make_summarizer(tmp_path, llm).summarize_text(LONG_TEXT)
+    assert llm.count(summaries.MERGE_PROMPT) > 0 and llm.count(summaries.REDUCE_PROMPT) == 1
+
+
+def test_unchanged_sections_come_from_the_cache(tmp_path):
+    llm = FakeLLM()
+    summarizer = make_summarizer(tmp_path, llm)
+    summarizer.summary('hash-v1', lambda: LONG_TEXT)
+    llm.prompts.clear()
+    longer = LONG_TEXT + " " + " ".join(f"Appended sentence {i} adds new material." for i in range(100))
+    summarizer.summary('hash-v2', lambda: longer)
+    changed = len(set(split_sections(longer)) - set(split_sections(LONG_TEXT)))
+    assert 0 < llm.count(summaries.SECTION_PROMPT) == changed < len(split_sections(longer))
+    assert summarizer.stats()['parts_cached'] == len(split_sections(longer)) - changed